@@ -0,0 +1,163 @@
+"""Микробенчмарк функций, выполняемых для каждой медиазаписи при разборе ответов
+Instagram: поиск хэштегов, извлечение значений по пути и формирование имени
+файла по шаблону. Сравнивается прежняя реализация (повторная компиляция
+выражений и многократный вызов time.localtime) с текущей из модуля parsing.
+
+Использование:
+    python benchmark.py [страница_graphql.json ...]
+
+В качестве аргументов передаются сохранённые ответы GraphQL-запроса медиа
+пользователя. Без аргументов используется синтетическая страница.
+"""
+import os
+import re
+import sys
+import json
+import time
+import timeit
+
+import parsing
+
+# Количество повторов каждого замера
+REPEAT = 5
+
+# Шаблон имени файла, используемый ботом
+TEMPLATE = '{shortcode}.{urlname}'
+
+def get_timestamp(item):
+    for key in ['taken_at_timestamp', 'created_time', 'taken_at', 'date',
+                'published_time']:
+        found = item.get(key, 0)
+        try:
+            found = int(found)
+            if found > 1:
+                return found
+        except ValueError:
+            pass
+    return 0
+
+def legacy_find_tags(caption_text):
+    return list(set(re.findall(parsing.TAGS_PATTERN, caption_text,
+                               re.UNICODE)))
+
+def legacy_deep_get(dict, path):
+    def _split_indexes(key):
+        split_array_index = re.compile(r'[.\[\]]+')
+        return filter(None, split_array_index.split(key))
+
+    ends_with_index = re.compile(r'\[(.*?)\]$')
+
+    keylist = path.split('.')
+
+    val = dict
+
+    for key in keylist:
+        try:
+            if ends_with_index.search(key):
+                for prop in _split_indexes(key):
+                    if prop.isdigit():
+                        val = val[int(prop)]
+                    else:
+                        val = val[prop]
+            else:
+                val = val[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return val
+
+def legacy_template_filename(item, url):
+    filename = os.path.splitext(os.path.split(url.split('?')[0])[1])[0]
+    template_values = {
+        'username': item['username'],
+        'urlname': filename,
+        'shortcode': str(item['shortcode']),
+        'mediatype': item['__typename'][5:],
+        'datetime': time.strftime('%Y%m%d %Hh%Mm%Ss',
+                                  time.localtime(get_timestamp(item))),
+        'date': time.strftime('%Y%m%d', time.localtime(get_timestamp(item))),
+        'year': time.strftime('%Y', time.localtime(get_timestamp(item))),
+        'month': time.strftime('%m', time.localtime(get_timestamp(item))),
+        'day': time.strftime('%d', time.localtime(get_timestamp(item))),
+        'h': time.strftime('%Hh', time.localtime(get_timestamp(item))),
+        'm': time.strftime('%Mm', time.localtime(get_timestamp(item))),
+        's': time.strftime('%Ss', time.localtime(get_timestamp(item)))}
+    return TEMPLATE.format(**template_values)
+
+def template_filename(item, url):
+    filename = os.path.splitext(os.path.split(url.split('?')[0])[1])[0]
+    template = parsing.compile_template(TEMPLATE)
+    timestamp = get_timestamp(item) if template.uses_time else 0
+    return template.format(item, filename, timestamp)
+
+def synthetic_page(size=50) -> dict:
+    caption = ('Новый пост #travel #summer #море #🔥 '
+               'с длинным описанием ' * 10)
+    edges = []
+    for i in range(size):
+        edges.append({'node': {
+            '__typename': 'GraphImage',
+            'shortcode': f'B{i:010d}',
+            'display_url': f'https://scontent.cdninstagram.com/v/{i}_n.jpg'
+                           '?_nc_ht=scontent.cdninstagram.com',
+            'is_video': False,
+            'taken_at_timestamp': 1600000000 + i,
+            'edge_media_to_caption': {'edges': [{'node': {'text': caption}}]},
+        }})
+    return {'data': {'user': {'edge_owner_to_timeline_media': {
+        'edges': edges, 'page_info': {'end_cursor': None}}}}}
+
+def load_nodes(paths: list) -> list:
+    pages = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            pages.append(json.load(f))
+    if not pages:
+        pages.append(synthetic_page())
+
+    nodes = []
+    for page in pages:
+        container = page['data']['user']['edge_owner_to_timeline_media']
+        for edge in container['edges']:
+            node = edge['node']
+            node.setdefault('username', 'benchmark')
+            nodes.append(node)
+    return nodes
+
+def per_item_us(fn, nodes: list) -> float:
+    number = max(1, 2000 // len(nodes))
+    best = min(timeit.repeat(lambda: [fn(node) for node in nodes],
+                             number=number, repeat=REPEAT))
+    return best / number / len(nodes) * 1e6
+
+def main():
+    nodes = load_nodes(sys.argv[1:])
+
+    def caption(node):
+        edges = node.get('edge_media_to_caption', {}).get('edges')
+        return edges[0]['node']['text'] if edges else ''
+
+    def url(node):
+        return node.get('video_url') or node.get('display_url', '')
+
+    path = 'edge_media_to_caption.edges[0].node.text'
+    cases = [
+        ('extract_tags', lambda node: legacy_find_tags(caption(node)),
+                         lambda node: parsing.find_tags(caption(node))),
+        ('deep_get', lambda node: legacy_deep_get(node, path),
+                     lambda node: parsing.deep_get(node, path)),
+        ('templatefilename',
+            lambda node: legacy_template_filename(node, url(node)),
+            lambda node: template_filename(node, url(node))),
+    ]
+
+    print(f'Медиазаписей: {len(nodes)}; время на запись, мкс')
+    print(f'{"функция":<18}{"было":>10}{"стало":>10}{"ускорение":>12}')
+    for name, legacy, current in cases:
+        before = per_item_us(legacy, nodes)
+        after = per_item_us(current, nodes)
+        print(f'{name:<18}{before:>10.2f}{after:>10.2f}'
+              f'{before / after:>11.1f}x')
+
+if __name__ == '__main__':
+    main()
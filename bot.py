@@ -15,24 +15,76 @@
 import os
 import sys
 import glob
+import signal
 import logging
 import time
-import json
+import threading
 
-import telebot
 from telebot.types import InputMediaPhoto, InputMediaVideo
 
-from config_loader import (BOT_TOKEN, TEMP_FOLDER, INSTAGRAM_USER_NAMES,
+from config_loader import (BOT_TOKENS, TEMP_FOLDER, INSTAGRAM_USER_NAMES,
                            TELEGRAM_CHAT_IDS, INCLUDE_LINK, REQUEST_TIMEOUT,
                            SEND_MESSAGE_DELAY, MAX_CAPTION_LENGTH,
-                           CAPTION_TAIL, SCRAPE_PERIOD)
+                           CAPTION_TAIL, SCRAPE_PERIOD, DUPLICATE_DISTANCE,
+                           HASH_INDEX_PATH, HASH_INDEX_SIZE,
+                           PERSISTENT_SESSION, USE_PROXY, BOT_API_URL,
+                           BOT_API_TEMP_FOLDER, MAX_UPLOAD_SIZE,
+                           MAX_LOCAL_UPLOAD_SIZE, PHOTO_CACHE_FOLDER,
+                           PHOTO_CACHE_TTL)
+from media_tools import (dhash, HashIndex, fit_photo, transcode_video,
+                         MAX_PHOTO_SIZE)
+from constants import LINK_SUFFIX
+from bot_pool import BotPool
+import telegram_transport
+import fastjson
 import scraper
+import workers
+import proxy_finder
 
-bot = telebot.TeleBot(BOT_TOKEN)
+telegram_transport.install(api_url=BOT_API_URL)
+bots = BotPool(BOT_TOKENS, SEND_MESSAGE_DELAY)
+bots.assign([chat_id for chat_ids in TELEGRAM_CHAT_IDS.values()
+             for chat_id in chat_ids])
+
+# Событие запроса на завершение работы программы
+shutdown_event = threading.Event()
 
 def get_media_link(shortcode: str):
     return f'https://www.instagram.com/p/{shortcode}/'
 
+def get_upload_source(file):
+    """Возвращает объект для отправки файла в Telegram: сам файл или, при
+    работе с локальным сервером Bot API, ссылку file:// на него. Локальный
+    сервер читает файл с диска, поэтому передача данных не требуется.
+    """
+    if not BOT_API_URL:
+        return file
+
+    relative_path = os.path.relpath(os.path.abspath(file.name),
+                                    os.path.abspath(TEMP_FOLDER))
+    return 'file://' + '/'.join([BOT_API_TEMP_FOLDER.rstrip('/')]
+                                + relative_path.split(os.sep))
+
+def exceeds_upload_limit(file_path: str) -> bool:
+    """Проверяет размер файла по ограничению Telegram: для фото оно своё и не
+    зависит от использования локального сервера Bot API.
+    """
+    if get_media_type(file_path) == 'photo':
+        limit = MAX_PHOTO_SIZE
+    else:
+        limit = MAX_LOCAL_UPLOAD_SIZE if BOT_API_URL else MAX_UPLOAD_SIZE
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        return False
+
+    if size > limit:
+        logging.error(f'Размер файла {file_path} ({size // 1024 // 1024} МБ) '
+                      + 'превышает ограничение Telegram.')
+        return True
+
+    return False
+
 def get_user_dir(username: str):
     return os.path.join(TEMP_FOLDER, username)
 
@@ -40,7 +92,7 @@ def get_media_file_list(path: str) -> list:
     file_list = []
 
     if os.path.exists(path):
-        for wildcard in ['*?.*.jpg', '*?.*.mp4']:
+        for wildcard in ['*?.*.jpg', '*?.*.mp4', '*?.*' + LINK_SUFFIX]:
             file_list.extend(glob.glob(os.path.join(path, wildcard)))
 
         file_list.sort(key=os.path.getmtime, reverse=True)
@@ -79,18 +131,28 @@ def cleanup(complete=False):
                 file_path = os.path.join(user_dir, filename)
                 if file_path != file_to_skip:
                     os.remove(file_path)
+
+        if os.path.exists(PHOTO_CACHE_FOLDER):
+            expired = time.time() - PHOTO_CACHE_TTL
+            for filename in os.listdir(PHOTO_CACHE_FOLDER):
+                file_path = os.path.join(PHOTO_CACHE_FOLDER, filename)
+                if complete or os.path.getmtime(file_path) < expired:
+                    os.remove(file_path)
     except OSError:
         logging.warning('Ошибка при удалении временных файлов.')
 
 def get_media_type(file_path: str) -> str:
-    """Возвращемое значение: 'photo' или 'video'.
+    """Возвращемое значение: 'photo', 'video' или 'link' (видео, вместо
+    которого публикуется ссылка на запись Instagram).
     """
     if os.path.splitext(file_path)[1] == '.jpg':
         return 'photo'
+    elif os.path.splitext(file_path)[1] == LINK_SUFFIX:
+        return 'link'
     else:
         return 'video'
 
-def scrape_medias(test=False) -> list:
+def scrape_medias(test=False, persistent=False) -> list:
     """Структура данных для хранения медиа представляет собой список словарей:
     [
         {
@@ -114,7 +176,7 @@ def scrape_medias(test=False) -> list:
     if test:
         scraper.execute(maximum=1, latest=False)
     else:
-        scraper.execute()
+        scraper.execute(persistent=persistent)
 
     medias = []
 
@@ -145,8 +207,8 @@ def scrape_medias(test=False) -> list:
 
         try:
             with open(os.path.join(get_user_dir(username), f'{username}.json'),
-                      encoding='utf-8') as f:
-                media_metadata = json.load(f)
+                      'rb') as f:
+                media_metadata = fastjson.load(f)
         except Exception as e:
             logging.error('Не удалось загрузить файл метаданных. ' + str(e))
         else:
@@ -168,62 +230,215 @@ def scrape_medias(test=False) -> list:
 
     return medias
 
-def send_media_group(media: list, instagram_username: str):
+def filter_duplicates(medias: list, hash_index: HashIndex) -> list:
+    """Исключает из медиазаписей фото, являющиеся почти-дубликатами недавно
+    пересланных или других фото этого же цикла. Медиазаписи, у которых не
+    осталось файлов, исключаются целиком. Хэши оставшихся фото сохраняются в
+    media['hashes'] и добавляются в индекс только после успешной отправки.
+    """
+    photos = [file_path for media in medias for file_path in media['files']
+              if get_media_type(file_path) == 'photo']
+    if not photos:
+        return medias
+
+    hashes = dict(zip(photos, workers.map(dhash, photos)))
+
+    # Хэши фото текущего цикла, ещё не отправленных в Telegram
+    pending = HashIndex(None, len(photos))
+    filtered_medias = []
+
+    for media in medias:
+        files = []
+        media['hashes'] = []
+        for file_path in media['files']:
+            value = hashes.get(file_path)
+            if value is not None:
+                if (hash_index.find(value, DUPLICATE_DISTANCE)
+                        or pending.find(value, DUPLICATE_DISTANCE)):
+                    logging.info('Пропущен почти-дубликат фото: '
+                                 + os.path.basename(file_path))
+                    continue
+                pending.add(value)
+                media['hashes'].append(value)
+            files.append(file_path)
+
+        if files:
+            media['files'] = files
+            filtered_medias.append(media)
+
+    return filtered_medias
+
+def prepare_photos(medias: list) -> list:
+    """Приводит фото медиазаписей к ограничениям Telegram (разрешение и
+    размер файла). Обработка выполняется в пуле процессов.
+    """
+    photos = [file_path for media in medias for file_path in media['files']
+              if get_media_type(file_path) == 'photo']
+    if not photos:
+        return medias
+
+    prepared = dict(zip(photos, workers.map(fit_photo, photos,
+                                            [PHOTO_CACHE_FOLDER] * len(photos))))
+    for media in medias:
+        media['files'] = [prepared.get(file_path, file_path)
+                          for file_path in media['files']]
+
+    return medias
+
+def replace_with_link(file_path: str) -> str:
+    """Заменяет видеофайл файлом-меткой публикации ссылки."""
+    link_path = file_path + LINK_SUFFIX
+    file_time = os.path.getmtime(file_path)
+    with open(link_path, 'w'):
+        pass
+    os.utime(link_path, (file_time, file_time))
+    os.remove(file_path)
+    return link_path
+
+def route_videos(medias: list) -> list:
+    """Выбирает способ отправки видео, превышающих ограничение Telegram на
+    размер файла. При работе с локальным сервером Bot API такие видео
+    отправляются как документы, иначе сжимаются в пуле процессов. Если сжать
+    видео не удалось, вместо него публикуется ссылка на запись Instagram.
+    """
+    if BOT_API_URL:
+        return medias
+
+    videos = []
+    for media in medias:
+        for file_path in media['files']:
+            if (get_media_type(file_path) == 'video'
+                    and os.path.getsize(file_path) > MAX_UPLOAD_SIZE):
+                videos.append(file_path)
+    if not videos:
+        return medias
+
+    logging.info('Сжатие видео, превышающих ограничение Telegram: '
+                 + f'{len(videos)}.')
+    results = dict(zip(videos, workers.map(transcode_video, videos,
+                                           [MAX_UPLOAD_SIZE] * len(videos))))
+    for media in medias:
+        files = []
+        for file_path in media['files']:
+            if results.get(file_path, True):
+                files.append(file_path)
+            else:
+                logging.warning('Видео будет заменено ссылкой: '
+                                + os.path.basename(file_path))
+                try:
+                    files.append(replace_with_link(file_path))
+                except OSError as e:
+                    logging.error('Не удалось заменить видео ссылкой. '
+                                  + str(e))
+        media['files'] = files
+
+    return medias
+
+def send_text(text: str, instagram_username: str) -> bool:
+    sent = False
     for chat_id in TELEGRAM_CHAT_IDS[instagram_username]:
+        def request(bot):
+            bot.send_message(chat_id, text, timeout=REQUEST_TIMEOUT)
+
         try:
-            # Необходимо делать сброс позиции чтения файлов на каждой итерации
+            bots.send(chat_id, request, shutdown_event.is_set)
+        except Exception as e:
+            logging.error(
+                'Не удалось переслать сообщение в Telegram. ' + str(e))
+        else:
+            sent = True
+            logging.info('Отправлено в Telegram: ссылка.')
+
+    return sent
+
+def send_media_group(media: list, instagram_username: str) -> bool:
+    sent = False
+    for chat_id in TELEGRAM_CHAT_IDS[instagram_username]:
+        def request(bot):
+            # Необходимо делать сброс позиции чтения файлов перед каждой
+            # отправкой
             for media_item in media:
-                media_item.media.seek(0)
+                if hasattr(media_item.media, 'seek'):
+                    media_item.media.seek(0)
             bot.send_media_group(chat_id, media, timeout=REQUEST_TIMEOUT)
+
+        try:
+            bots.send(chat_id, request, shutdown_event.is_set)
         except Exception as e:
             logging.error('Не удалось переслать альбом в Telegram. ' + str(e))
         else:
+            sent = True
             logging.info('Отправлено в Telegram: альбом.')
-            time.sleep(SEND_MESSAGE_DELAY)
 
-def send_photo(photo, caption: str, instagram_username: str):
+    return sent
+
+def send_photo(photo, caption: str, instagram_username: str) -> bool:
     if isinstance(photo, str):
         try:
             photo = open(photo, 'rb')
         except Exception as e:
             logging.error('Не удалось открыть файл с фото. ' + str(e))
-            return
+            return False
 
+    if exceeds_upload_limit(photo.name):
+        return False
+
+    sent = False
     for chat_id in TELEGRAM_CHAT_IDS[instagram_username]:
-        try:
+        def request(bot):
             # Сброс позиции чтения файла с фото
             photo.seek(0)
-            bot.send_photo(chat_id, photo, caption=caption,
+            bot.send_photo(chat_id, get_upload_source(photo), caption=caption,
                            timeout=REQUEST_TIMEOUT)
+
+        try:
+            bots.send(chat_id, request, shutdown_event.is_set)
         except Exception as e:
             logging.error(
                 'Не удалось переслать фото в Telegram. ' + str(e))
         else:
+            sent = True
             logging.info('Отправлено в Telegram: фото.')
-            time.sleep(SEND_MESSAGE_DELAY)
 
-def send_video(video, caption: str, instagram_username: str):
+    return sent
+
+def send_video(video, caption: str, instagram_username: str) -> bool:
     if isinstance(video, str):
         try:
             video = open(video, 'rb')
         except Exception as e:
             logging.error('Не удалось открыть файл с видео. ' + str(e))
-            return
+            return False
 
+    if exceeds_upload_limit(video.name):
+        return False
+
+    sent = False
     for chat_id in TELEGRAM_CHAT_IDS[instagram_username]:
-        try:
+        def request(bot):
             # Сброс позиции чтения файла с видео
             video.seek(0)
-            bot.send_video(chat_id, video, caption=caption,
-                           timeout=REQUEST_TIMEOUT)
+            # Большие видео отправляются локальным сервером Bot API как
+            # документы
+            if os.path.getsize(video.name) > MAX_UPLOAD_SIZE:
+                bot.send_document(chat_id, get_upload_source(video),
+                                  caption=caption, timeout=REQUEST_TIMEOUT)
+            else:
+                bot.send_video(chat_id, get_upload_source(video),
+                               caption=caption, timeout=REQUEST_TIMEOUT)
+
+        try:
+            bots.send(chat_id, request, shutdown_event.is_set)
         except Exception as e:
             logging.error(
                 'Не удалось переслать видео в Telegram. ' + str(e))
         else:
+            sent = True
             logging.info('Отправлено в Telegram: видео.')
-            time.sleep(SEND_MESSAGE_DELAY)
 
-def aggregate_to_telegram():
+    return sent
+
+def aggregate_to_telegram(persistent=False):
     logging.info('Инициирован процесс скрейпинга Instagram.')
 
     if '--test' in sys.argv:
@@ -231,15 +446,29 @@ def aggregate_to_telegram():
     else:
         test = False
 
-    medias = scrape_medias(test=test)
+    medias = scrape_medias(test=test, persistent=persistent)
+    hash_index = None
+    if DUPLICATE_DISTANCE >= 0:
+        hash_index = HashIndex(HASH_INDEX_PATH, HASH_INDEX_SIZE)
+        medias = filter_duplicates(medias, hash_index)
+    medias = route_videos(prepare_photos(medias))
     for media in medias:
+        if shutdown_event.is_set():
+            logging.info('Пересылка в Telegram прервана.')
+            break
+
         caption = media['caption']
 
         if len(caption) > MAX_CAPTION_LENGTH:
             new_len = MAX_CAPTION_LENGTH - len(CAPTION_TAIL)
             caption = caption[:new_len] + CAPTION_TAIL
 
-        if INCLUDE_LINK:
+        # Видео, заменённые ссылками, не отправляются; ссылка на запись
+        # добавляется к подписи в любом случае
+        files = [file_path for file_path in media['files']
+                 if get_media_type(file_path) != 'link']
+
+        if INCLUDE_LINK or len(files) < len(media['files']):
             media_link = get_media_link(media['shortcode'])
             if caption:
                 media_link = '\n' + media_link
@@ -251,9 +480,11 @@ def aggregate_to_telegram():
             else:
                 caption = media_link
 
-        if len(media['files']) > 1:
+        if len(files) > 1:
             ok_files = []
-            for file_path in media['files']:
+            for file_path in files:
+                if exceeds_upload_limit(file_path):
+                    continue
                 try:
                     file = open(file_path, 'rb')
                 except Exception as e:
@@ -270,54 +501,87 @@ def aggregate_to_telegram():
                         actual_caption = caption
 
                     if get_media_type(file.name) == 'photo':
-                        media_item = InputMediaPhoto(file,
+                        media_item = InputMediaPhoto(get_upload_source(file),
                                                      caption=actual_caption)
                     else:
-                        media_item = InputMediaVideo(file,
+                        media_item = InputMediaVideo(get_upload_source(file),
                                                      caption=actual_caption)
                     media_items.append(media_item)
 
-                send_media_group(media_items,
-                                 instagram_username=media['username'])
+                sent = send_media_group(media_items,
+                                        instagram_username=media['username'])
             elif len(ok_files) == 1:
                 if get_media_type(ok_files[0].name) == 'photo':
-                    send_photo(ok_files[0], caption=caption,
-                               instagram_username=media['username'])
+                    sent = send_photo(ok_files[0], caption=caption,
+                                      instagram_username=media['username'])
                 else:
-                    send_video(ok_files[0], caption=caption,
-                               instagram_username=media['username'])
+                    sent = send_video(ok_files[0], caption=caption,
+                                      instagram_username=media['username'])
             else:
+                sent = False
                 logging.error('Не удалось открыть ни одного медиафайла.')
 
-        elif len(media['files']) == 1:
-            if get_media_type(media['files'][0]) == 'photo':
-                send_photo(media['files'][0], caption=caption,
-                           instagram_username=media['username'])
+        elif len(files) == 1:
+            if get_media_type(files[0]) == 'photo':
+                sent = send_photo(files[0], caption=caption,
+                                  instagram_username=media['username'])
             else:
-                send_video(media['files'][0], caption=caption,
-                           instagram_username=media['username'])
+                sent = send_video(files[0], caption=caption,
+                                  instagram_username=media['username'])
+
+        elif media['files']:
+            sent = send_text(caption, instagram_username=media['username'])
 
         else:
+            sent = False
             logging.error('Нет записей о прикреплённых файлах.')
 
+        # Хэши фото попадают в индекс только после успешной отправки, иначе
+        # неотправленное фото считалось бы дубликатом в следующих циклах
+        if sent and hash_index is not None:
+            for value in media.get('hashes', []):
+                hash_index.add(value)
+
+    # Тестовый запуск не изменяет индекс пересланных фото
+    if hash_index is not None and not test:
+        hash_index.save()
+
     if not medias:
         logging.info('Обновления не найдены.')
 
+    telegram_transport.stats.log_summary()
+
     logging.info('Завершение процесса скрейпинга Instagram.')
 
 def run_infinite_loop():
     logging.info('Запуск бесконечного цикла работы. '
                  + f'Период {SCRAPE_PERIOD} с.')
+    if USE_PROXY:
+        proxy_finder.pool.start_warming()
+
     while True:
         logging.info('Переход в режим ожидания.')
-        time.sleep(SCRAPE_PERIOD)
+        if shutdown_event.wait(SCRAPE_PERIOD):
+            break
 
         try:
-            aggregate_to_telegram()
+            aggregate_to_telegram(persistent=PERSISTENT_SESSION)
         except Exception as e:
             logging.error('Ошибка в процессе скрейпинга Instagram. ' + str(e))
 
+def handle_shutdown(signum, frame):
+    """Обработчик сигнала завершения: прерывает ожидание и текущий цикл
+    скрейпинга.
+    """
+    logging.info('Получен сигнал завершения работы.')
+    shutdown_event.set()
+    bots.wake_all()
+    scraper.cancel()
+
 def main():
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
     if not os.path.exists(TEMP_FOLDER):
         try:
             os.mkdir(TEMP_FOLDER)
@@ -326,18 +590,22 @@ def main():
                           'Работа программы завершается.')
             return
 
-    if '--setup' in sys.argv:
-        logging.info('Инициирован процесс начального скрейпинга Instagram '
-                     + 'без репоста в Telegram.')
-        scraper.execute(maximum=1, latest=False)
-        logging.info('Процесс начального скрейпинга Instagram завершён.')
-        return
+    try:
+        if '--setup' in sys.argv:
+            logging.info('Инициирован процесс начального скрейпинга Instagram '
+                         + 'без репоста в Telegram.')
+            scraper.execute(maximum=1, latest=False)
+            logging.info('Процесс начального скрейпинга Instagram завершён.')
+            return
 
-    if ('--test' in sys.argv) or ('--singlerun' in sys.argv):
-        aggregate_to_telegram()
-        return
+        if ('--test' in sys.argv) or ('--singlerun' in sys.argv):
+            aggregate_to_telegram()
+            return
 
-    run_infinite_loop()
+        run_infinite_loop()
+    finally:
+        proxy_finder.pool.stop_warming()
+        workers.shutdown()
 
 if __name__ == '__main__':
     main()
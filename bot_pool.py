@@ -0,0 +1,77 @@
+"""В данном модуле реализован пул ботов Telegram для пересылки сообщений.
+Каждый чат закрепляется за одним из ботов, у каждого бота собственный
+ограничитель частоты отправки (модуль rate_control), поэтому пауза после
+отправки сообщения действует только на один бот и пропускная способность
+растёт с количеством ботов. Если закреплённый за чатом бот получил ответ 429
+(Too Many Requests), сообщение отправляется другим ботом пула, который также
+должен быть администратором канала или группы.
+"""
+import time
+import logging
+
+import telebot
+from telebot.apihelper import ApiException
+
+from rate_control import EndpointLimiter
+
+# Количество сообщений, которое бот может отправить подряд без паузы
+BOT_BURST = 1
+
+# Частота отправки сообщений ботом без заданной паузы (сообщений в секунду)
+MAX_BOT_RATE = 30
+
+class BotPool:
+    """Набор ботов Telegram с закреплением чатов за ботами."""
+    def __init__(self, tokens: list, send_delay: float):
+        self.bots = [telebot.TeleBot(token) for token in tokens]
+        rate = 1 / send_delay if send_delay > 0 else MAX_BOT_RATE
+        self.limiters = [EndpointLimiter(f'bot{i}', rate=rate,
+                                         burst=BOT_BURST, concurrency=1)
+                         for i in range(len(self.bots))]
+        self.assignment = {}
+
+    def assign(self, chat_ids: list):
+        """Распределяет чаты между ботами по очереди."""
+        for chat_id in chat_ids:
+            if chat_id not in self.assignment:
+                self.assignment[chat_id] = (len(self.assignment)
+                                            % len(self.bots))
+
+    def candidates(self, chat_id) -> list:
+        """Возвращает номера ботов для отправки в чат: сначала закреплённый
+        бот, затем остальные; боты с приостановленной отправкой - в конце.
+        """
+        self.assign([chat_id])
+        primary = self.assignment[chat_id]
+        order = [primary] + [i for i in range(len(self.bots)) if i != primary]
+        now = time.monotonic()
+        return sorted(order,
+                      key=lambda i: self.limiters[i].open_until > now)
+
+    def send(self, chat_id, request, interrupted=None):
+        """Выполняет request(bot) ботом, закреплённым за чатом chat_id, при
+        ответе 429 повторяет запрос другими ботами пула. Функция request
+        должна быть готова к повторному вызову (например, сбрасывать позицию
+        чтения отправляемых файлов).
+        """
+        error = None
+        for i in self.candidates(chat_id):
+            with self.limiters[i].slot(interrupted) as slot:
+                try:
+                    result = request(self.bots[i])
+                except ApiException as e:
+                    if getattr(e, 'error_code', None) != 429:
+                        raise
+                    slot.status = 429
+                    error = e
+                    logging.warning(f'Бот №{i + 1} превысил ограничение '
+                                    + 'частоты отправки сообщений.')
+                    continue
+                slot.status = 200
+                return result
+
+        raise error
+
+    def wake_all(self):
+        for limiter in self.limiters:
+            limiter.wake_all()
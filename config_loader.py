@@ -5,6 +5,7 @@ import os
 import sys
 import logging
 import logging.handlers
+import multiprocessing
 from configparser import ConfigParser
 
 # Папка для сохранения файлов журнала ошибок и уведомлений
@@ -43,30 +44,45 @@ MAX_CAPTION_LENGTH = 1024
 # Концовка, добавляемая к обрезанной текстовой подписи
 CAPTION_TAIL = '...'
 
-"""Настройка логгирования (журнала ошибок и уведомлений).
+# Максимальный размер файла, отправляемого ботом через api.telegram.org и
+# через локальный сервер Bot API (в байтах)
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+MAX_LOCAL_UPLOAD_SIZE = 2000 * 1024 * 1024
+
+"""Настройка логгирования (журнала ошибок и уведомлений). Выполняется только
+в основном процессе: процессы пула (модуль workers) при запуске повторно
+импортируют основной модуль программы, и второй обработчик ротации того же
+файла журнала в них недопустим.
 """
-logFormatter = logging.Formatter(fmt='[%(asctime)s] %(filename)s:%(lineno)d '
-                                     '%(levelname)s - %(message)s',
-                                 datefmt='%d.%m.%Y %H:%M:%S')
-rootLogger = logging.getLogger()
-rootLogger.setLevel(logging.INFO)
+def setup_logging():
+    logFormatter = logging.Formatter(fmt='[%(asctime)s] %(filename)s:'
+                                         '%(lineno)d %(levelname)s - '
+                                         '%(message)s',
+                                     datefmt='%d.%m.%Y %H:%M:%S')
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
 
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
+    if not os.path.exists(LOG_FOLDER):
+        try:
+            os.mkdir(LOG_FOLDER)
+        except OSError:
+            logging.warning('Не удалось создать папку для журнала ошибок.')
 
-if not os.path.exists(LOG_FOLDER):
-    try:
-        os.mkdir(LOG_FOLDER)
-    except OSError:
-        logging.warning('Не удалось создать папку для журнала ошибок.')
+    if os.path.exists(LOG_FOLDER):
+        fileHandler = logging.handlers.RotatingFileHandler(
+            LOG_PATH, mode='a', maxBytes=LOG_SIZE, backupCount=LOG_BACKUPS)
 
-if os.path.exists(LOG_FOLDER):
-    fileHandler = logging.handlers.RotatingFileHandler(
-        LOG_PATH, mode='a', maxBytes=LOG_SIZE, backupCount=LOG_BACKUPS)
+        fileHandler.setFormatter(logFormatter)
+        rootLogger.addHandler(fileHandler)
 
-    fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
+# Процесс пула получает имя (например, SpawnProcess-1) до импорта основного
+# модуля программы
+if multiprocessing.current_process().name == 'MainProcess':
+    setup_logging()
 
 """Подгрузка параметров из конфигурационного файла.
 """
@@ -80,6 +96,13 @@ if not BOT_TOKEN:
                   'API TOKEN бота. Работа программы завершается.')
     sys.exit()
 
+# API TOKEN всех ботов: основного и дополнительных, перечисленных через
+# запятую. Чаты Telegram распределяются между ботами
+BOT_TOKENS = [BOT_TOKEN]
+for token in parser.get('credentials', 'extra_tokens', fallback='').split(','):
+    if token.strip() and token.strip() not in BOT_TOKENS:
+        BOT_TOKENS.append(token.strip())
+
 # Словарь, ключи которого - названия аккаунтов пользователей Instagram для
 # мониторинга, а значения - списки идентификаторов каналов Telegram для
 # пересылки извлечённой информации
@@ -119,6 +142,34 @@ LOGIN = parser.get('credentials', 'login', fallback=None)
 # Пароль владельца аккаунта Instagram
 PASSWORD = parser.get('credentials', 'password', fallback=None)
 
+# Учётные записи Instagram для скрейпинга: основная из секции [credentials]
+# и дополнительные из секций [credentials:ИМЯ]. Для каждой учётной записи
+# используется отдельный файл HTTP Cookies
+INSTAGRAM_LOGINS = []
+
+for section_name in parser.sections():
+    name_parts = section_name.split(':')
+    if name_parts[0] == 'credentials' and len(name_parts) > 1:
+        login = parser.get(section_name, 'login', fallback=None)
+        password = parser.get(section_name, 'password', fallback=None)
+        if not login or not password:
+            logging.error(
+                'Ошибка в файле конфигурации: не указаны логин или пароль '
+                + f'для секции [{section_name}]. '
+                + 'Работа программы завершается.')
+            sys.exit()
+
+        cookiejar_name, cookiejar_ext = os.path.splitext(COOKIEJAR)
+        INSTAGRAM_LOGINS.append({
+            'login': login, 'password': password,
+            'cookiejar': f'{cookiejar_name}.{name_parts[1]}{cookiejar_ext}'})
+
+# Без основной учётной записи скрейпинг выполняется гостем, если не заданы
+# дополнительные
+if (LOGIN and PASSWORD) or not INSTAGRAM_LOGINS:
+    INSTAGRAM_LOGINS.insert(0, {'login': LOGIN, 'password': PASSWORD,
+                                'cookiejar': COOKIEJAR})
+
 # Флаг режима ручной авторизации в Instagram
 MANUAL_AUTH = parser.get('credentials', 'manual_auth', fallback='')
 if MANUAL_AUTH.strip().lower() in ['true', '1']:
@@ -155,3 +206,129 @@ if SCRAPE_PERIOD.strip().isdigit():
     SCRAPE_PERIOD = int(SCRAPE_PERIOD.strip())
 else:
     SCRAPE_PERIOD = 60 * 60
+
+# Максимальное расстояние Хэмминга (в битах) между перцептивными хэшами фото,
+# при котором фото считается почти-дубликатом недавно пересланного и не
+# отправляется в Telegram; отрицательное значение отключает проверку
+DUPLICATE_DISTANCE = parser.get('general', 'duplicate_distance', fallback='')
+if DUPLICATE_DISTANCE.strip().lstrip('-').isdigit():
+    DUPLICATE_DISTANCE = int(DUPLICATE_DISTANCE.strip())
+else:
+    DUPLICATE_DISTANCE = 5
+
+# Путь к файлу индекса перцептивных хэшей недавно пересланных фото
+HASH_INDEX_PATH = os.path.join(TEMP_FOLDER, 'photo_hashes.json')
+
+# Количество хэшей, хранимых в индексе недавно пересланных фото
+HASH_INDEX_SIZE = 1000
+
+# Папка для фото, подготовленных к отправке в Telegram, и время хранения
+# подготовленных фото (секунды)
+PHOTO_CACHE_FOLDER = os.path.join(TEMP_FOLDER, 'photo_cache')
+PHOTO_CACHE_TTL = 24 * 60 * 60
+
+# Количество процессов в пуле для задач, требовательных к ресурсам процессора;
+# значение 0 отключает пул (задачи выполняются в вызывающем потоке)
+CPU_WORKERS = parser.get('general', 'cpu_workers', fallback='')
+if CPU_WORKERS.strip().isdigit():
+    CPU_WORKERS = int(CPU_WORKERS.strip())
+else:
+    CPU_WORKERS = os.cpu_count() or 1
+
+# Действие при исчерпании попыток повтора запроса: 'ignore' - пропустить
+# медиа, 'abort' - прервать скрейпинг, 'prompt' - спросить пользователя
+# (только для интерактивного запуска)
+RETRY_POLICY = parser.get('general', 'retry_policy', fallback='')
+RETRY_POLICY = RETRY_POLICY.strip().lower()
+if RETRY_POLICY not in ['ignore', 'abort', 'prompt']:
+    RETRY_POLICY = 'ignore'
+
+# Максимальное количество повторов одного запроса к Instagram
+MAX_REQUEST_RETRIES = parser.get('general', 'max_retries', fallback='')
+if MAX_REQUEST_RETRIES.strip().isdigit():
+    MAX_REQUEST_RETRIES = int(MAX_REQUEST_RETRIES.strip())
+else:
+    MAX_REQUEST_RETRIES = 5
+
+# Ограничение времени скрейпинга одного аккаунта Instagram (секунды);
+# 0 - без ограничения
+ACCOUNT_BUDGET = parser.get('general', 'account_budget', fallback='')
+if ACCOUNT_BUDGET.strip().isdigit():
+    ACCOUNT_BUDGET = int(ACCOUNT_BUDGET.strip())
+else:
+    ACCOUNT_BUDGET = 0
+
+# Ограничение времени одного цикла скрейпинга (секунды); не загруженные к
+# этому сроку медиа откладываются до следующего цикла; 0 - без ограничения
+CYCLE_DEADLINE = parser.get('general', 'cycle_deadline', fallback='')
+if CYCLE_DEADLINE.strip().isdigit():
+    CYCLE_DEADLINE = int(CYCLE_DEADLINE.strip())
+else:
+    CYCLE_DEADLINE = SCRAPE_PERIOD
+
+# Сохранять ли авторизованную сессию Instagram между циклами скрейпинга при
+# работе в режиме бесконечного цикла (повторная авторизация выполняется только
+# при недействительности сессии)
+PERSISTENT_SESSION = parser.get('general', 'persistent_session', fallback='')
+if PERSISTENT_SESSION.strip().lower() in ['false', '0']:
+    PERSISTENT_SESSION = False
+else:
+    PERSISTENT_SESSION = True
+
+# Закрепление прокси из пула: account - за аккаунтом Instagram, host - за
+# сервером (позволяет переиспользовать соединения); по умолчанию прокси
+# выбирается для каждого запроса
+PROXY_PINNING = parser.get('general', 'proxy_pinning', fallback='')
+PROXY_PINNING = PROXY_PINNING.strip().lower()
+if PROXY_PINNING not in ['account', 'host']:
+    PROXY_PINNING = None
+
+# Адрес локального сервера Telegram Bot API (telegram-bot-api, запущенный с
+# параметром --local). Если задан, файлы не загружаются, а передаются серверу
+# ссылками file:// на временную папку
+BOT_API_URL = parser.get('general', 'bot_api_url', fallback='')
+BOT_API_URL = BOT_API_URL.strip().rstrip('/') or None
+
+# Путь к временной папке с точки зрения локального сервера Bot API (например,
+# если сервер запущен в контейнере); по умолчанию совпадает с TEMP_FOLDER
+BOT_API_TEMP_FOLDER = parser.get('general', 'bot_api_temp_folder',
+                                 fallback='')
+BOT_API_TEMP_FOLDER = (BOT_API_TEMP_FOLDER.strip()
+                       or os.path.abspath(TEMP_FOLDER))
+
+# Максимальный размер видео (в байтах), которое скачивается для сжатия до
+# ограничения Telegram; вместо видео большего размера публикуется ссылка на
+# запись Instagram. При работе с локальным сервером Bot API сжатие не
+# требуется, и ограничение совпадает с максимальным размером файла
+MAX_TRANSCODE_SIZE = parser.get('general', 'max_transcode_size', fallback='')
+if MAX_TRANSCODE_SIZE.strip().isdigit():
+    MAX_TRANSCODE_SIZE = int(MAX_TRANSCODE_SIZE.strip()) * 1024 * 1024
+else:
+    MAX_TRANSCODE_SIZE = 200 * 1024 * 1024
+
+MAX_VIDEO_DOWNLOAD_SIZE = (MAX_LOCAL_UPLOAD_SIZE if BOT_API_URL
+                           else MAX_TRANSCODE_SIZE)
+
+# Целевое разрешение скачиваемых фото и видео: выбирается наименьший вариант,
+# большая сторона которого не меньше max_long_edge пикселей (0 - наибольший
+# вариант); варианты видео с битрейтом выше max_bitrate (кбит/с) по
+# возможности не используются (0 - без ограничения)
+MAX_LONG_EDGE = parser.get('general', 'max_long_edge', fallback='')
+if MAX_LONG_EDGE.strip().isdigit():
+    MAX_LONG_EDGE = int(MAX_LONG_EDGE.strip())
+else:
+    MAX_LONG_EDGE = 1280
+
+MAX_BITRATE = parser.get('general', 'max_bitrate', fallback='')
+if MAX_BITRATE.strip().isdigit():
+    MAX_BITRATE = int(MAX_BITRATE.strip()) * 1000
+else:
+    MAX_BITRATE = 0
+
+# Количество страниц результатов Instagram, запрашиваемых заранее, пока
+# обрабатывается текущая страница (0 - без упреждающей загрузки)
+PAGINATION_PREFETCH = parser.get('general', 'pagination_prefetch', fallback='')
+if PAGINATION_PREFETCH.strip().isdigit():
+    PAGINATION_PREFETCH = int(PAGINATION_PREFETCH.strip())
+else:
+    PAGINATION_PREFETCH = 1
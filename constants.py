@@ -1,6 +1,7 @@
 BASE_URL = 'https://www.instagram.com/'
 LOGIN_URL = BASE_URL + 'accounts/login/ajax/'
 LOGOUT_URL = BASE_URL + 'accounts/logout/'
+SESSION_CHECK_URL = BASE_URL + 'accounts/edit/?__a=1'
 CHROME_WIN_UA = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.87 Safari/537.36'
 USER_URL = BASE_URL + '{0}/?__a=1'
 USER_INFO = 'https://i.instagram.com/api/v1/users/{0}/info/'
@@ -33,9 +34,48 @@ QUERY_MEDIA = BASE_URL + 'graphql/query/?query_hash=42323d64886122307be10013ad2d
 QUERY_MEDIA_VARS = '{{"id":"{0}","first":50,"after":"{1}"}}'
 
 MAX_CONCURRENT_DOWNLOADS = 5
+# Downloads waiting for a worker; pagination pauses while the queue is full
+MAX_PENDING_DOWNLOADS = 50
+# Posts kept in memory before their metadata is spooled to disk
+METADATA_BATCH_SIZE = 200
+# Posts whose comments are collected at the same time
+MAX_CONCURRENT_COMMENTS = 3
+# Comment pages fetched per post, 0 for unlimited
+MAX_COMMENT_PAGES = 10
+# Posts whose location is looked up at the same time
+MAX_CONCURRENT_LOCATIONS = 5
+# Post and location entries kept in the location cache
+LOCATION_CACHE_SIZE = 5000
+# Highlight chunks fetched at the same time
+MAX_CONCURRENT_HIGHLIGHTS = 3
+# Extra attempts for a highlight chunk whose request failed
+HIGHLIGHT_CHUNK_RETRIES = 2
+# Highlight reels kept in the highlight cache
+HIGHLIGHT_CACHE_SIZE = 500
 CONNECT_TIMEOUT = 90
 MAX_RETRIES = 5
 RETRY_DELAY = 5
 MAX_RETRY_DELAY = 60
 
+# How many times a single request may switch to another proxy after a proxy failure
+MAX_PROXY_FAILOVERS = 3
+
+# Seconds a login rests after Instagram challenged or rate limited it
+LOGIN_COOLDOWN = 30 * 60
+
+# Suffix of the marker file saved instead of a video too large to download
+LINK_SUFFIX = '.link'
+
+# Per endpoint class limits: requests per second, burst size, max concurrent requests
+RATE_LIMITS = {
+    'graphql': {'rate': 1.0, 'burst': 5, 'concurrency': 3},
+    'profile': {'rate': 0.5, 'burst': 2, 'concurrency': 2},
+    'cdn': {'rate': 10.0, 'burst': 20, 'concurrency': MAX_CONCURRENT_DOWNLOADS},
+}
+
 LATEST_STAMPS_USER_SECTION = 'users'
+
+SHARED_DATA_MARKER = b'window._sharedData = '
+ADDITIONAL_DATA_MARKER = b'window.__additionalDataLoaded('
+PROFILE_PAGE_CHUNK_SIZE = 16 * 1024
+MAX_PROFILE_PAGE_SIZE = 8 * 1024 * 1024
@@ -0,0 +1,133 @@
+"""В данном модуле реализован пул потоков загрузки с приоритетной очередью.
+Задачи с большим приоритетом (например, с большим ожидаемым размером файла)
+запускаются первыми, а мелкие задачи занимают освободившиеся потоки. Такой
+порядок (longest job first) сокращает общее время загрузки при том же числе
+потоков: крупный файл, найденный последним, не задерживает окончание цикла.
+
+Пул совместим с concurrent.futures.Executor, возвращаемые объекты Future
+можно использовать с concurrent.futures.as_completed.
+
+Очередь пула может быть ограничена: при заполненной очереди постановка новой
+задачи блокируется до освобождения места. Так источник задач (например,
+постраничный обход публикаций) приостанавливается, если загрузки не
+успевают за ним, и объём памяти под ожидающие задачи остаётся постоянным.
+"""
+import heapq
+import itertools
+import threading
+from concurrent.futures import CancelledError, Executor, Future
+
+class PriorityThreadPool(Executor):
+    """Пул потоков, выполняющий задачи в порядке убывания приоритета; задачи
+    с одинаковым приоритетом выполняются в порядке постановки в очередь.
+    """
+    def __init__(self, max_workers: int, max_pending: int = 0):
+        """max_pending - наибольшее число задач в очереди (0 - без
+        ограничения).
+        """
+        self.max_pending = max_pending
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.is_shutdown = False
+        self.threads = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit_priority(self, priority: float, fn, *args, **kwargs) -> Future:
+        """Ставит задачу fn(*args, **kwargs) в очередь с приоритетом
+        priority. Если очередь заполнена, ожидает освобождения места.
+        """
+        future = Future()
+        with self.lock:
+            while (self.max_pending and len(self.queue) >= self.max_pending
+                   and not self.is_shutdown):
+                self.not_full.wait()
+            if self.is_shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            heapq.heappush(self.queue, (-priority, next(self.counter),
+                                        future, fn, args, kwargs))
+            self.not_empty.notify()
+        return future
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.submit_priority(0, fn, *args, **kwargs)
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.is_shutdown:
+                    self.not_empty.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn, args, kwargs = heapq.heappop(self.queue)
+                self.not_full.notify()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self.lock:
+            self.is_shutdown = True
+            if cancel_futures:
+                for item in self.queue:
+                    item[2].cancel()
+                self.queue = []
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+class Stage:
+    """Этап обработки с собственным ограниченным пулом потоков. Задачи
+    ставятся в очередь без ожидания результата; перед использованием
+    результатов вызывается wait(), дожидающийся завершения всех
+    поставленных задач.
+    """
+    def __init__(self, max_workers: int, max_pending: int = 0):
+        self.pool = PriorityThreadPool(max_workers, max_pending)
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.errors = []
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = self.pool.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self.lock:
+            self.futures.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self.errors.append(future.exception())
+
+    def wait(self) -> list:
+        """Дожидается завершения поставленных задач. Возвращает исключения,
+        возникшие в задачах с момента предыдущего вызова.
+        """
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            try:
+                future.exception()
+            except CancelledError:
+                pass
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait, cancel_futures=not wait)
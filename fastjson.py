@@ -0,0 +1,44 @@
+"""Единый интерфейс сериализации JSON. При наличии установленной библиотеки
+orjson используется она (разбор и запись в несколько раз быстрее), иначе -
+стандартный модуль json.
+
+Функции loads и load принимают байты без предварительного декодирования,
+функции dumps и dump возвращают и записывают байты в кодировке UTF-8.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+    """Разбирает JSON-документ из bytes или str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj, pretty: bool = False) -> bytes:
+    """Сериализует объект в компактный JSON (или с отступами и сортировкой
+    ключей при pretty=True).
+    """
+    if orjson is not None:
+        if pretty:
+            return orjson.dumps(obj,
+                                option=orjson.OPT_INDENT_2
+                                | orjson.OPT_SORT_KEYS)
+        return orjson.dumps(obj)
+
+    if pretty:
+        text = json.dumps(obj, indent=4, sort_keys=True, ensure_ascii=False)
+    else:
+        text = json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+    return text.encode('utf-8')
+
+def load(f):
+    """Читает JSON-документ из файла, открытого в двоичном режиме."""
+    return loads(f.read())
+
+def dump(obj, f, pretty: bool = False):
+    """Записывает объект в файл, открытый в двоичном режиме."""
+    f.write(dumps(obj, pretty=pretty))
@@ -0,0 +1,206 @@
+"""В данном модуле собраны функции обработки медиафайлов, требовательные к
+ресурсам процессора: вычисление перцептивных хэшей изображений, индекс
+недавно пересланных фото для поиска почти-дубликатов, подготовка фото к
+отправке в Telegram, сведение дорожек видео.
+Функции задач предназначены для выполнения в пуле процессов (модуль workers).
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+import moviepy.editor as mpe
+
+# Размер стороны уменьшенного изображения для вычисления разностного хэша
+HASH_SIZE = 8
+
+# Максимальная длина большей стороны фото: Telegram уменьшает фото до этого
+# размера, поэтому отправлять фото большего разрешения бессмысленно
+MAX_PHOTO_SIDE = 2560
+
+# Максимальный размер файла фото, принимаемый Telegram (в байтах)
+MAX_PHOTO_SIZE = 10 * 1024 * 1024
+
+# Начальное и минимальное качество JPEG при повторном сжатии фото
+PHOTO_QUALITY = 87
+MIN_PHOTO_QUALITY = 50
+
+# Максимальная высота кадра и битрейт звука сжатого видео
+TRANSCODE_MAX_HEIGHT = 720
+TRANSCODE_AUDIO_BITRATE = 128 * 1000
+
+# Минимальный битрейт видеодорожки, при котором сжатие имеет смысл
+MIN_VIDEO_BITRATE = 300 * 1000
+
+# Доля целевого размера файла, отводимая под дорожки (остаток - запас на
+# контейнер и погрешность кодировщика)
+TRANSCODE_SIZE_MARGIN = 0.9
+
+def dhash(file_path: str) -> Optional[int]:
+    """Вычисляет 64-битный разностный перцептивный хэш (dHash) изображения.
+    Возвращает None, если файл не удалось прочитать как изображение.
+    """
+    try:
+        with Image.open(file_path) as image:
+            # Для JPEG декодирование сразу в уменьшенном масштабе многократно
+            # быстрее полного декодирования
+            image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+            image = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                              Image.LANCZOS)
+            pixels = np.asarray(image, dtype=np.int16)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Не удалось вычислить хэш изображения {file_path}. '
+                        + str(e))
+        return None
+
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+class HashIndex:
+    """Ограниченный по размеру индекс перцептивных хэшей недавно пересланных
+    изображений с поиском по расстоянию Хэмминга. Хранится в JSON-файле;
+    индекс без пути (path=None) существует только в памяти.
+    """
+    def __init__(self, path: Optional[str], capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.hashes = np.zeros(0, dtype=np.uint64)
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.hashes = np.array(json.load(f)[-capacity:],
+                                           dtype=np.uint64)
+            except (OSError, ValueError, TypeError) as e:
+                logging.warning('Не удалось загрузить индекс хэшей '
+                                + 'изображений. ' + str(e))
+
+    def find(self, value: int, max_distance: int) -> bool:
+        """Возвращает True, если в индексе есть хэш, отличающийся от value
+        не более чем на max_distance бит.
+        """
+        if not len(self.hashes):
+            return False
+
+        xor = np.bitwise_xor(self.hashes, np.uint64(value))
+        distances = np.unpackbits(xor.view(np.uint8)).reshape(-1, 64).sum(1)
+        return bool((distances <= max_distance).any())
+
+    def add(self, value: int):
+        self.hashes = np.append(self.hashes, np.uint64(value))
+        self.hashes = self.hashes[-self.capacity:]
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump([int(value) for value in self.hashes], f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('Не удалось сохранить индекс хэшей изображений. '
+                            + str(e))
+
+def fit_photo(file_path: str, cache_dir: str) -> str:
+    """Приводит фото к ограничениям Telegram: уменьшает разрешение до
+    MAX_PHOTO_SIDE и сжимает до MAX_PHOTO_SIZE. Возвращает путь к исходному
+    файлу, если обработка не требуется, или к обработанной копии в cache_dir.
+    Копии именуются по хэшу содержимого исходного файла и используются
+    повторно.
+    """
+    try:
+        with Image.open(file_path) as image:
+            if (max(image.size) <= MAX_PHOTO_SIDE
+                    and os.path.getsize(file_path) <= MAX_PHOTO_SIZE):
+                return file_path
+
+            # Хэш вычисляется только для фото, которые требуют обработки
+            cached_path = os.path.join(cache_dir, file_digest(file_path) + '.jpg')
+            if os.path.exists(cached_path):
+                return cached_path
+
+            image.draft('RGB', (MAX_PHOTO_SIDE, MAX_PHOTO_SIDE))
+            image = image.convert('RGB')
+            image.thumbnail((MAX_PHOTO_SIDE, MAX_PHOTO_SIDE), Image.LANCZOS)
+
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cached_path + '.tmp'
+            quality = PHOTO_QUALITY
+            while True:
+                image.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+                if (os.path.getsize(tmp_path) <= MAX_PHOTO_SIZE
+                        or quality <= MIN_PHOTO_QUALITY):
+                    break
+                quality -= 10
+            os.replace(tmp_path, cached_path)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning(f'Не удалось обработать фото {file_path}. ' + str(e))
+        return file_path
+
+    return cached_path
+
+def file_digest(file_path: str) -> str:
+    """Возвращает SHA-1 содержимого файла, читая его по частям."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def transcode_video(file_path: str, max_size: int) -> bool:
+    """Сжимает видео так, чтобы размер файла не превышал max_size байт.
+    Исходный файл заменяется сжатым. Возвращает False, если при допустимом
+    качестве уложиться в ограничение не удалось.
+    """
+    tmp_path = file_path + '.part'
+    try:
+        clip = mpe.VideoFileClip(file_path)
+        try:
+            bitrate = int(max_size * 8 * TRANSCODE_SIZE_MARGIN / clip.duration
+                          - TRANSCODE_AUDIO_BITRATE)
+            if bitrate < MIN_VIDEO_BITRATE:
+                return False
+
+            clip.write_videofile(
+                tmp_path, codec='libx264', audio_codec='aac',
+                bitrate=str(bitrate),
+                audio_bitrate=str(TRANSCODE_AUDIO_BITRATE),
+                ffmpeg_params=['-vf',
+                               f'scale=-2:min({TRANSCODE_MAX_HEIGHT}\\,ih)',
+                               '-f', 'mp4'],
+                logger=None)
+        finally:
+            clip.close()
+
+        if os.path.getsize(tmp_path) > max_size:
+            os.remove(tmp_path)
+            return False
+
+        file_time = os.path.getmtime(file_path)
+        os.replace(tmp_path, file_path)
+        os.utime(file_path, (file_time, file_time))
+    except Exception as e:
+        logging.warning(f'Не удалось сжать видео {file_path}. ' + str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    return True
+
+def mux_broadcast(video_path: str, audio_path: str):
+    """Объединяет видео- и аудиодорожки трансляции в файл video_path.
+    Файл аудиодорожки после этого удаляется.
+    """
+    broadcast = mpe.VideoFileClip(video_path)
+    audio_background = mpe.AudioFileClip(audio_path)
+    broadcast = broadcast.set_audio(audio_background)
+    broadcast.write_videofile(broadcast.filename, logger=None)
+    broadcast.close()
+    audio_background.close()
+
+    os.remove(audio_background.filename)
@@ -0,0 +1,283 @@
+"""В данном модуле собраны функции разбора данных Instagram, не зависящие от
+состояния скрейпера.
+"""
+import re
+import string
+import time
+from functools import lru_cache
+
+# Регулярное выражение для поиска хэштегов в тексте подписи (включая эмодзи)
+TAGS_PATTERN = r"(?<!&)#(\w+|(?:[\xA9\xAE\u203C\u2049\u2122\u2139\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u2388\u23CF\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB-\u25FE\u2600-\u2604\u260E\u2611\u2614\u2615\u2618\u261D\u2620\u2622\u2623\u2626\u262A\u262E\u262F\u2638-\u263A\u2648-\u2653\u2660\u2663\u2665\u2666\u2668\u267B\u267F\u2692-\u2694\u2696\u2697\u2699\u269B\u269C\u26A0\u26A1\u26AA\u26AB\u26B0\u26B1\u26BD\u26BE\u26C4\u26C5\u26C8\u26CE\u26CF\u26D1\u26D3\u26D4\u26E9\u26EA\u26F0-\u26F5\u26F7-\u26FA\u26FD\u2702\u2705\u2708-\u270D\u270F\u2712\u2714\u2716\u271D\u2721\u2728\u2733\u2734\u2744\u2747\u274C\u274E\u2753-\u2755\u2757\u2763\u2764\u2795-\u2797\u27A1\u27B0\u27BF\u2934\u2935\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55\u3030\u303D\u3297\u3299]|\uD83C[\uDC04\uDCCF\uDD70\uDD71\uDD7E\uDD7F\uDD8E\uDD91-\uDD9A\uDE01\uDE02\uDE1A\uDE2F\uDE32-\uDE3A\uDE50\uDE51\uDF00-\uDF21\uDF24-\uDF93\uDF96\uDF97\uDF99-\uDF9B\uDF9E-\uDFF0\uDFF3-\uDFF5\uDFF7-\uDFFF]|\uD83D[\uDC00-\uDCFD\uDCFF-\uDD3D\uDD49-\uDD4E\uDD50-\uDD67\uDD6F\uDD70\uDD73-\uDD79\uDD87\uDD8A-\uDD8D\uDD90\uDD95\uDD96\uDDA5\uDDA8\uDDB1\uDDB2\uDDBC\uDDC2-\uDDC4\uDDD1-\uDDD3\uDDDC-\uDDDE\uDDE1\uDDE3\uDDEF\uDDF3\uDDFA-\uDE4F\uDE80-\uDEC5\uDECB-\uDED0\uDEE0-\uDEE5\uDEE9\uDEEB\uDEEC\uDEF0\uDEF3]|\uD83E[\uDD10-\uDD18\uDD80-\uDD84\uDDC0]|(?:0\u20E3|1\u20E3|2\u20E3|3\u20E3|4\u20E3|5\u20E3|6\u20E3|7\u20E3|8\u20E3|9\u20E3|#\u20E3|\\*\u20E3|\uD83C(?:\uDDE6\uD83C(?:\uDDEB|\uDDFD|\uDDF1|\uDDF8|\uDDE9|\uDDF4|\uDDEE|\uDDF6|\uDDEC|\uDDF7|\uDDF2|\uDDFC|\uDDE8|\uDDFA|\uDDF9|\uDDFF|\uDDEA)|\uDDE7\uD83C(?:\uDDF8|\uDDED|\uDDE9|\uDDE7|\uDDFE|\uDDEA|\uDDFF|\uDDEF|\uDDF2|\uDDF9|\uDDF4|\uDDE6|\uDDFC|\uDDFB|\uDDF7|\uDDF3|\uDDEC|\uDDEB|\uDDEE|\uDDF6|\uDDF1)|\uDDE8\uD83C(?:\uDDF2|\uDDE6|\uDDFB|\uDDEB|\uDDF1|\uDDF3|\uDDFD|\uDDF5|\uDDE8|\uDDF4|\uDDEC|\uDDE9|\uDDF0|\uDDF7|\uDDEE|\uDDFA|\uDDFC|\uDDFE|\uDDFF|\uDDED)|\uDDE9\uD83C(?:\uDDFF|\uDDF0|\uDDEC|\uDDEF|\uDDF2|\uDDF4|\uDDEA)|\uDDEA\uD83C(?:\uDDE6|\uDDE8|\uDDEC|\uDDF7|\uDDEA|\uDDF9|\uDDFA|\uDDF8|\uDDED)|\uDDEB\uD83C(?:\uDDF0|\uDDF4|\uDDEF|\uDDEE|\uDDF7|\uDDF2)|\uDDEC\uD83C(?:\uDDF6|\uDDEB|\uDDE6|\uDDF2|\uDDEA|\uDDED|\uDDEE|\uDDF7|\uDDF1|\uDDE9|\uDDF5|\uDDFA|\uDDF9|\uDDEC|\uDDF3|\uDDFC|\uDDFE|\uDDF8|\uDDE7)|\uDDED\uD83C(?:\uDDF7|\uDDF9|\uDDF2|\uDDF3|\uDDF0|\uDDFA)|\uDDEE\uD83C(?:\uDDF4|\uDDE8|\uDDF8|\uDDF3|\uDDE9|\uDDF7|\uDDF6|\uDDEA|\uDDF2|\uDDF1|\uDDF9)|\uDDEF\uD83C(?:\uDDF2|\uDDF5|\uDDEA|\uDDF4)|\uDDF0\uD83C(?:\uDDED|\uDDFE|\uDDF2|\uDDFF|\uDDEA|\uDDEE|\uDDFC|\uDDEC|\uDDF5|\uDDF7|\uDDF3)|\uDDF1\uD83C(?:\uDDE6|\uDDFB|\uDDE7|\uDDF8|\uDDF7|\uDDFE|\uDDEE|\uDDF9|\uDDFA|\uDDF0|\uDDE8)|\uDDF2\uD83C(?:\uDDF4|\uDDF0|\uDDEC|\uDDFC|\uDDFE|\uDDFB|\uDDF1|\uDDF9|\uDDED|\uDDF6|\uDDF7|\uDDFA|\uDDFD|\uDDE9|\uDDE8|\uDDF3|\uDDEA|\uDDF8|\uDDE6|\uDDFF|\uDDF2|\uDDF5|\uDDEB)|\uDDF3\uD83C(?:\uDDE6|\uDDF7|\uDDF5|\uDDF1|\uDDE8|\uDDFF|\uDDEE|\uDDEA|\uDDEC|\uDDFA|\uDDEB|\uDDF4)|\uDDF4\uD83C\uDDF2|\uDDF5\uD83C(?:\uDDEB|\uDDF0|\uDDFC|\uDDF8|\uDDE6|\uDDEC|\uDDFE|\uDDEA|\uDDED|\uDDF3|\uDDF1|\uDDF9|\uDDF7|\uDDF2)|\uDDF6\uD83C\uDDE6|\uDDF7\uD83C(?:\uDDEA|\uDDF4|\uDDFA|\uDDFC|\uDDF8)|\uDDF8\uD83C(?:\uDDFB|\uDDF2|\uDDF9|\uDDE6|\uDDF3|\uDDE8|\uDDF1|\uDDEC|\uDDFD|\uDDF0|\uDDEE|\uDDE7|\uDDF4|\uDDF8|\uDDED|\uDDE9|\uDDF7|\uDDEF|\uDDFF|\uDDEA|\uDDFE)|\uDDF9\uD83C(?:\uDDE9|\uDDEB|\uDDFC|\uDDEF|\uDDFF|\uDDED|\uDDF1|\uDDEC|\uDDF0|\uDDF4|\uDDF9|\uDDE6|\uDDF3|\uDDF7|\uDDF2|\uDDE8|\uDDFB)|\uDDFA\uD83C(?:\uDDEC|\uDDE6|\uDDF8|\uDDFE|\uDDF2|\uDDFF)|\uDDFB\uD83C(?:\uDDEC|\uDDE8|\uDDEE|\uDDFA|\uDDE6|\uDDEA|\uDDF3)|\uDDFC\uD83C(?:\uDDF8|\uDDEB)|\uDDFD\uD83C\uDDF0|\uDDFE\uD83C(?:\uDDF9|\uDDEA)|\uDDFF\uD83C(?:\uDDE6|\uDDF2|\uDDFC))))[\ufe00-\ufe0f\u200d]?)+"
+
+# Скомпилированное регулярное выражение для поиска хэштегов
+TAGS_REGEX = re.compile(TAGS_PATTERN, re.UNICODE)
+
+# Регулярные выражения для разбора пути вида 'foo.bar[0].baz'
+ENDS_WITH_INDEX_REGEX = re.compile(r'\[(.*?)\]$')  # foo[0]
+SPLIT_INDEXES_REGEX = re.compile(r'[.\[\]]+')  # ['foo', '0']
+
+# Поля шаблона имени файла, зависящие от времени публикации, и их форматы
+TIME_FIELDS = {
+    'datetime': '%Y%m%d %Hh%Mm%Ss',
+    'date': '%Y%m%d',
+    'year': '%Y',
+    'month': '%m',
+    'day': '%d',
+    'h': '%Hh',
+    'm': '%Mm',
+    's': '%Ss',
+}
+
+def find_tags(caption_text: str) -> list:
+    """Возвращает список уникальных хэштегов из текста подписи."""
+    return list(set(TAGS_REGEX.findall(caption_text)))
+
+@lru_cache(maxsize=None)
+def compile_path(path: str) -> tuple:
+    """Преобразует путь вида 'entry_data.ProfilePage[0].graphql.user' в
+    кортеж ключей и индексов для функции deep_get.
+    """
+    keys = []
+
+    for key in path.split('.'):
+        if ENDS_WITH_INDEX_REGEX.search(key):
+            for prop in filter(None, SPLIT_INDEXES_REGEX.split(key)):
+                keys.append(int(prop) if prop.isdigit() else prop)
+        else:
+            keys.append(key)
+
+    return tuple(keys)
+
+def deep_get(data, path: str):
+    """Возвращает значение из вложенной структуры по пути вида
+    'foo.bar[0].baz' или None, если такого значения нет.
+    """
+    value = data
+
+    for key in compile_path(path):
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return value
+
+class FilenameTemplate:
+    """Скомпилированный шаблон имени файла. При подстановке вычисляются только
+    поля, на которые ссылается шаблон.
+    """
+    def __init__(self, template: str):
+        self.template = template
+        self.fields = {field_name for _, field_name, _, _
+                       in string.Formatter().parse(template) if field_name}
+        self.uses_time = not self.fields.isdisjoint(TIME_FIELDS)
+
+    def format(self, item: dict, urlname: str, timestamp: int = 0) -> str:
+        """Возвращает имя файла без расширения. Исключение KeyError
+        возникает, если шаблон ссылается на неизвестное или отсутствующее поле.
+        """
+        values = {}
+        local_time = time.localtime(timestamp) if self.uses_time else None
+
+        for field in self.fields:
+            if field == 'username':
+                values[field] = item['username']
+            elif field == 'urlname':
+                values[field] = urlname
+            elif field == 'shortcode':
+                values[field] = str(item['shortcode'])
+            elif field == 'mediatype':
+                values[field] = item['__typename'][5:]
+            elif field in TIME_FIELDS:
+                values[field] = time.strftime(TIME_FIELDS[field], local_time)
+
+        return self.template.format(**values)
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> FilenameTemplate:
+    return FilenameTemplate(template)
+
+# Символы, значимые при поиске границ JSON-объекта в потоке байтов
+JSON_TOKEN_REGEX = re.compile(rb'[{}"\\]')
+
+class JsonBlobScanner:
+    """Инкрементальный поиск JSON-объектов, следующих за текстовыми
+    маркерами (например, 'window._sharedData = ') в потоке байтов HTML-страницы.
+    Хранит только хвост для поиска маркера и текущий собираемый объект.
+    """
+    def __init__(self, markers: list):
+        self.markers = markers
+        self.tail = b''
+        self.marker = None
+        self.blob = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: bytes) -> list:
+        """Обрабатывает очередной фрагмент потока. Возвращает список пар
+        (маркер, байты JSON-объекта) для объектов, завершённых в этом фрагменте.
+        """
+        data = self.tail + chunk
+        self.tail = b''
+        pos = 0
+        found = []
+
+        while pos < len(data):
+            if self.blob is None:
+                pos = self._find_start(data, pos)
+                if pos < 0:
+                    break
+
+            end = self._scan(data, pos)
+            if end < 0:
+                self.blob += data[pos:]
+                break
+
+            self.blob += data[pos:end]
+            found.append((self.marker, bytes(self.blob)))
+            self.marker = None
+            self.blob = None
+            pos = end
+
+        return found
+
+    def _find_start(self, data: bytes, pos: int) -> int:
+        matches = [(data.find(marker, pos), marker) for marker in self.markers]
+        matches = [match for match in matches if match[0] >= 0]
+
+        if not matches:
+            keep = max(len(marker) for marker in self.markers) - 1
+            self.tail = data[max(pos, len(data) - keep):]
+            return -1
+
+        index, marker = min(matches)
+        start = data.find(b'{', index + len(marker))
+        if start < 0:
+            # Начало объекта ещё не получено - ждём следующий фрагмент
+            self.tail = data[index:]
+            return -1
+
+        self.marker = marker
+        self.blob = bytearray()
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        return start
+
+    def _scan(self, data: bytes, pos: int) -> int:
+        """Возвращает позицию за закрывающей скобкой объекта или -1."""
+        if self.escaped:
+            self.escaped = False
+            pos += 1
+
+        while True:
+            match = JSON_TOKEN_REGEX.search(data, pos)
+            if match is None:
+                return -1
+
+            index = match.start()
+            token = data[index]
+            pos = index + 1
+
+            if self.in_string:
+                if token == 0x5C:  # \
+                    if pos >= len(data):
+                        self.escaped = True
+                        return -1
+                    pos += 1
+                elif token == 0x22:  # "
+                    self.in_string = False
+            elif token == 0x22:
+                self.in_string = True
+            elif token == 0x7B:  # {
+                self.depth += 1
+            elif token == 0x7D:  # }
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+
+def iter_json_blobs(chunks, markers: list, limit: int):
+    """Генератор пар (маркер, байты JSON-объекта) по мере их появления в
+    потоке фрагментов chunks. Чтение прекращается, если потребитель
+    остановил генератор или получено более limit байтов.
+    """
+    scanner = JsonBlobScanner(markers)
+    received = 0
+
+    for chunk in chunks:
+        received += len(chunk)
+        if received > limit:
+            return
+
+        yield from scanner.feed(chunk)
+
+def select_rendition(renditions: list, max_edge: int = 0,
+                     max_bitrate: int = 0, width: str = 'config_width',
+                     height: str = 'config_height',
+                     bitrate: str = 'bitrate') -> dict:
+    """Выбирает вариант медиафайла (разрешение, битрейт) из списка
+    renditions. Варианты с битрейтом выше max_bitrate отбрасываются, если
+    есть другие. Из оставшихся возвращается наименьший вариант, большая
+    сторона которого не меньше max_edge, либо наибольший, если таких нет
+    или max_edge не задан. Имена полей размеров и битрейта задаются
+    параметрами width, height и bitrate.
+    """
+    def long_edge(rendition):
+        return max(int(rendition.get(width) or 0),
+                   int(rendition.get(height) or 0))
+
+    def rate(rendition):
+        return int(rendition.get(bitrate) or 0)
+
+    if not renditions:
+        return None
+
+    ordered = sorted(renditions, key=lambda r: (long_edge(r), rate(r)))
+
+    if max_bitrate:
+        ordered = ([r for r in ordered if rate(r) <= max_bitrate]
+                   or ordered[:1])
+
+    if max_edge:
+        for rendition in ordered:
+            if long_edge(rendition) >= max_edge:
+                return rendition
+
+    return ordered[-1]
+
+# Оценки для расчёта ожидаемого размера медиафайла: байт в секунду видео,
+# байт на пиксель фото JPEG, длительность видео и размер фото по умолчанию
+VIDEO_BYTES_PER_SECOND = 300 * 1024
+IMAGE_BYTES_PER_PIXEL = 0.25
+DEFAULT_VIDEO_DURATION = 30
+DEFAULT_IMAGE_SIZE = 200 * 1024
+
+# Ожидаемая длительность записи трансляции (секунды)
+BROADCAST_DURATION = 30 * 60
+
+def estimate_media_size(item: dict) -> int:
+    """Оценивает суммарный размер файлов медиазаписи в байтах по данным
+    записи (тип, длительность видео, размеры изображения), не обращаясь к
+    серверу. Используется для упорядочивания загрузок.
+    """
+    if 'video' in item and 'audio' in item and 'published_time' in item:
+        # Запись трансляции
+        return BROADCAST_DURATION * VIDEO_BYTES_PER_SECOND
+
+    children = deep_get(item, 'edge_sidecar_to_children.edges')
+    if children:
+        return sum(estimate_media_size(child['node']) for child in children)
+
+    if item.get('is_video') or item.get('video_resources'):
+        duration = item.get('video_duration') or DEFAULT_VIDEO_DURATION
+        return int(duration * VIDEO_BYTES_PER_SECOND)
+
+    width = deep_get(item, 'dimensions.width')
+    height = deep_get(item, 'dimensions.height')
+    if width and height:
+        size = int(width * height * IMAGE_BYTES_PER_PIXEL)
+    else:
+        size = DEFAULT_IMAGE_SIZE
+
+    return size * max(1, len(item.get('urls') or ()))
@@ -1,5 +1,8 @@
+import time
+import random
 import logging
-from random import choice
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from bs4 import BeautifulSoup
@@ -11,6 +14,31 @@ RANDOM_TRIES = 20
 PROXY_TYPE = 'anonymous'
 # PROXY_TYPE = 'elite proxy'
 
+# Время жизни проверенного набора прокси (секунды)
+POOL_TTL = 10 * 60
+
+# Количество одновременно проверяемых прокси
+VALIDATE_WORKERS = 10
+
+# Минимальное число работающих прокси; при меньшем числе пул обновляется
+# досрочно
+MIN_POOL_SIZE = 3
+
+# Период проверки актуальности пула фоновым потоком (секунды)
+WARM_INTERVAL = 60
+
+# Минимальный интервал между попытками обновления пула (секунды); не даёт
+# обновлять пул непрерывно, пока работающих прокси меньше MIN_POOL_SIZE
+MIN_REFRESH_INTERVAL = 60
+
+# Коэффициент сглаживания средней задержки
+LATENCY_SMOOTHING = 0.3
+
+# Прокси исключается из пула после указанного числа ошибок, если доля
+# успешных запросов через него ниже порога
+MAX_FAILURES = 3
+MIN_SUCCESS_RATE = 0.5
+
 def parse_proxies() -> list:
     proxies = []
 
@@ -33,43 +61,212 @@ def parse_proxies() -> list:
 
     return proxies
 
-def proxy_is_valid(proxy: str) -> bool:
+def check_proxy(proxy: str) -> float:
+    """Проверяет доступ через прокси. Возвращает задержку ответа в секундах
+    или None, если прокси не работает.
+    """
+    started = time.monotonic()
     try:
         res = requests.get(HTTP_BIN_HOST, proxies={'https': proxy},
                            timeout=TIMEOUT)
     except Exception as e:
-        logging.warning(f'Ошибка доступа к прокси {proxy}. ' + str(e))
-    else:
-        try:
-            ip = res.json()['origin']
-        except Exception as e:
-            logging.warning(f'Ошибка доступа через прокси {proxy}: получен'
-                            ' некорректый ответ. ' + str(e))
+        logging.debug(f'Ошибка доступа к прокси {proxy}. ' + str(e))
+        return None
+
+    try:
+        ip = res.json()['origin']
+    except Exception as e:
+        logging.debug(f'Ошибка доступа через прокси {proxy}: получен'
+                      ' некорректый ответ. ' + str(e))
+        return None
+
+    logging.debug(f'Получен доступ через прокси. IP-адрес: {ip}.')
+    return time.monotonic() - started
+
+def proxy_is_valid(proxy: str) -> bool:
+    return check_proxy(proxy) is not None
+
+class ProxyStats:
+    """Статистика работы одного прокси."""
+    def __init__(self, proxy: str, latency: float):
+        self.proxy = proxy
+        self.latency = latency
+        self.successes = 1
+        self.failures = 0
+
+    @property
+    def success_rate(self) -> float:
+        return self.successes / (self.successes + self.failures)
+
+    @property
+    def score(self) -> float:
+        """Оценка качества: доля успешных запросов на секунду задержки."""
+        return self.success_rate / max(self.latency, 0.01)
+
+    def update(self, ok: bool, latency: float = None):
+        if ok:
+            self.successes += 1
         else:
-            logging.info(f'Получен доступ через прокси. IP-адрес: {ip}.')
+            self.failures += 1
+        if latency is not None:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+class ProxyPool:
+    """Кэшируемый набор проверенных прокси с оценкой качества каждого.
+    Кандидаты проверяются параллельно, набор обновляется по истечении
+    времени жизни или при нехватке работающих прокси, но не чаще одного раза
+    в MIN_REFRESH_INTERVAL. Выбор прокси не ждёт обновления: оно выполняется
+    фоновым потоком.
+    """
+    def __init__(self, ttl: int = POOL_TTL, workers: int = VALIDATE_WORKERS,
+                 min_size: int = MIN_POOL_SIZE):
+        self.ttl = ttl
+        self.workers = workers
+        self.min_size = min_size
+        self.stats = {}
+        self.refreshed = None
+        self.attempted = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.warm_thread = None
+
+    def is_stale(self) -> bool:
+        now = time.monotonic()
+        if (self.attempted is not None
+                and now - self.attempted < MIN_REFRESH_INTERVAL):
+            return False
+        if self.refreshed is None or now - self.refreshed > self.ttl:
             return True
+        with self.lock:
+            return len(self.stats) < self.min_size
 
-    return False
+    def refresh(self):
+        """Получает список кандидатов и параллельно проверяет их вместе с
+        прокси, уже находящимися в пуле.
+        """
+        with self.refresh_lock:
+            if not self.is_stale():
+                return
+            self.attempted = time.monotonic()
 
-def get_random_proxy() -> str:
-    proxies = parse_proxies()
-    if not proxies:
-        return False
+            candidates = parse_proxies()
+            random.shuffle(candidates)
+            with self.lock:
+                known = list(self.stats)
+            fresh = [proxy for proxy in candidates if proxy not in known]
+            candidates = known + fresh[:RANDOM_TRIES]
 
-    for i in range(0, RANDOM_TRIES):
-        proxy = choice(proxies)
-        if proxy_is_valid(proxy):
-            return proxy
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                latencies = list(executor.map(check_proxy, candidates))
 
-    return False
+            with self.lock:
+                for proxy, latency in zip(candidates, latencies):
+                    if latency is None:
+                        self.stats.pop(proxy, None)
+                    elif proxy in self.stats:
+                        self.stats[proxy].update(True, latency)
+                    else:
+                        self.stats[proxy] = ProxyStats(proxy, latency)
+                size = len(self.stats)
 
-def get_proxy() -> str:
-    proxies = parse_proxies()
-    if not proxies:
-        return False
+            self.refreshed = time.monotonic()
+            logging.info(f'Пул прокси обновлён. Работающих прокси: {size}.')
+
+    def ensure(self):
+        """Обновляет устаревший пул, ожидая завершения обновления."""
+        if self.is_stale():
+            self.refresh()
+
+    def ensure_async(self):
+        """Запускает обновление устаревшего пула в отдельном потоке, если его
+        не поддерживает фоновый поток и обновление ещё не выполняется.
+        """
+        if self.warm_thread is not None and self.warm_thread.is_alive():
+            return
+        if self.refresh_lock.locked() or not self.is_stale():
+            return
+        threading.Thread(target=self._refresh_logged, daemon=True).start()
+
+    def prepare(self):
+        """Готовит пул к началу цикла. Ожидает обновления, только если пул
+        пуст и его не поддерживает фоновый поток; иначе используется текущий
+        набор, а устаревший пул обновляется в фоне.
+        """
+        warming = self.warm_thread is not None and self.warm_thread.is_alive()
+        with self.lock:
+            empty = not self.stats
+        if empty and not warming:
+            self.ensure()
+        else:
+            self.ensure_async()
+
+    def _refresh_logged(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.error('Ошибка обновления пула прокси. ' + str(e))
 
-    for proxy in proxies:
-        if proxy_is_valid(proxy):
-            return proxy
+    def proxies(self) -> list:
+        """Возвращает работающие прокси в порядке убывания оценки."""
+        self.ensure_async()
+        with self.lock:
+            ranked = sorted(self.stats.values(), key=lambda s: s.score,
+                            reverse=True)
+        return [stats.proxy for stats in ranked]
 
-    return False
+    def best(self) -> str:
+        proxies = self.proxies()
+        return proxies[0] if proxies else None
+
+    def random(self) -> str:
+        """Выбирает случайный прокси с вероятностью, пропорциональной его
+        оценке.
+        """
+        self.ensure_async()
+        with self.lock:
+            stats = list(self.stats.values())
+        if not stats:
+            return None
+        return random.choices([s.proxy for s in stats],
+                              weights=[s.score for s in stats])[0]
+
+    def report(self, proxy: str, ok: bool, latency: float = None):
+        """Учитывает результат запроса через прокси."""
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.update(ok, latency)
+            if (stats.failures >= MAX_FAILURES
+                    and stats.success_rate < MIN_SUCCESS_RATE):
+                del self.stats[proxy]
+                logging.warning(f'Прокси {proxy} исключён из пула.')
+
+    def _warm(self, interval: int):
+        while not self.stop_event.is_set():
+            if self.is_stale():
+                self._refresh_logged()
+            self.stop_event.wait(interval)
+
+    def start_warming(self, interval: int = WARM_INTERVAL):
+        """Запускает фоновый поток, поддерживающий пул в актуальном
+        состоянии.
+        """
+        if self.warm_thread is not None and self.warm_thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.warm_thread = threading.Thread(target=self._warm,
+                                            args=(interval,), daemon=True)
+        self.warm_thread.start()
+
+    def stop_warming(self):
+        self.stop_event.set()
+
+pool = ProxyPool()
+
+def get_random_proxy() -> str:
+    return pool.random() or False
+
+def get_proxy() -> str:
+    return pool.best() or False
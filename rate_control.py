@@ -0,0 +1,171 @@
+"""В данном модуле реализовано общее для всех потоков скрейпера управление
+частотой запросов к Instagram. Запросы делятся на классы (API/GraphQL,
+HTML-страницы профилей, CDN), для каждого класса действуют:
+
+- корзина токенов (token bucket), ограничивающая частоту запросов;
+- ограничение числа одновременных запросов, подстраиваемое по алгоритму AIMD:
+  аддитивное увеличение после успешных ответов, мультипликативное уменьшение
+  после ответов 429 и 5xx;
+- автоматический выключатель (circuit breaker): после ответа 429 или серии
+  ошибок все потоки, обращающиеся к данному классу запросов, приостанавливаются
+  на общий интервал ожидания.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+# Количество ошибок 5xx подряд, после которого срабатывает выключатель
+BREAKER_THRESHOLD = 3
+
+# Начальная и максимальная длительность паузы выключателя (секунды)
+BREAKER_COOLDOWN = 30
+MAX_BREAKER_COOLDOWN = 10 * 60
+
+class Interrupted(Exception):
+    """Ожидание разрешения на запрос прервано (отмена или истечение срока)."""
+    pass
+
+class EndpointLimiter:
+    """Ограничитель запросов для одного класса адресов."""
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.max_concurrency = concurrency
+        self.concurrency = float(concurrency)
+        self.active = 0
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, interrupted=None):
+        """Блокирует вызывающий поток, пока запрос не будет разрешён.
+        Функция interrupted проверяется при каждом пробуждении; если она
+        возвращает True, возбуждается исключение Interrupted.
+        """
+        with self.condition:
+            while True:
+                if interrupted is not None and interrupted():
+                    raise Interrupted()
+
+                now = time.monotonic()
+                if now < self.open_until:
+                    self.condition.wait(self.open_until - now)
+                    continue
+
+                if self.active >= int(self.concurrency):
+                    self.condition.wait()
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def release(self, status: int = None):
+        """Освобождает разрешение и учитывает код ответа сервера. Если ответ
+        не получен (status is None), параметры ограничителя не меняются.
+        """
+        with self.condition:
+            self.active -= 1
+
+            if status == 429 or (status is not None and status >= 500):
+                self._decrease(status)
+            elif status is not None:
+                self._increase()
+
+            self.condition.notify_all()
+
+    def _increase(self):
+        self.failures = 0
+        self.trips = 0
+        self.concurrency = min(self.max_concurrency,
+                               self.concurrency + 1 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def _decrease(self, status: int):
+        self.failures += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+
+        if status == 429 or self.failures >= BREAKER_THRESHOLD:
+            cooldown = min(MAX_BREAKER_COOLDOWN,
+                           BREAKER_COOLDOWN * 2 ** self.trips)
+            self.open_until = time.monotonic() + cooldown
+            self.trips += 1
+            self.failures = 0
+            logging.warning(f'Запросы класса {self.name} приостановлены на '
+                            + f'{cooldown} с после ответа {status}.')
+
+    def wake_all(self):
+        """Пробуждает все ожидающие потоки для проверки условия прерывания."""
+        with self.condition:
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, interrupted=None):
+        """Контекстный менеджер запроса; код ответа следует записать в
+        атрибут status возвращаемого объекта.
+        """
+        self.acquire(interrupted)
+        result = SimpleNamespace(status=None)
+        try:
+            yield result
+        finally:
+            self.release(result.status)
+
+# Классы адресов, ограничение которых не зависит от учётной записи Instagram
+SHARED_CLASSES = ('cdn',)
+
+class RateController:
+    """Набор ограничителей по классам адресов. Ограничители из shared
+    используются совместно с другими контроллерами (например, общий для всех
+    учётных записей ограничитель CDN).
+    """
+    def __init__(self, limits: dict, shared: dict = None):
+        shared = shared or {}
+        self.limiters = {name: shared.get(name)
+                         or EndpointLimiter(name, **params)
+                         for name, params in limits.items()}
+
+    @staticmethod
+    def shared_limiters(limits: dict) -> dict:
+        """Создаёт ограничители классов SHARED_CLASSES для передачи
+        нескольким контроллерам.
+        """
+        return {name: EndpointLimiter(name, **limits[name])
+                for name in SHARED_CLASSES if name in limits}
+
+    @staticmethod
+    def classify(url: str) -> str:
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+
+        if 'cdninstagram' in host or 'fbcdn' in host:
+            return 'cdn'
+        if ('/graphql/' in parsed.path or '/api/' in parsed.path
+                or '__a=1' in parsed.query or host.startswith('i.')):
+            return 'graphql'
+        return 'profile'
+
+    def limiter_for(self, url: str) -> EndpointLimiter:
+        return self.limiters[self.classify(url)]
+
+    def wake_all(self):
+        for limiter in self.limiters.values():
+            limiter.wake_all()
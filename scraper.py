@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import codecs
+import collections
 import configparser
+import contextlib
 import errno
 import glob
+import itertools
 from operator import itemgetter
 import json
 import logging
@@ -13,13 +15,13 @@ import logging.config
 import hashlib
 import os
 import pickle
+import queue
 import re
 import socket
 import sys
 import textwrap
 import time
 import xml.etree.ElementTree as ET
-import moviepy.editor as mpe
 
 try:
     from urllib.parse import urlparse
@@ -34,9 +36,19 @@ import requests.packages.urllib3.util.connection as urllib3_connection
 import tqdm
 
 from constants import *
-from config_loader import (TEMP_FOLDER, INSTAGRAM_USER_NAMES, LOGIN, PASSWORD,
-                           MANUAL_AUTH, MEDIA_LIMIT, COOKIEJAR, USE_PROXY)
+from config_loader import (TEMP_FOLDER, INSTAGRAM_USER_NAMES,
+                           MANUAL_AUTH, MEDIA_LIMIT, COOKIEJAR, USE_PROXY,
+                           RETRY_POLICY, MAX_REQUEST_RETRIES,
+                           ACCOUNT_BUDGET, CYCLE_DEADLINE, PROXY_PINNING, INSTAGRAM_LOGINS,
+                           MAX_VIDEO_DOWNLOAD_SIZE, MAX_LONG_EDGE, MAX_BITRATE, PAGINATION_PREFETCH)
+from parsing import (find_tags, deep_get, compile_template, iter_json_blobs, select_rendition,
+                     estimate_media_size)
+from download_pool import PriorityThreadPool, Stage
+from media_tools import mux_broadcast
+import fastjson
+from rate_control import RateController, Interrupted
 import proxy_finder
+import workers
 
 try:
     reload(sys)  # Python 2.7
@@ -87,6 +99,9 @@ input = threaded_input
 class PartialContentException(Exception):
     pass
 
+class DeadlineExceeded(Exception):
+    pass
+
 class InstagramScraper(object):
     """InstagramScraper scrapes and downloads an instagram user's photos and videos"""
 
@@ -100,7 +115,12 @@ class InstagramScraper(object):
                             media_types=['image', 'video', 'story-image', 'story-video', 'broadcast'],
                             tag=False, location=False, search_location=False, comments=False,
                             verbose=0, include_location=False, filter=None, proxies={}, no_check_certificate=False,
-                                                        template='{urlname}', log_destination='')
+                                                        template='{urlname}', log_destination='', pretty_json=False,
+                            retry_policy='prompt', max_retries=MAX_RETRIES, account_budget=0, cycle_deadline=0,
+                            keep_session=False, proxy_pool=None, proxy_pinning=None, yield_when_blocked=False,
+                            max_video_size=0, max_long_edge=0, max_bitrate=0, prefetch_pages=1,
+                            comment_workers=MAX_CONCURRENT_COMMENTS, max_comment_pages=MAX_COMMENT_PAGES,
+                            shared_limiters=None)
 
         allowed_attr = list(default_attr.keys())
         default_attr.update(kwargs)
@@ -132,8 +152,19 @@ class InstagramScraper(object):
 
         self.posts = []
         self.stories = []
+        self.spool_path = None
+        self.comment_stage = None
+        self.location_stage = None
+        self.location_cache = collections.OrderedDict()
+        self.location_lock = threading.Lock()
+        self.highlight_cache = collections.OrderedDict()
+        self.highlight_lock = threading.Lock()
+        self.completed_downloads = []
+        self.deferred_downloads = []
 
         self.session = requests.Session()
+        # The CDN limiter may be shared with the scrapers of other logins
+        self.rate_control = RateController(RATE_LIMITS, shared=self.shared_limiters)
         if self.no_check_certificate:
             self.session.verify = False
 
@@ -145,28 +176,147 @@ class InstagramScraper(object):
             raise
 
         self.session.headers = {'user-agent': CHROME_WIN_UA}
-        if self.cookiejar and os.path.exists(self.cookiejar):
-            with open(self.cookiejar, 'rb') as f:
-                self.session.cookies.update(pickle.load(f))
+        self.load_cookies()
         self.session.cookies.set('ig_pr', '1')
         self.rhx_gis = ""
 
         self.cookies = None
         self.authenticated = False
         self.logged_in = False
+        self.login_lock = threading.Lock()
+        self.session_generation = 0
+        self.login_blocked = False
+        self.finished_usernames = []
         self.last_scraped_filemtime = 0
         self.initial_scraped_filemtime = 0
         if default_attr['filter']:
             self.filter = list(self.filter)
+        self.cancel_event = threading.Event()
+        self._active_responses = set()
+        # Reentrant: cancel() may run in a signal handler that interrupted the main thread holding the lock
+        self._responses_lock = threading.RLock()
+        self._deadline_timer = None
         self.quit = False
+        self.cycle_deadline_at = None
+        self.account_deadline_at = None
+        self.current_account = None
+        self.pinned_proxies = {}
+        self.pinned_proxies_lock = threading.Lock()
+
+    @property
+    def quit(self):
+        """State of the cancellation token shared by all waits, reads and worker tasks."""
+        return self.cancel_event.is_set()
+
+    @quit.setter
+    def quit(self, value):
+        if value:
+            self.cancel()
+        else:
+            self.cancel_event.clear()
+
+    def cancel(self):
+        """Cancels the scrape: wakes up all waiting threads and aborts streamed reads.
+
+        Safe to call from a signal handler: the responses lock is reentrant and never held over I/O.
+        """
+        self.cancel_event.set()
+        self._interrupt()
+
+    def interrupted(self):
+        return self.quit or self.deadline_exceeded()
+
+    def _interrupt(self):
+        with self._responses_lock:
+            responses = list(self._active_responses)
+        for response in responses:
+            self._abort_response(response)
+        self.rate_control.wake_all()
+
+    @staticmethod
+    def _abort_response(response):
+        """Closes the response, shutting its socket down to wake up a thread blocked reading it."""
+        sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+        if sock is None:
+            # the connection has already handed the socket over to the response body reader
+            body = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+            sock = getattr(getattr(body, 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        response.close()
+
+    @contextlib.contextmanager
+    def _tracked(self, response):
+        """Registers a streamed response so that cancellation or a deadline can close it."""
+        with self._responses_lock:
+            self._active_responses.add(response)
+        try:
+            if self.interrupted():
+                self._abort_response(response)
+            yield response
+        finally:
+            with self._responses_lock:
+                self._active_responses.discard(response)
+            response.close()
+
+    def _arm_deadline_timer(self):
+        """Interrupts blocking waits and reads as soon as the nearest deadline passes."""
+        self._disarm_deadline_timer()
+        time_left = self.time_left()
+        if time_left is not None:
+            self._deadline_timer = threading.Timer(time_left, self._interrupt)
+            self._deadline_timer.daemon = True
+            self._deadline_timer.start()
+
+    def _disarm_deadline_timer(self):
+        if self._deadline_timer is not None:
+            self._deadline_timer.cancel()
+            self._deadline_timer = None
 
     def sleep(self, secs):
-        min_delay = 1
-        for _ in range(secs // min_delay):
-            time.sleep(min_delay)
-            if self.quit:
-                return
-        time.sleep(secs % min_delay)
+        self.cancel_event.wait(secs)
+
+    def start_cycle(self, deadline_at=None):
+        """Starts the per-cycle deadline, or joins a cycle already running until deadline_at."""
+        if deadline_at is None and self.cycle_deadline:
+            deadline_at = time.monotonic() + self.cycle_deadline
+        self.cycle_deadline_at = deadline_at
+        self._arm_deadline_timer()
+
+    def start_account(self, name=None):
+        """Starts the per-account time budget."""
+        self.current_account = name
+        self.account_deadline_at = time.monotonic() + self.account_budget if self.account_budget else None
+        self._arm_deadline_timer()
+
+    def time_left(self):
+        """Returns seconds left until the nearest deadline or None if there is no deadline."""
+        deadlines = [d for d in (self.cycle_deadline_at, self.account_deadline_at) if d is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def deadline_exceeded(self):
+        return self.time_left() == 0
+
+    def _retry_sleep(self, retry_delay):
+        """Returns the retry delay clipped to the time left until the deadline."""
+        time_left = self.time_left()
+        return retry_delay if time_left is None else min(retry_delay, time_left)
+
+    def _on_retries_exhausted(self, url, exception_message):
+        """Apply the retry policy and return True: retry, False: ignore, None: abort"""
+        if self.retry_policy == 'prompt':
+            return self._retry_prompt(url, exception_message)
+        elif self.retry_policy == 'abort':
+            self.logger.error('Giving up on {0} after repeated error {1}'.format(url, exception_message))
+            return None
+        else:
+            self.logger.warning('Skipping {0} after repeated error {1}'.format(url, exception_message))
+            return False
 
     def _retry_prompt(self, url, exception_message):
         """Show prompt and return True: retry, False: ignore, None: abort"""
@@ -180,48 +330,132 @@ class InstagramScraper(object):
                 return True
             elif answer == 'F':
                 self.logger.info( 'The user has chosen to retry forever' )
-                global MAX_RETRIES
-                MAX_RETRIES = sys.maxsize
+                self.max_retries = sys.maxsize
                 return True
             else:
                 self.logger.info( 'The user has chosen to abort' )
                 return None
 
+    def choose_proxy(self, url):
+        """Picks a proxy for the request from the proxy pool, honouring account or host pinning.
+        Returns None when requests should go through the session proxies."""
+        if self.proxy_pool is None:
+            return None
+
+        if self.proxy_pinning == 'account':
+            key = self.current_account
+        elif self.proxy_pinning == 'host':
+            key = urlparse(url).hostname
+        else:
+            key = None
+
+        if key is None:
+            return self.proxy_pool.random()
+
+        with self.pinned_proxies_lock:
+            proxy = self.pinned_proxies.get(key)
+        if proxy is not None:
+            return proxy
+
+        # The pool is consulted outside the lock, the first pin recorded for the key wins
+        proxy = self.proxy_pool.random()
+        if proxy is None:
+            return None
+        with self.pinned_proxies_lock:
+            return self.pinned_proxies.setdefault(key, proxy)
+
+    def proxy_failed(self, proxy, error):
+        """Reports a failed request through the proxy and unpins it.
+        Returns True if the request should be repeated through another proxy."""
+        if proxy is None:
+            return False
+
+        if isinstance(error, (requests.exceptions.ProxyError, requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout)):
+            pass
+        elif isinstance(error, requests.exceptions.HTTPError) and error.response is not None \
+                and error.response.status_code == 429:
+            pass
+        else:
+            return False
+
+        self.proxy_pool.report(proxy, False)
+        with self.pinned_proxies_lock:
+            for key in [key for key, value in self.pinned_proxies.items() if value == proxy]:
+                del self.pinned_proxies[key]
+        return True
+
+    def proxy_succeeded(self, proxy, response):
+        if proxy is not None:
+            self.proxy_pool.report(proxy, True, response.elapsed.total_seconds())
+
+    @staticmethod
+    def proxy_kwargs(proxy):
+        return {'http': proxy, 'https': proxy} if proxy else None
+
     def safe_get(self, *args, **kwargs):
         # out of the box solution
         # session.mount('https://', HTTPAdapter(max_retries=...))
         # only covers failed DNS lookups, socket connections and connection timeouts
         # It doesnt work when server terminate connection while response is downloaded
+        if 'url' in kwargs:
+            url = kwargs['url']
+        elif len(args) > 0:
+            url = args[0]
+        limiter = self.rate_control.limiter_for(url)
+
         retry = 0
         retry_delay = RETRY_DELAY
+        relogged = False
+        failovers = 0
         while True:
             if self.quit:
                 return
+            if self.deadline_exceeded():
+                self.logger.warning('Deadline exceeded, skipping {0}'.format(url))
+                return
+            proxy = self.choose_proxy(url)
             try:
-                response = self.session.get(timeout=CONNECT_TIMEOUT, cookies=self.cookies, *args, **kwargs)
+                generation = self.session_generation
+                with limiter.slot(self.interrupted) as slot:
+                    response = self.session.get(timeout=CONNECT_TIMEOUT, cookies=self.cookies,
+                                                proxies=self.proxy_kwargs(proxy), *args, **kwargs)
+                    slot.status = response.status_code
+                if not relogged and self.session_expired(response):
+                    relogged = True
+                    response.close()
+                    if self.relogin(generation):
+                        continue
+                    return
                 if response.status_code == 404:
                     return
                 response.raise_for_status()
+                self.proxy_succeeded(proxy, response)
                 content_length = response.headers.get('Content-Length')
+                if kwargs.get('stream'):
+                    # the caller reads the body itself
+                    return response
                 if content_length is not None and len(response.content) != int(content_length):
                     #if content_length is None we repeat anyway to get size and be confident
                     raise PartialContentException('Partial response')
                 return response
             except (KeyboardInterrupt):
                 raise
+            except Interrupted:
+                continue
             except (requests.exceptions.RequestException, PartialContentException) as e:
-                if 'url' in kwargs:
-                    url = kwargs['url']
-                elif len(args) > 0:
-                    url = args[0]
-                if retry < MAX_RETRIES:
+                if self.proxy_failed(proxy, e) and failovers < MAX_PROXY_FAILOVERS:
+                    self.logger.warning('Proxy {0} failed with {1}, switching proxy for {2}'.format(proxy, repr(e), url))
+                    failovers += 1
+                    continue
+                if retry < self.max_retries:
                     self.logger.warning('Retry after exception {0} on {1}'.format(repr(e), url))
-                    self.sleep(retry_delay)
+                    self.sleep(self._retry_sleep(retry_delay))
                     retry_delay = min( 2 * retry_delay, MAX_RETRY_DELAY )
                     retry = retry + 1
                     continue
                 else:
-                    keep_trying = self._retry_prompt(url, repr(e))
+                    keep_trying = self._on_retries_exhausted(url, repr(e))
                     if keep_trying == True:
                         retry = 0
                         continue
@@ -229,12 +463,53 @@ class InstagramScraper(object):
                         return
                 raise
 
+    @staticmethod
+    def parse_json(data):
+        """Parses JSON bytes or text.
+
+        Parsing stays on the calling thread: handing a document to the process pool costs more in
+        pickling the result back than the parse itself.
+        """
+        return fastjson.loads(data)
+
     def get_json(self, *args, **kwargs):
-        """Retrieve text from url. Return text as string or None if no data present """
+        """Retrieve raw JSON from url. Return body as bytes or None if no data present """
         resp = self.safe_get(*args, **kwargs)
 
         if resp is not None:
-            return resp.text
+            return resp.content
+
+    def authenticate(self):
+        """Restores the stored session if it is still valid, otherwise logs in or authenticates as a guest."""
+        if self.login_user and self.login_pass:
+            if not self.authenticate_with_cookies():
+                self.authenticate_with_login()
+        else:
+            self.authenticate_as_guest()
+
+    def authenticate_with_cookies(self):
+        """Checks the session loaded from the cookiejar with a single request.
+        Returns True if the session is still logged in."""
+        if not self.session.cookies.get('sessionid') or not self.session.cookies.get('csrftoken'):
+            return False
+
+        self.session.headers.update({'X-CSRFToken': self.session.cookies.get('csrftoken')})
+        try:
+            resp = self.session.get(SESSION_CHECK_URL, timeout=CONNECT_TIMEOUT, allow_redirects=False)
+            valid = resp.status_code == 200 and 'form_data' in fastjson.loads(resp.content)
+        except (requests.exceptions.RequestException, ValueError, TypeError):
+            valid = False
+
+        if not valid:
+            self.logger.info('Stored session is no longer valid')
+            del self.session.headers['X-CSRFToken']
+            return False
+
+        self.cookies = self.session.cookies
+        self.authenticated = True
+        self.logged_in = True
+        self.rhx_gis = ""
+        return True
 
     def authenticate_as_guest(self):
         """Authenticate as a guest/non-signed in user"""
@@ -258,15 +533,17 @@ class InstagramScraper(object):
         login = self.session.post(LOGIN_URL, data=login_data, allow_redirects=True)
         self.session.headers.update({'X-CSRFToken': login.cookies['csrftoken']})
         self.cookies = login.cookies
-        login_text = json.loads(login.text)
+        login_text = fastjson.loads(login.content)
 
         if login_text.get('authenticated') and login.status_code == 200:
             self.authenticated = True
             self.logged_in = True
+            self.login_blocked = False
             self.session.headers.update({'user-agent': CHROME_WIN_UA})
             self.rhx_gis = ""
         else:
             self.logger.error('Login failed for ' + self.login_user)
+            self.login_blocked = True
 
             if 'checkpoint_url' in login_text:
                 checkpoint_url = login_text.get('checkpoint_url')
@@ -297,11 +574,12 @@ class InstagramScraper(object):
         code = self.session.post(BASE_URL[:-1] + checkpoint_url, data=code_data, allow_redirects=True)
         self.session.headers.update({'X-CSRFToken': code.cookies['csrftoken']})
         self.cookies = code.cookies
-        code_text = json.loads(code.text)
+        code_text = fastjson.loads(code.content)
 
         if code_text.get('status') == 'ok':
             self.authenticated = True
             self.logged_in = True
+            self.login_blocked = False
         elif 'errors' in code.text:
             for count, error in enumerate(code_text['challenge']['errors']):
                 count += 1
@@ -320,6 +598,58 @@ class InstagramScraper(object):
             except requests.exceptions.RequestException:
                 self.logger.warning('Failed to log out ' + self.login_user)
 
+    def session_expired(self, response):
+        """Returns True if the response shows that the login session is no longer valid."""
+        if not self.logged_in:
+            return False
+        if '/accounts/login' in response.url or '/challenge/' in response.url:
+            return True
+        if response.status_code == 401:
+            return True
+        if response.status_code == 403:
+            return b'login_required' in response.content or b'require_login' in response.content
+        return False
+
+    def relogin(self, generation):
+        """Logs in again unless another thread has already done it since the given session generation.
+        Returns True if the scraper is logged in afterwards."""
+        with self.login_lock:
+            if self.session_generation == generation:
+                self.logger.warning('Instagram session is no longer valid, logging in again')
+                user_agent = self.session.headers.get('user-agent')
+                self.logged_in = False
+                self.authenticated = False
+                self.authenticate_with_login()
+                self.session.headers.update({'user-agent': user_agent})
+                self.session_generation += 1
+            return self.logged_in
+
+    def identity_blocked(self):
+        """Returns True if Instagram rejected the login or is rate limiting this identity."""
+        return self.identity_blocked_until() > time.monotonic()
+
+    def identity_blocked_until(self):
+        """Returns the monotonic time until which this identity should rest.
+
+        A rejected login rests for LOGIN_COOLDOWN, a rate limited one until its endpoint breakers reopen.
+        """
+        if self.login_blocked:
+            return time.monotonic() + LOGIN_COOLDOWN
+        return max((limiter.open_until for name, limiter in self.rate_control.limiters.items() if name != 'cdn'),
+                   default=0)
+
+    def _account_done(self, username):
+        # An account scraped while the identity got blocked is left for another identity
+        if not (self.yield_when_blocked and self.identity_blocked()):
+            self.finished_usernames.append(username)
+
+    def configure(self, **kwargs):
+        """Updates scraper settings before the next scrape of a long-lived scraper."""
+        for key, value in kwargs.items():
+            if key in self.__dict__:
+                self.__dict__[key] = value
+        self.quit = False
+
     def get_dst_dir(self, username):
         """Gets the destination directory and last scraped file time."""
         if self.destination == './':
@@ -369,7 +699,8 @@ class InstagramScraper(object):
     def get_last_scraped_filemtime(self, dst):
         """Stores the last modified time of newest file in a directory."""
         list_of_files = []
-        file_types = ('*.jpg', '*.mp4')
+        # Link markers stand in for videos too large to download or send
+        file_types = ('*.jpg', '*.mp4', '*' + LINK_SUFFIX)
 
         for type in file_types:
             list_of_files.extend(glob.glob(dst + '/' + type))
@@ -400,7 +731,7 @@ class InstagramScraper(object):
         resp = self.get_json(QUERY_FOLLOWINGS.format(params))
 
         if resp is not None:
-            payload = json.loads(resp)['data']['user']['edge_follow']
+            payload = self.parse_json(resp)['data']['user']['edge_follow']
             if payload:
                 end_cursor = payload['page_info']['end_cursor']
                 followings = []
@@ -409,22 +740,15 @@ class InstagramScraper(object):
                 return followings, end_cursor
         return None, None
 
-    def query_comments_gen(self, shortcode, end_cursor=''):
+    def query_comments_gen(self, shortcode, end_cursor='', max_pages=0):
         """Generator for comments."""
-        comments, end_cursor = self.__query_comments(shortcode, end_cursor)
-
-        if comments:
-            try:
-                while True:
-                    for item in comments:
-                        yield item
-
-                    if end_cursor:
-                        comments, end_cursor = self.__query_comments(shortcode, end_cursor)
-                    else:
-                        return
-            except ValueError:
-                self.logger.exception('Failed to query comments for shortcode ' + shortcode)
+        try:
+            with contextlib.closing(self.paginate(lambda cursor: self.__query_comments(shortcode, cursor),
+                                                  end_cursor, max_pages=max_pages)) as comments:
+                for item in comments:
+                    yield item
+        except ValueError:
+            self.logger.exception('Failed to query comments for shortcode ' + shortcode)
 
     def __query_comments(self, shortcode, end_cursor=''):
         params = QUERY_COMMENTS_VARS.format(shortcode, end_cursor)
@@ -433,7 +757,7 @@ class InstagramScraper(object):
         resp = self.get_json(QUERY_COMMENTS.format(params))
 
         if resp is not None:
-            payload = json.loads(resp)['data']['shortcode_media']
+            payload = self.parse_json(resp)['data']['shortcode_media']
 
             if payload:
                 container = payload['edge_media_to_comment']
@@ -443,6 +767,96 @@ class InstagramScraper(object):
 
         return None, None
 
+    def paginate(self, fetch, end_cursor='', is_last_page=None, limit=0, max_pages=0):
+        """Yields the items of the pages returned by fetch(end_cursor) as (items, next_end_cursor).
+
+        While the consumer works through a page, up to prefetch_pages following pages are requested in a
+        background thread. No further page is requested once is_last_page(items) is true for the last page,
+        limit items or max_pages pages have been fetched, so early stops do not waste requests.
+        """
+        pages = self._fetch_pages(fetch, end_cursor, is_last_page, limit, max_pages)
+        if self.prefetch_pages <= 0:
+            for items in pages:
+                yield from items
+            return
+
+        results = queue.Queue()
+        slots = threading.Semaphore(self.prefetch_pages + 1)
+        stopped = threading.Event()
+        threading.Thread(target=self._prefetch_pages, args=(pages, results, slots, stopped), daemon=True).start()
+        try:
+            while True:
+                kind, value = results.get()
+                if kind == 'error':
+                    raise value
+                if kind == 'end':
+                    return
+                yield from value
+                slots.release()
+        finally:
+            stopped.set()
+
+    def _fetch_pages(self, fetch, end_cursor, is_last_page, limit, max_pages):
+        fetched = 0
+        for page in itertools.count(1):
+            items, end_cursor = fetch(end_cursor)
+            if not items:
+                # safe_get gives up on the deadline, which must not pass for the end of the feed
+                if self.deadline_exceeded():
+                    raise DeadlineExceeded('Deadline exceeded while paginating')
+                return
+            yield items
+
+            fetched += len(items)
+            if not end_cursor or (limit and fetched >= limit) or (max_pages and page >= max_pages) or \
+                    (is_last_page and is_last_page(items)):
+                return
+
+    def _prefetch_pages(self, pages, results, slots, stopped):
+        """Fetches the pages into results, holding a slot per page until the consumer is done with it."""
+        try:
+            while True:
+                while not slots.acquire(timeout=1):
+                    if stopped.is_set() or self.quit:
+                        return
+                if stopped.is_set():
+                    return
+                items = next(pages, None)
+                if items is None:
+                    return
+                results.put(('page', items))
+        except Exception as e:
+            results.put(('error', e))
+        finally:
+            results.put(('end', None))
+
+    def harvest_comments(self, item, container):
+        """Collects the comments of the post into container['data'], runs in the comment stage."""
+        container['data'] = list(self.query_comments_gen(item['shortcode'], max_pages=self.max_comment_pages))
+
+    def _start_stages(self):
+        """Starts the enrichment stages that fill in the posts metadata next to the discovery loop."""
+        if self.comments:
+            self.comment_stage = Stage(self.comment_workers, max_pending=MAX_PENDING_DOWNLOADS)
+        if self.include_location:
+            self.location_stage = Stage(MAX_CONCURRENT_LOCATIONS, max_pending=MAX_PENDING_DOWNLOADS)
+
+    def _stop_stages(self):
+        # Every account awaits its enrichment before persisting, anything still queued was interrupted
+        for stage in (self.comment_stage, self.location_stage):
+            if stage is not None:
+                stage.shutdown(wait=False)
+        self.comment_stage = None
+        self.location_stage = None
+
+    def wait_enrichment(self):
+        """Waits for the enrichment of the posts discovered so far."""
+        for stage, what in ((self.comment_stage, 'comments'), (self.location_stage, 'location')):
+            if stage is not None:
+                errors = stage.wait()
+                if errors:
+                    self.logger.warning('Failed to get {0} for {1} posts: {2}'.format(what, len(errors), errors[0]))
+
     def scrape_hashtag(self):
         self.__scrape_query(self.query_hashtag_gen)
 
@@ -453,70 +867,99 @@ class InstagramScraper(object):
         try:
             if self.quit:
                 return
+            if self.deadline_exceeded():
+                raise DeadlineExceeded('Deadline exceeded before start')
             return fn(*args, **kwargs)
+        except DeadlineExceeded:
+            raise
         except:
+            # Errors of reads aborted by cancellation or a deadline are expected
+            if self.quit:
+                return
+            if self.deadline_exceeded():
+                raise DeadlineExceeded('Deadline exceeded in {0}'.format(fn.__name__))
             self.logger.debug("Exception in worker thread", exc_info=sys.exc_info())
             raise
 
-    def __scrape_query(self, media_generator, executor=concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)):
+    def submit_download(self, executor, future_to_item, fn, item, dst):
+        """Submits the download of the item, larger expected downloads first when the executor supports priorities.
+
+        Blocks while the executor queue is full, so that pagination waits for the downloads to catch up.
+        """
+        self.reap_downloads(future_to_item)
+        if hasattr(executor, 'submit_priority'):
+            future = executor.submit_priority(estimate_media_size(item), self.worker_wrapper, fn, item, dst)
+        else:
+            future = executor.submit(self.worker_wrapper, fn, item, dst)
+        future_to_item[future] = item
+
+    def reap_downloads(self, future_to_item, block=False):
+        """Records the outcome of the finished downloads and drops them from future_to_item.
+
+        Only the timestamps and file paths needed by _settle_downloads are kept. With block set waits for
+        all the pending downloads.
+        """
+        if block:
+            futures = tqdm.tqdm(concurrent.futures.as_completed(list(future_to_item)), total=len(future_to_item),
+                                desc='Downloading', disable=self.quiet)
+        else:
+            futures = [future for future in future_to_item if future.done()]
+
+        for future in futures:
+            item = future_to_item.pop(future)
+            if future.cancelled():
+                continue
+            is_profile_pic = item.get('__typename') == 'GraphProfilePic'
+            # worker_wrapper returns None for downloads skipped on cancellation
+            if isinstance(future.exception(), DeadlineExceeded) or (future.exception() is None and
+                                                                    future.result() is None and self.quit):
+                self.deferred_downloads.append((self.__get_timestamp(item), is_profile_pic))
+            elif future.exception() is not None:
+                self.logger.error('Media at {0} generated an exception: {1}'.format(item.get('urls'),
+                                                                                   future.exception()))
+            else:
+                self.completed_downloads.append((self.__get_timestamp(item), is_profile_pic, future.result()))
+
+    def __scrape_query(self, media_generator, executor=None):
         """Scrapes the specified value for posted media."""
         self.quit = False
+        own_executor = executor is None
+        if own_executor:
+            executor = PriorityThreadPool(max_workers=MAX_CONCURRENT_DOWNLOADS, max_pending=MAX_PENDING_DOWNLOADS)
+        self._start_stages()
         try:
+            self.start_cycle()
             for value in self.usernames:
+                if self.quit:
+                    break
+                if self.deadline_exceeded():
+                    self.logger.warning('Cycle deadline exceeded, {0} deferred to the next cycle'.format(value))
+                    continue
+
+                self.start_account(value)
                 self.posts = []
                 self.stories = []
+                self.completed_downloads = []
+                self.deferred_downloads = []
                 self.last_scraped_filemtime = 0
                 greatest_timestamp = 0
                 future_to_item = {}
 
                 dst = self.get_dst_dir(value)
+                self._start_metadata(dst, value)
 
-                if self.include_location:
-                    media_exec = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-
-                iter = 0
-                for item in tqdm.tqdm(media_generator(value), desc='Searching {0} for posts'.format(value), unit=" media",
-                                      disable=self.quiet):
-
-                    if self.filter_locations:
-                        if item.get("location") is None or self.get_key_from_value(self.filter_locations, item["location"].get("id")) is None:
-                            continue
-                    if ((item['is_video'] is False and 'image' in self.media_types) or \
-                                (item['is_video'] is True and 'video' in self.media_types)
-                        ) and self.is_new_media(item):
-                        future = executor.submit(self.worker_wrapper, self.download, item, dst)
-                        future_to_item[future] = item
-
-                    if self.include_location and 'location' not in item:
-                        media_exec.submit(self.worker_wrapper, self.__get_location, item)
+                listing_complete = True
+                try:
+                    self.__scrape_query_items(media_generator(value), executor, future_to_item, dst)
+                except DeadlineExceeded:
+                    listing_complete = False
+                    self.logger.warning('Deadline exceeded while listing {0}, the rest is left to the next cycle'.format(
+                        value))
 
-                    if self.comments:
-                        item['edge_media_to_comment']['data'] = list(self.query_comments_gen(item['shortcode']))
+                self.reap_downloads(future_to_item, block=True)
 
-                    if self.media_metadata or self.comments or self.include_location:
-                        if self.latest_stamps_parser and self.initial_scraped_filemtime > self.__get_timestamp(item):
-                            pass
-                        else:
-                            self.posts.append(item)
-
-                    iter = iter + 1
-                    if self.maximum != 0 and iter >= self.maximum:
-                        break
-
-                if future_to_item:
-                    for future in tqdm.tqdm(concurrent.futures.as_completed(future_to_item),
-                                            total=len(future_to_item),
-                                            desc='Downloading', disable=self.quiet):
-                        item = future_to_item[future]
-
-                        if future.exception() is not None:
-                            self.logger.warning(
-                                'Media for {0} at {1} generated an exception: {2}'.format(value, item['urls'],
-                                                                                          future.exception()))
-                        else:
-                            timestamp = self.__get_timestamp(item)
-                            if timestamp > greatest_timestamp:
-                                greatest_timestamp = timestamp
+                greatest_timestamp = self._settle_downloads(self.completed_downloads, self.deferred_downloads,
+                                                            listing_complete)
                 # Even bother saving it?
                 if greatest_timestamp > self.last_scraped_filemtime:
                     self.set_last_scraped_timestamp(value, greatest_timestamp)
@@ -525,6 +968,44 @@ class InstagramScraper(object):
 
         finally:
             self.quit = True
+            if own_executor:
+                executor.shutdown(wait=True)
+            self._stop_stages()
+            self._disarm_deadline_timer()
+
+    def __scrape_query_items(self, items, executor, future_to_item, dst):
+        """Submits the downloads and enrichment of the listed posts."""
+        iter = 0
+        for item in tqdm.tqdm(items, desc='Searching {0} for posts'.format(self.current_account), unit=" media",
+                              disable=self.quiet):
+
+            if self.filter_locations:
+                # The filter needs the location right away
+                if 'location' not in item:
+                    self.__get_location(item)
+                if item.get("location") is None or self.get_key_from_value(self.filter_locations, item["location"].get("id")) is None:
+                    continue
+            if ((item['is_video'] is False and 'image' in self.media_types) or \
+                        (item['is_video'] is True and 'video' in self.media_types)
+                ) and self.is_new_media(item):
+                self.submit_download(executor, future_to_item, self.download, item, dst)
+
+            if self.include_location and 'location' not in item:
+                self.location_stage.submit(self.worker_wrapper, self.__get_location, item)
+
+            if self.comments:
+                self.comment_stage.submit(self.worker_wrapper, self.harvest_comments, item,
+                                          item['edge_media_to_comment'])
+
+            if self.media_metadata or self.comments or self.include_location:
+                if self.latest_stamps_parser and self.initial_scraped_filemtime > self.__get_timestamp(item):
+                    pass
+                else:
+                    self.add_post(item)
+
+            iter = iter + 1
+            if self.maximum != 0 and iter >= self.maximum:
+                break
 
     def query_hashtag_gen(self, hashtag):
         return self.__query_gen(QUERY_HASHTAG, QUERY_HASHTAG_VARS, 'hashtag', hashtag)
@@ -534,20 +1015,15 @@ class InstagramScraper(object):
 
     def __query_gen(self, url, variables, entity_name, query, end_cursor=''):
         """Generator for hashtag and location."""
-        nodes, end_cursor = self.__query(url, variables, entity_name, query, end_cursor)
-
-        if nodes:
-            try:
-                while True:
-                    for node in nodes:
-                        yield node
-
-                    if end_cursor:
-                        nodes, end_cursor = self.__query(url, variables, entity_name, query, end_cursor)
-                    else:
-                        return
-            except ValueError:
-                self.logger.exception('Failed to query ' + query)
+        # Posts skipped by the location filter do not count towards the maximum
+        limit = 0 if self.filter_locations else self.maximum
+        try:
+            with contextlib.closing(self.paginate(lambda cursor: self.__query(url, variables, entity_name, query, cursor),
+                                                  end_cursor, limit=limit)) as nodes:
+                for node in nodes:
+                    yield node
+        except ValueError:
+            self.logger.exception('Failed to query ' + query)
 
     def __query(self, url, variables, entity_name, query, end_cursor):
         params = variables.format(query, end_cursor)
@@ -556,7 +1032,7 @@ class InstagramScraper(object):
         resp = self.get_json(url.format(params))
 
         if resp is not None:
-            payload = json.loads(resp)['data'][entity_name]
+            payload = self.parse_json(resp)['data'][entity_name]
 
             if payload:
                 nodes = []
@@ -580,21 +1056,20 @@ class InstagramScraper(object):
         self.extract_tags(node)
 
         details = None
-        if self.include_location and 'location' not in node:
-            details = self.__get_media_details(node['shortcode'])
-            node['location'] = details.get('location') if details else None
-
         if 'urls' not in node:
             node['urls'] = []
         if node['is_video'] and 'video_url' in node:
             node['urls'] = [node['video_url']]
         elif '__typename' in node and node['__typename'] == 'GraphImage':
-            node['urls'] = [self.get_original_image(node['display_url'])]
+            node['urls'] = [self.get_image_url(node)]
         else:
             if details is None:
                 details = self.__get_media_details(node['shortcode'])
 
             if details:
+                # The details carry the location as well, saving the location stage a request
+                if self.include_location and 'location' not in node:
+                    node['location'] = self._cache_location(node['shortcode'], details.get('location'))
                 if '__typename' in details and details['__typename'] == 'GraphVideo':
                     node['urls'] = [details['video_url']]
                 elif '__typename' in details and details['__typename'] == 'GraphSidecar':
@@ -603,7 +1078,7 @@ class InstagramScraper(object):
                         urls += self.augment_node(carousel_item['node'])['urls']
                     node['urls'] = urls
                 else:
-                    node['urls'] = [self.get_original_image(details['display_url'])]
+                    node['urls'] = [self.get_image_url(details)]
 
         return node
 
@@ -612,7 +1087,7 @@ class InstagramScraper(object):
 
         if resp is not None:
             try:
-                return json.loads(resp)['graphql']['shortcode_media']
+                return self.parse_json(resp)['graphql']['shortcode_media']
             except ValueError:
                 self.logger.warning('Failed to get media details for ' + shortcode)
 
@@ -623,21 +1098,58 @@ class InstagramScraper(object):
         code = item.get('shortcode', item.get('code'))
 
         if code:
-            details = self.__get_media_details(code)
-            item['location'] = details.get('location') if details else None
-
-    def scrape(self, executor=concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)):
+            with self.location_lock:
+                location = self.location_cache.get(code, False)
+            if location is False:
+                details = self.__get_media_details(code)
+                if details is None:
+                    item['location'] = None
+                    return
+                location = self._cache_location(code, details.get('location'))
+            item['location'] = location
+
+    def _cache_location(self, shortcode, location):
+        """Remembers the location of the post, sharing one payload between the posts of a location id."""
+        with self.location_lock:
+            if location and location.get('id') is not None:
+                location = self.location_cache.setdefault(('id', location['id']), location)
+            self.location_cache[shortcode] = location
+            while len(self.location_cache) > LOCATION_CACHE_SIZE:
+                self.location_cache.popitem(last=False)
+        return location
+
+    def scrape(self, executor=None, cycle_deadline_at=None):
         """Crawls through and downloads user's media"""
         self.session.headers.update({'user-agent': STORIES_UA})
+        own_executor = executor is None
+        if own_executor:
+            executor = PriorityThreadPool(max_workers=MAX_CONCURRENT_DOWNLOADS, max_pending=MAX_PENDING_DOWNLOADS)
+        self._start_stages()
+        self.start_cycle(cycle_deadline_at)
+        self.finished_usernames = []
         try:
             for username in self.usernames:
+                if self.quit:
+                    break
+                if self.yield_when_blocked and self.identity_blocked():
+                    self.logger.warning('Login {0} is blocked, leaving the remaining accounts to other logins'.format(
+                        self.login_user))
+                    break
+                if self.deadline_exceeded():
+                    self.logger.warning('Cycle deadline exceeded, {0} deferred to the next cycle'.format(username))
+                    continue
+
+                self.start_account(username)
                 self.posts = []
                 self.stories = []
+                self.completed_downloads = []
+                self.deferred_downloads = []
                 self.last_scraped_filemtime = 0
                 greatest_timestamp = 0
                 future_to_item = {}
 
                 dst = self.get_dst_dir(username)
+                self._start_metadata(dst, username)
 
                 # Get the user metadata.
                 user = self.get_shared_data_userinfo(username)
@@ -645,6 +1157,7 @@ class InstagramScraper(object):
                 if not user:
                     self.logger.error(
                         'Error getting user details for {0}. Please verify that the user exists.'.format(username))
+                    self._account_done(username)
                     continue
                 elif user and user['is_private'] and user['edge_owner_to_timeline_media']['count'] > 0 and not \
                     user['edge_owner_to_timeline_media']['edges']:
@@ -662,22 +1175,20 @@ class InstagramScraper(object):
                 # Crawls the media and sends it to the executor.
                 try:
 
-                    self.get_media(dst, executor, future_to_item, user)
+                    listing_complete = True
+                    try:
+                        self.get_media(dst, executor, future_to_item, user)
+                    except DeadlineExceeded:
+                        listing_complete = False
+                        self.logger.warning('Deadline exceeded while listing the posts of {0}, the rest is left to '
+                                            'the next cycle'.format(username))
 
                     # Displays the progress bar of completed downloads. Might not even pop up if all media is downloaded while
                     # the above loop finishes.
-                    if future_to_item:
-                        for future in tqdm.tqdm(concurrent.futures.as_completed(future_to_item), total=len(future_to_item),
-                                                desc='Downloading', disable=self.quiet):
-                            item = future_to_item[future]
-
-                            if future.exception() is not None:
-                                self.logger.error(
-                                    'Media at {0} generated an exception: {1}'.format(item['urls'], future.exception()))
-                            else:
-                                timestamp = self.__get_timestamp(item)
-                                if timestamp > greatest_timestamp:
-                                    greatest_timestamp = timestamp
+                    self.reap_downloads(future_to_item, block=True)
+
+                    greatest_timestamp = self._settle_downloads(self.completed_downloads, self.deferred_downloads,
+                                                                listing_complete)
                     # Even bother saving it?
                     if greatest_timestamp > self.last_scraped_filemtime:
                         self.set_last_scraped_timestamp(username, greatest_timestamp)
@@ -686,9 +1197,55 @@ class InstagramScraper(object):
 
                 except ValueError:
                     self.logger.error("Unable to scrape user - %s" % username)
+
+                self._account_done(username)
         finally:
             self.quit = True
-            self.logout()
+            if own_executor:
+                executor.shutdown(wait=True)
+            self._stop_stages()
+            self._disarm_deadline_timer()
+            if not self.keep_session:
+                self.logout()
+
+    def _settle_downloads(self, completed, deferred, listing_complete=True):
+        """Returns the latest media timestamp to store for the account.
+
+        completed holds (timestamp, is_profile_pic, files_path) and deferred (timestamp, is_profile_pic)
+        tuples recorded by reap_downloads. Media that missed its deadline is deferred to the next cycle,
+        and so is everything older than the listed posts when the listing was cut short by a deadline.
+        In latest mode the stored timestamp is clamped below the oldest deferred media, so that it is
+        scraped again while the downloaded files are kept.
+
+        Without a latest stamps file the newest file of the directory is the watermark. Files newer than
+        the oldest deferred media are removed in that case, otherwise they would hide it.
+        """
+        # Profile pictures are fetched whenever missing and do not take part in the watermark
+        deferred_timestamps = [timestamp for timestamp, is_profile_pic in deferred if not is_profile_pic]
+        if not listing_complete:
+            # The posts that were not listed are older than every listed one
+            deferred_timestamps.append(0)
+        oldest_deferred = min(deferred_timestamps) if deferred_timestamps and self.latest else None
+
+        if deferred:
+            self.logger.warning('{0} media deferred to the next cycle'.format(len(deferred)))
+
+        greatest_timestamp = 0
+        for timestamp, is_profile_pic, files_path in completed:
+            if oldest_deferred is not None and timestamp >= oldest_deferred and not is_profile_pic and \
+                    not self.latest_stamps_parser:
+                for file_path in files_path or []:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                continue
+
+            if timestamp > greatest_timestamp:
+                greatest_timestamp = timestamp
+
+        if oldest_deferred is not None:
+            greatest_timestamp = min(greatest_timestamp, oldest_deferred - 1)
+
+        return greatest_timestamp
 
     def get_profile_pic(self, dst, executor, future_to_item, user, username):
         if 'image' not in self.media_types:
@@ -703,7 +1260,7 @@ class InstagramScraper(object):
                 self.logger.error('Error getting user info for {0}'.format(username))
                 return
 
-            user_info = json.loads(resp)['user']
+            user_info = self.parse_json(resp)['user']
 
             if 'has_anonymous_profile_picture' in user_info and user_info['has_anonymous_profile_picture']:
                 return
@@ -727,8 +1284,7 @@ class InstagramScraper(object):
         if self.latest is False or os.path.isfile(dst + '/' + item['urls'][0].split('/')[-1]) is False:
             for item in tqdm.tqdm([item], desc='Searching {0} for profile pic'.format(username), unit=" images",
                                   ncols=0, disable=self.quiet):
-                future = executor.submit(self.worker_wrapper, self.download, item, dst)
-                future_to_item[future] = item
+                self.submit_download(executor, future_to_item, self.download, item, dst)
 
     def get_profile_info(self, dst, username):
         if self.profile_metadata is False:
@@ -742,7 +1298,7 @@ class InstagramScraper(object):
 
         self.logger.info( 'Saving metadata general information on {0}.json'.format(username) )
 
-        user_info = json.loads(resp)['graphql']['user']
+        user_info = self.parse_json(resp)['graphql']['user']
 
         try:
             profile_info = {
@@ -768,7 +1324,7 @@ class InstagramScraper(object):
                 'created_time': 1286323200
             }
         }
-        self.save_json(item, '{0}/{1}.json'.format(dst, username))
+        self.save_json(item, '{0}/{1}.json'.format(dst, username), self.pretty_json)
 
     def get_stories(self, dst, executor, future_to_item, user, username):
         """Scrapes the user's stories."""
@@ -786,8 +1342,7 @@ class InstagramScraper(object):
                 if self.story_has_selected_media_types(item) and self.is_new_media(item):
                     item['username'] = username
                     item['shortcode'] = ''
-                    future = executor.submit(self.worker_wrapper, self.download, item, dst)
-                    future_to_item[future] = item
+                    self.submit_download(executor, future_to_item, self.download, item, dst)
 
                 iter = iter + 1
                 if self.maximum != 0 and iter >= self.maximum:
@@ -804,8 +1359,7 @@ class InstagramScraper(object):
             for item in tqdm.tqdm(broadcasts, desc='Searching {0} for broadcasts'.format(user['username']), unit=" media",
                                   disable=self.quiet):
                 item['username'] = user['username']
-                future = executor.submit(self.worker_wrapper, self.dowload_broadcast, item, dst)
-                future_to_item[future] = item
+                self.submit_download(executor, future_to_item, self.dowload_broadcast, item, dst)
 
                 iter = iter + 1
                 if self.maximum != 0 and iter >= self.maximum:
@@ -818,9 +1372,6 @@ class InstagramScraper(object):
 
         username = user['username']
 
-        if self.include_location:
-            media_exec = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-
         iter = 0
         for item in tqdm.tqdm(self.query_media_gen(user), desc='Searching {0} for posts'.format(username),
                               unit=' media', disable=self.quiet):
@@ -830,8 +1381,7 @@ class InstagramScraper(object):
                     filtered = any(x in item['tags'] for x in self.filter)
                     if self.has_selected_media_types(item) and self.is_new_media(item) and filtered:
                         item['username']=username
-                        future = executor.submit(self.worker_wrapper, self.download, item, dst)
-                        future_to_item[future] = item
+                        self.submit_download(executor, future_to_item, self.download, item, dst)
                 else:
                     # For when filter is on but media doesnt contain tags
                     pass
@@ -839,64 +1389,79 @@ class InstagramScraper(object):
             else:
                 if self.has_selected_media_types(item) and self.is_new_media(item):
                     item['username']=username
-                    future = executor.submit(self.worker_wrapper, self.download, item, dst)
-                    future_to_item[future] = item
+                    self.submit_download(executor, future_to_item, self.download, item, dst)
 
             if self.include_location:
                 item['username']=username
-                media_exec.submit(self.worker_wrapper, self.__get_location, item)
+                if 'location' not in item:
+                    self.location_stage.submit(self.worker_wrapper, self.__get_location, item)
 
             if self.comments:
                 item['username']=username
-                item['comments'] = {'data': list(self.query_comments_gen(item['shortcode']))}
+                item['comments'] = {'data': []}
+                self.comment_stage.submit(self.worker_wrapper, self.harvest_comments, item, item['comments'])
 
             if self.media_metadata or self.comments or self.include_location:
                 item['username']=username
-                self.posts.append(item)
+                self.add_post(item)
 
             iter = iter + 1
             if self.maximum != 0 and iter >= self.maximum:
                 break
 
     def get_shared_data_userinfo(self, username=''):
-        """Fetches the user's metadata."""
-        resp = self.get_json(BASE_URL + username)
+        """Fetches the user's metadata.
+
+        The profile page is read incrementally and the download stops as soon as
+        the embedded JSON holding the user is complete.
+        """
+        resp = self.safe_get(BASE_URL + username, stream=True)
 
         userinfo = None
 
         if resp is not None:
-            try:
-                if "window._sharedData = " in resp:
-                    shared_data = resp.split("window._sharedData = ")[1].split(";</script>")[0]
-                    if shared_data:
-                        userinfo = self.deep_get(json.loads(shared_data), 'entry_data.ProfilePage[0].graphql.user')
-
-                if "window.__additionalDataLoaded(" in resp and not userinfo:
-                    parameters = resp.split("window.__additionalDataLoaded(")[1].split(");</script>")[0]
-                    if parameters and "," in parameters:
-                        shared_data = parameters.split(",", 1)[1]
-                        if shared_data:
-                            userinfo = self.deep_get(json.loads(shared_data), 'graphql.user')
-            except (TypeError, KeyError, IndexError):
-                pass
+            with self._tracked(resp):
+                try:
+                    chunks = resp.iter_content(chunk_size=PROFILE_PAGE_CHUNK_SIZE)
+                    markers = [SHARED_DATA_MARKER, ADDITIONAL_DATA_MARKER]
+                    for marker, shared_data in iter_json_blobs(chunks, markers, MAX_PROFILE_PAGE_SIZE):
+                        if marker == SHARED_DATA_MARKER:
+                            userinfo = self.deep_get(self.parse_json(shared_data), 'entry_data.ProfilePage[0].graphql.user')
+                        else:
+                            userinfo = self.deep_get(self.parse_json(shared_data), 'graphql.user')
+
+                        if userinfo:
+                            break
+                except (TypeError, KeyError, IndexError):
+                    pass
+                except requests.exceptions.RequestException as e:
+                    self.logger.warning('Failed to read profile page of {0}: {1}'.format(username, repr(e)))
 
         return userinfo
 
     def __fetch_stories(self, url, fetching_highlights_metadata=False):
+        items = []
+        for reel_media in self.__fetch_reels(url, fetching_highlights_metadata) or []:
+            items.extend(reel_media['items'])
+            self.stories.extend(reel_media['items'])
+
+        return items
+
+    def __fetch_reels(self, url, fetching_highlights_metadata=False):
+        """Returns the reels with story urls set, or None if the request failed."""
         resp = self.get_json(url)
 
-        if resp is not None:
-            retval = json.loads(resp)
-            if retval['data'] and 'reels_media' in retval['data'] and len(retval['data']['reels_media']) > 0 and len(retval['data']['reels_media'][0]['items']) > 0:
-                items = []
+        if resp is None:
+            return None
 
-                for reel_media in retval['data']['reels_media']:
-                    items.extend([self.set_story_url(item) for item in reel_media['items']])
-                    for item in reel_media['items']:
-                        item['highlight'] = fetching_highlights_metadata
-                        self.stories.append(item)
+        retval = self.parse_json(resp)
+        if retval['data'] and 'reels_media' in retval['data'] and len(retval['data']['reels_media']) > 0 and len(retval['data']['reels_media'][0]['items']) > 0:
+            for reel_media in retval['data']['reels_media']:
+                for item in reel_media['items']:
+                    self.set_story_url(item)
+                    item['highlight'] = fetching_highlights_metadata
 
-                return items
+            return retval['data']['reels_media']
 
         return []
 
@@ -910,25 +1475,66 @@ class InstagramScraper(object):
         resp = self.get_json(HIGHLIGHT_STORIES_USER_ID_URL.format(user_id))
 
         if resp is not None:
-            retval = json.loads(resp)
+            retval = self.parse_json(resp)
 
             if retval['data'] and 'user' in retval['data'] and 'edge_highlight_reels' in retval['data']['user'] and \
                     'edges' in retval['data']['user']['edge_highlight_reels']:
-                higlight_stories_ids = [item['node']['id'] for item in
-                                        retval['data']['user']['edge_highlight_reels']['edges']]
+                highlights = [(str(item['node']['id']), item['node'].get('latest_reel_media')) for item in
+                              retval['data']['user']['edge_highlight_reels']['edges']]
+
+                # Highlights that did not change since they were cached are not fetched again
+                reels = {}
+                with self.highlight_lock:
+                    for reel_id, latest_reel_media in highlights:
+                        cached = self.highlight_cache.get(reel_id)
+                        if latest_reel_media and cached and cached[0] == latest_reel_media:
+                            reels[reel_id] = cached[1]
+                higlight_stories_ids = [reel_id for reel_id, _ in highlights if reel_id not in reels]
 
                 # Workaround for issue https://github.com/rarcega/instagram-scraper/issues/488
                 # __fetch_stories with count of ids more than 20 some times returns "Bad gateway" error.
                 # Instagram web site fetches by 3.
                 ids_chunks = [higlight_stories_ids[i:i + 3] for i in range(0, len(higlight_stories_ids), 3)]
 
+                if ids_chunks:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_HIGHLIGHTS) as executor:
+                        for chunk_reels in executor.map(self.__fetch_highlight_chunk, ids_chunks):
+                            for reel_media in chunk_reels:
+                                reel_id = str(reel_media.get('id', '')).replace('highlight:', '')
+                                reels.setdefault(reel_id, []).extend(reel_media['items'])
+
                 stories = []
+                with self.highlight_lock:
+                    for reel_id, latest_reel_media in highlights:
+                        items = reels.pop(reel_id, None)
+                        if items is None:
+                            continue
+                        stories.extend(items)
+                        if latest_reel_media:
+                            self.highlight_cache[reel_id] = (latest_reel_media, items)
+                            self.highlight_cache.move_to_end(reel_id)
+                    while len(self.highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+                        self.highlight_cache.popitem(last=False)
+                # Reels whose id does not match a highlight are kept, just not cached
+                for items in reels.values():
+                    stories.extend(items)
+
+                self.stories.extend(stories)
+                return stories
 
-                for ids_chunk in ids_chunks:
-                    stories.extend(self.__fetch_stories(HIGHLIGHT_STORIES_REEL_ID_URL.format('%22%2C%22'.join(str(x) for x in ids_chunk)), fetching_highlights_metadata=True))
+        return []
 
-                return stories
+    def __fetch_highlight_chunk(self, ids_chunk):
+        """Fetches the reels of a chunk of highlights, retrying the chunk if the request fails."""
+        url = HIGHLIGHT_STORIES_REEL_ID_URL.format('%22%2C%22'.join(str(x) for x in ids_chunk))
+        for attempt in range(HIGHLIGHT_CHUNK_RETRIES + 1):
+            if self.quit or (attempt and self.cancel_event.wait(RETRY_DELAY * attempt)):
+                break
+            reels = self.__fetch_reels(url, fetching_highlights_metadata=True)
+            if reels is not None:
+                return reels
 
+        self.logger.warning('Failed to fetch highlights {0}'.format(', '.join(ids_chunk)))
         return []
 
     def fetch_broadcasts(self, user_id):
@@ -938,7 +1544,7 @@ class InstagramScraper(object):
 
 
         if resp is not None:
-            retval = json.loads(resp)
+            retval = self.parse_json(resp)
 
 
             if 'post_live_item' not in retval:
@@ -953,8 +1559,11 @@ class InstagramScraper(object):
                 video_adaptation_set = dash_manifest.find('.//{0}Representation[@mimeType="video/mp4"]/..'.format(xmlns))
                 audio_adaptation_set = dash_manifest.find('.//{0}Representation[@mimeType="audio/mp4"]/..'.format(xmlns))
 
-                best_video_quality = (video_adaptation_set.get('maxWidth'), video_adaptation_set.get('maxHeight'))
-                video_element = video_adaptation_set.find('.//*[@width="{0}"][@height="{1}"]/{2}BaseURL'.format(best_video_quality[0], best_video_quality[1], xmlns))
+                representations = video_adaptation_set.findall('{0}Representation'.format(xmlns))
+                attributes = [representation.attrib for representation in representations]
+                best_video_quality = select_rendition(attributes, self.max_long_edge, self.max_bitrate,
+                                                      'width', 'height', 'bandwidth')
+                video_element = representations[attributes.index(best_video_quality)].find('{0}BaseURL'.format(xmlns))
                 video_url = video_element.text
 
                 audio_element = audio_adaptation_set.find('.//{0}BaseURL'.format(xmlns))
@@ -975,22 +1584,16 @@ class InstagramScraper(object):
 
     def query_media_gen(self, user, end_cursor=''):
         """Generator for media."""
-        media, end_cursor = self.__query_media(user['id'], end_cursor)
-
-        if media:
-            try:
-                while True:
-                    for item in media:
-                        if not self.is_new_media(item):
-                            return
-                        yield item
-
-                    if end_cursor:
-                        media, end_cursor = self.__query_media(user['id'], end_cursor)
-                    else:
+        try:
+            with contextlib.closing(self.paginate(lambda cursor: self.__query_media(user['id'], cursor), end_cursor,
+                                                  is_last_page=lambda items: not all(map(self.is_new_media, items)),
+                                                  limit=self.maximum)) as media:
+                for item in media:
+                    if not self.is_new_media(item):
                         return
-            except ValueError:
-                self.logger.exception('Failed to query media for user ' + user['username'])
+                    yield item
+        except ValueError:
+            self.logger.exception('Failed to query media for user ' + user['username'])
 
     def __query_media(self, id, end_cursor=''):
         params = QUERY_MEDIA_VARS.format(id, end_cursor)
@@ -999,7 +1602,7 @@ class InstagramScraper(object):
         resp = self.get_json(QUERY_MEDIA.format(params))
 
         if resp is not None:
-            payload = json.loads(resp)['data']['user']
+            payload = self.parse_json(resp)['data']['user']
 
             if payload:
                 container = payload['edge_owner_to_timeline_media']
@@ -1048,8 +1651,9 @@ class InstagramScraper(object):
 
         return False
 
-    def extract_tags(self, item):
-        """Extracts the hashtags from the caption text."""
+    @staticmethod
+    def get_caption_text(item):
+        """Returns the caption text of the item or an empty string."""
         caption_text = ''
         if 'caption' in item and item['caption']:
             if isinstance(item['caption'], dict):
@@ -1061,12 +1665,15 @@ class InstagramScraper(object):
             'edges']:
             caption_text = item['edge_media_to_caption']['edges'][0]['node']['text']
 
+        return caption_text
+
+    def extract_tags(self, item):
+        """Extracts the hashtags from the caption text."""
+        caption_text = self.get_caption_text(item)
+
         if caption_text:
             # include words and emojis
-            item['tags'] = re.findall(
-                r"(?<!&)#(\w+|(?:[\xA9\xAE\u203C\u2049\u2122\u2139\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u2388\u23CF\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB-\u25FE\u2600-\u2604\u260E\u2611\u2614\u2615\u2618\u261D\u2620\u2622\u2623\u2626\u262A\u262E\u262F\u2638-\u263A\u2648-\u2653\u2660\u2663\u2665\u2666\u2668\u267B\u267F\u2692-\u2694\u2696\u2697\u2699\u269B\u269C\u26A0\u26A1\u26AA\u26AB\u26B0\u26B1\u26BD\u26BE\u26C4\u26C5\u26C8\u26CE\u26CF\u26D1\u26D3\u26D4\u26E9\u26EA\u26F0-\u26F5\u26F7-\u26FA\u26FD\u2702\u2705\u2708-\u270D\u270F\u2712\u2714\u2716\u271D\u2721\u2728\u2733\u2734\u2744\u2747\u274C\u274E\u2753-\u2755\u2757\u2763\u2764\u2795-\u2797\u27A1\u27B0\u27BF\u2934\u2935\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55\u3030\u303D\u3297\u3299]|\uD83C[\uDC04\uDCCF\uDD70\uDD71\uDD7E\uDD7F\uDD8E\uDD91-\uDD9A\uDE01\uDE02\uDE1A\uDE2F\uDE32-\uDE3A\uDE50\uDE51\uDF00-\uDF21\uDF24-\uDF93\uDF96\uDF97\uDF99-\uDF9B\uDF9E-\uDFF0\uDFF3-\uDFF5\uDFF7-\uDFFF]|\uD83D[\uDC00-\uDCFD\uDCFF-\uDD3D\uDD49-\uDD4E\uDD50-\uDD67\uDD6F\uDD70\uDD73-\uDD79\uDD87\uDD8A-\uDD8D\uDD90\uDD95\uDD96\uDDA5\uDDA8\uDDB1\uDDB2\uDDBC\uDDC2-\uDDC4\uDDD1-\uDDD3\uDDDC-\uDDDE\uDDE1\uDDE3\uDDEF\uDDF3\uDDFA-\uDE4F\uDE80-\uDEC5\uDECB-\uDED0\uDEE0-\uDEE5\uDEE9\uDEEB\uDEEC\uDEF0\uDEF3]|\uD83E[\uDD10-\uDD18\uDD80-\uDD84\uDDC0]|(?:0\u20E3|1\u20E3|2\u20E3|3\u20E3|4\u20E3|5\u20E3|6\u20E3|7\u20E3|8\u20E3|9\u20E3|#\u20E3|\\*\u20E3|\uD83C(?:\uDDE6\uD83C(?:\uDDEB|\uDDFD|\uDDF1|\uDDF8|\uDDE9|\uDDF4|\uDDEE|\uDDF6|\uDDEC|\uDDF7|\uDDF2|\uDDFC|\uDDE8|\uDDFA|\uDDF9|\uDDFF|\uDDEA)|\uDDE7\uD83C(?:\uDDF8|\uDDED|\uDDE9|\uDDE7|\uDDFE|\uDDEA|\uDDFF|\uDDEF|\uDDF2|\uDDF9|\uDDF4|\uDDE6|\uDDFC|\uDDFB|\uDDF7|\uDDF3|\uDDEC|\uDDEB|\uDDEE|\uDDF6|\uDDF1)|\uDDE8\uD83C(?:\uDDF2|\uDDE6|\uDDFB|\uDDEB|\uDDF1|\uDDF3|\uDDFD|\uDDF5|\uDDE8|\uDDF4|\uDDEC|\uDDE9|\uDDF0|\uDDF7|\uDDEE|\uDDFA|\uDDFC|\uDDFE|\uDDFF|\uDDED)|\uDDE9\uD83C(?:\uDDFF|\uDDF0|\uDDEC|\uDDEF|\uDDF2|\uDDF4|\uDDEA)|\uDDEA\uD83C(?:\uDDE6|\uDDE8|\uDDEC|\uDDF7|\uDDEA|\uDDF9|\uDDFA|\uDDF8|\uDDED)|\uDDEB\uD83C(?:\uDDF0|\uDDF4|\uDDEF|\uDDEE|\uDDF7|\uDDF2)|\uDDEC\uD83C(?:\uDDF6|\uDDEB|\uDDE6|\uDDF2|\uDDEA|\uDDED|\uDDEE|\uDDF7|\uDDF1|\uDDE9|\uDDF5|\uDDFA|\uDDF9|\uDDEC|\uDDF3|\uDDFC|\uDDFE|\uDDF8|\uDDE7)|\uDDED\uD83C(?:\uDDF7|\uDDF9|\uDDF2|\uDDF3|\uDDF0|\uDDFA)|\uDDEE\uD83C(?:\uDDF4|\uDDE8|\uDDF8|\uDDF3|\uDDE9|\uDDF7|\uDDF6|\uDDEA|\uDDF2|\uDDF1|\uDDF9)|\uDDEF\uD83C(?:\uDDF2|\uDDF5|\uDDEA|\uDDF4)|\uDDF0\uD83C(?:\uDDED|\uDDFE|\uDDF2|\uDDFF|\uDDEA|\uDDEE|\uDDFC|\uDDEC|\uDDF5|\uDDF7|\uDDF3)|\uDDF1\uD83C(?:\uDDE6|\uDDFB|\uDDE7|\uDDF8|\uDDF7|\uDDFE|\uDDEE|\uDDF9|\uDDFA|\uDDF0|\uDDE8)|\uDDF2\uD83C(?:\uDDF4|\uDDF0|\uDDEC|\uDDFC|\uDDFE|\uDDFB|\uDDF1|\uDDF9|\uDDED|\uDDF6|\uDDF7|\uDDFA|\uDDFD|\uDDE9|\uDDE8|\uDDF3|\uDDEA|\uDDF8|\uDDE6|\uDDFF|\uDDF2|\uDDF5|\uDDEB)|\uDDF3\uD83C(?:\uDDE6|\uDDF7|\uDDF5|\uDDF1|\uDDE8|\uDDFF|\uDDEE|\uDDEA|\uDDEC|\uDDFA|\uDDEB|\uDDF4)|\uDDF4\uD83C\uDDF2|\uDDF5\uD83C(?:\uDDEB|\uDDF0|\uDDFC|\uDDF8|\uDDE6|\uDDEC|\uDDFE|\uDDEA|\uDDED|\uDDF3|\uDDF1|\uDDF9|\uDDF7|\uDDF2)|\uDDF6\uD83C\uDDE6|\uDDF7\uD83C(?:\uDDEA|\uDDF4|\uDDFA|\uDDFC|\uDDF8)|\uDDF8\uD83C(?:\uDDFB|\uDDF2|\uDDF9|\uDDE6|\uDDF3|\uDDE8|\uDDF1|\uDDEC|\uDDFD|\uDDF0|\uDDEE|\uDDE7|\uDDF4|\uDDF8|\uDDED|\uDDE9|\uDDF7|\uDDEF|\uDDFF|\uDDEA|\uDDFE)|\uDDF9\uD83C(?:\uDDE9|\uDDEB|\uDDFC|\uDDEF|\uDDFF|\uDDED|\uDDF1|\uDDEC|\uDDF0|\uDDF4|\uDDF9|\uDDE6|\uDDF3|\uDDF7|\uDDF2|\uDDE8|\uDDFB)|\uDDFA\uD83C(?:\uDDEC|\uDDE6|\uDDF8|\uDDFE|\uDDF2|\uDDFF)|\uDDFB\uD83C(?:\uDDEC|\uDDE8|\uDDEE|\uDDFA|\uDDE6|\uDDEA|\uDDF3)|\uDDFC\uD83C(?:\uDDF8|\uDDEB)|\uDDFD\uD83C\uDDF0|\uDDFE\uD83C(?:\uDDF9|\uDDEA)|\uDDFF\uD83C(?:\uDDE6|\uDDF2|\uDDFC))))[\ufe00-\ufe0f\u200d]?)+",
-                caption_text, re.UNICODE)
-            item['tags'] = list(set(item['tags']))
+            item['tags'] = find_tags(caption_text)
 
         return item
 
@@ -1080,13 +1687,20 @@ class InstagramScraper(object):
         #url = re.sub(r'/c\d{1,}.\d{1,}.\d{1,}.\d{1,}/', '/', url)
         return url
 
+    def get_image_url(self, item):
+        """Gets the url of the image rendition matching the max_long_edge target, or of the original image
+        if there is no target."""
+        if self.max_long_edge and item.get('display_resources'):
+            return select_rendition(item['display_resources'], self.max_long_edge)['src']
+        return self.get_original_image(item['display_url'])
+
     def set_story_url(self, item):
         """Sets the story url."""
         urls = []
         if 'video_resources' in item and item['video_resources']:
-            urls.append(item['video_resources'][-1]['src'])
+            urls.append(select_rendition(item['video_resources'], self.max_long_edge, self.max_bitrate)['src'])
         if 'display_resources' in item:
-            urls.append(item['display_resources'][-1]['src'])
+            urls.append(select_rendition(item['display_resources'], self.max_long_edge)['src'])
         item['urls'] = urls
         return item
 
@@ -1106,6 +1720,18 @@ class InstagramScraper(object):
             if not os.path.exists(os.path.dirname(file_path)):
                 self.make_dir(os.path.dirname(file_path))
 
+            if os.path.isfile(file_path + LINK_SUFFIX):
+                files_path.append(file_path + LINK_SUFFIX)
+                continue
+
+            if not os.path.isfile(file_path) and self.max_video_size and file_path.endswith('.mp4'):
+                size = self.probe_size(full_url)
+                if size is not None and size > self.max_video_size:
+                    self.logger.info('Video {0} is {1} bytes, saving a link instead of downloading it'.format(
+                        base_name, size))
+                    files_path.append(self.save_link(item, full_url, file_path))
+                    continue
+
             if not os.path.isfile(file_path):
                 headers = {'Host': urlparse(url).hostname}
 
@@ -1116,14 +1742,21 @@ class InstagramScraper(object):
                     try:
                         retry = 0
                         retry_delay = RETRY_DELAY
+                        failovers = 0
                         while (True):
                             if self.quit:
                                 return
+                            if self.deadline_exceeded():
+                                raise DeadlineExceeded('Deadline exceeded while downloading {0}'.format(url))
+                            proxy = self.choose_proxy(url)
                             try:
                                 downloaded_before = downloaded
                                 headers['Range'] = 'bytes={0}-'.format(downloaded_before)
 
-                                with self.session.get(url, cookies=self.cookies, headers=headers, stream=True, timeout=CONNECT_TIMEOUT) as response:
+                                with self.rate_control.limiter_for(url).slot(self.interrupted) as slot, \
+                                        self._tracked(self.session.get(url, cookies=self.cookies, headers=headers, stream=True, timeout=CONNECT_TIMEOUT,
+                                                                       proxies=self.proxy_kwargs(proxy))) as response:
+                                    slot.status = response.status_code
                                     if response.status_code == 404 or response.status_code == 410:
                                         #on 410 error see issue #343
                                         #instagram don't lie on this
@@ -1133,6 +1766,7 @@ class InstagramScraper(object):
                                         url = full_url
                                         continue
                                     response.raise_for_status()
+                                    self.proxy_succeeded(proxy, response)
 
                                     if response.status_code == 206:
                                         try:
@@ -1176,6 +1810,8 @@ class InstagramScraper(object):
                             # Please do not add os.remove here.
                             except (KeyboardInterrupt):
                                 raise
+                            except Interrupted:
+                                continue
                             except (requests.exceptions.RequestException, PartialContentException) as e:
                                 media = url
                                 if item['shortcode'] and item['shortcode'] != '':
@@ -1185,14 +1821,18 @@ class InstagramScraper(object):
                                     self.logger.warning('Continue after exception {0} on {1}'.format(repr(e), media))
                                     retry = 0 # the next fail will be first in a row with no data
                                     continue
-                                if retry < MAX_RETRIES:
+                                if self.proxy_failed(proxy, e) and failovers < MAX_PROXY_FAILOVERS:
+                                    self.logger.warning('Proxy {0} failed with {1}, switching proxy for {2}'.format(proxy, repr(e), media))
+                                    failovers += 1
+                                    continue
+                                if retry < self.max_retries:
                                     self.logger.warning('Retry after exception {0} on {1}'.format(repr(e), media))
-                                    self.sleep(retry_delay)
+                                    self.sleep(self._retry_sleep(retry_delay))
                                     retry_delay = min( 2 * retry_delay, MAX_RETRY_DELAY )
                                     retry = retry + 1
                                     continue
                                 else:
-                                    keep_trying = self._retry_prompt(media, repr(e))
+                                    keep_trying = self._on_retries_exhausted(media, repr(e))
                                     if keep_trying == True:
                                         retry = 0
                                         continue
@@ -1212,6 +1852,32 @@ class InstagramScraper(object):
 
         return files_path
 
+    def probe_size(self, url):
+        """Returns the size of the file at url found with a one byte range request, or None if it is unknown."""
+        proxy = self.choose_proxy(url)
+        headers = {'Host': urlparse(url).hostname, 'Range': 'bytes=0-0'}
+        try:
+            with self.rate_control.limiter_for(url).slot(self.interrupted) as slot, \
+                    self._tracked(self.session.get(url, cookies=self.cookies, headers=headers, stream=True,
+                                                   timeout=CONNECT_TIMEOUT, proxies=self.proxy_kwargs(proxy))) as response:
+                slot.status = response.status_code
+                if response.status_code == 206:
+                    return int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                if response.status_code == 200:
+                    return int(response.headers['Content-Length'])
+        except (requests.exceptions.RequestException, Interrupted, KeyError, ValueError):
+            pass
+
+    def save_link(self, item, url, file_path):
+        """Saves the media url to a link marker file in place of the media file."""
+        link_path = file_path + LINK_SUFFIX
+        with open(link_path, 'w') as f:
+            f.write(url)
+        timestamp = self.__get_timestamp(item)
+        file_time = int(timestamp if timestamp else time.time())
+        os.utime(link_path, (file_time, file_time))
+        return link_path
+
     def dowload_broadcast(self, item, save_dir='./'):
         tmp_item = {
             'urls': [item['video']],
@@ -1228,38 +1894,16 @@ class InstagramScraper(object):
         # There is only one item
         audio_item = self.download(tmp_item, save_dir)[0]
 
-        broadcast = mpe.VideoFileClip(video_item)
-        audio_background = mpe.AudioFileClip(audio_item)
-        broadcast = broadcast.set_audio(audio_background)
-        broadcast.write_videofile(broadcast.filename, logger=None)
-        broadcast.close()
-        audio_background.close()
-
-        # Remove audio
-        os.remove(audio_background.filename)
+        workers.run(mux_broadcast, video_item, audio_item)
 
     def templatefilename(self, item):
+        template = compile_template(self.template)
+        timestamp = self.__get_timestamp(item) if template.uses_time else 0
 
         for url in item['urls']:
             filename, extension = os.path.splitext(os.path.split(url.split('?')[0])[1])
             try:
-                template = self.template
-                template_values = {
-                                    'username' : item['username'],
-                                   'urlname': filename,
-                                    'shortcode': str(item['shortcode']),
-                                    'mediatype' : item['__typename'][5:],
-                                   'datetime': time.strftime('%Y%m%d %Hh%Mm%Ss',
-                                                             time.localtime(self.__get_timestamp(item))),
-                                   'date': time.strftime('%Y%m%d', time.localtime(self.__get_timestamp(item))),
-                                   'year': time.strftime('%Y', time.localtime(self.__get_timestamp(item))),
-                                   'month': time.strftime('%m', time.localtime(self.__get_timestamp(item))),
-                                   'day': time.strftime('%d', time.localtime(self.__get_timestamp(item))),
-                                   'h': time.strftime('%Hh', time.localtime(self.__get_timestamp(item))),
-                                   'm': time.strftime('%Mm', time.localtime(self.__get_timestamp(item))),
-                                   's': time.strftime('%Ss', time.localtime(self.__get_timestamp(item)))}
-
-                customfilename = str(template.format(**template_values) + extension)
+                customfilename = str(template.format(item, filename, timestamp) + extension)
                 yield url, customfilename
             except KeyError:
                 customfilename = str(filename + extension)
@@ -1293,7 +1937,7 @@ class InstagramScraper(object):
     @staticmethod
     def __search(query):
         resp = requests.get(SEARCH_URL.format(query))
-        return json.loads(resp.text)
+        return fastjson.loads(resp.content)
 
     def search_locations(self):
         query = ' '.join(self.usernames)
@@ -1317,16 +1961,16 @@ class InstagramScraper(object):
 
     def merge_json(self, data, dst='./'):
         if not os.path.exists(dst):
-            self.save_json(data, dst)
+            self.save_json(data, dst, self.pretty_json)
         if data:
             merged = data
             with open(dst, 'rb') as f:
                 key = list(merged.keys())[0]
-                file_data = json.load(codecs.getreader('utf-8')(f))
+                file_data = fastjson.load(f)
                 self.remove_duplicate_data(file_data[key])
                 if key in file_data:
                     merged[key] = file_data[key]
-            self.save_json(merged, dst)
+            self.save_json(merged, dst, self.pretty_json)
 
     @staticmethod
     def remove_duplicate_data(file_data):
@@ -1342,8 +1986,8 @@ class InstagramScraper(object):
                 unique_ids.add(id_)
 
     @staticmethod
-    def save_json(data, dst='./'):
-        """Saves the data to a json file."""
+    def save_json(data, dst='./', pretty=False):
+        """Saves the data to a json file, compact unless pretty printing is requested."""
         if not os.path.exists(os.path.dirname(dst)):
             os.makedirs(os.path.dirname(dst))
 
@@ -1351,26 +1995,88 @@ class InstagramScraper(object):
             output_list = {}
             if os.path.exists(dst):
                 with open(dst, "rb") as f:
-                    output_list.update(json.load(codecs.getreader('utf-8')(f)))
+                    output_list.update(fastjson.load(f))
 
             with open(dst, 'wb') as f:
                 output_list.update(data)
-                json.dump(output_list, codecs.getwriter('utf-8')(f), indent=4, sort_keys=True, ensure_ascii=False)
+                fastjson.dump(output_list, f, pretty=pretty)
+
+    def _start_metadata(self, dirname, filename):
+        """Prepares the spool file for the posts metadata of the account, dropping one left by an interrupted run."""
+        self.spool_path = '{0}/{1}.json.spool'.format(dirname, filename)
+        if os.path.isfile(self.spool_path):
+            os.remove(self.spool_path)
+
+    def add_post(self, item):
+        """Keeps the post for the metadata file. Every METADATA_BATCH_SIZE posts are spooled to disk."""
+        self.posts.append(item)
+        if len(self.posts) >= METADATA_BATCH_SIZE and self.spool_path:
+            self._spool_posts()
+
+    def _spool_posts(self):
+        self.wait_enrichment()
+        if not os.path.exists(os.path.dirname(self.spool_path)):
+            os.makedirs(os.path.dirname(self.spool_path))
+        with open(self.spool_path, 'ab') as f:
+            for post in self.posts:
+                f.write(fastjson.dumps(post) + b'\n')
+        self.posts = []
+
+    def _iter_spool(self):
+        with open(self.spool_path, 'rb') as f:
+            for line in f:
+                yield fastjson.loads(line)
+
+    def _write_spooled_metadata(self, metadata_path):
+        """Writes the metadata file streaming the spooled posts instead of holding them in memory.
+
+        In latest mode the posts already in the file follow the new ones, duplicates are skipped by id.
+        Otherwise the file is replaced, like save_json does for unspooled metadata.
+        """
+        data = {}
+        if self.latest and os.path.exists(metadata_path):
+            with open(metadata_path, 'rb') as f:
+                data = fastjson.load(f)
+        old_posts = data.pop('GraphImages', [])
+        if self.stories:
+            data['GraphStories'] = self.stories + (data.get('GraphStories', []) if self.latest else [])
+
+        tmp_path = metadata_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b'{')
+            for key, value in data.items():
+                f.write(fastjson.dumps(key) + b':' + fastjson.dumps(value, pretty=self.pretty_json) + b',')
+            f.write(b'"GraphImages":[')
+            seen = set()
+            for post in itertools.chain(self._iter_spool(), self.posts, old_posts):
+                if post.get('id') in seen:
+                    continue
+                if seen:
+                    f.write(b',\n' if self.pretty_json else b',')
+                seen.add(post.get('id'))
+                f.write(fastjson.dumps(post, pretty=self.pretty_json))
+            f.write(b']}')
+        os.replace(tmp_path, metadata_path)
+        os.remove(self.spool_path)
 
     def _persist_metadata(self, dirname, filename):
+        self.wait_enrichment()
         metadata_path = '{0}/{1}.json'.format(dirname, filename)
+        if self.spool_path and os.path.isfile(self.spool_path):
+            self._write_spooled_metadata(metadata_path)
+            return
         if (self.media_metadata or self.comments or self.include_location):
             if self.posts:
                 if self.latest:
                     self.merge_json({'GraphImages': self.posts}, metadata_path)
                 else:
-                    self.save_json({'GraphImages': self.posts}, metadata_path)
+                    self.save_json({'GraphImages': self.posts}, metadata_path, self.pretty_json)
 
             if self.stories:
                 if self.latest:
                     self.merge_json({'GraphStories': self.stories}, metadata_path)
                 else:
-                    self.save_json({'GraphStories': self.stories}, metadata_path)
+                    self.save_json({'GraphStories': self.stories}, metadata_path, self.pretty_json)
 
     @staticmethod
     def get_logger(level=logging.DEBUG, dest='', verbose=0):
@@ -1447,35 +2153,38 @@ class InstagramScraper(object):
         return re.findall(r'[^,;\s]+', input)
 
     def deep_get(self, dict, path):
-        def _split_indexes(key):
-            split_array_index = re.compile(r'[.\[\]]+')  # ['foo', '0']
-            return filter(None, split_array_index.split(key))
-
-        ends_with_index = re.compile(r'\[(.*?)\]$')  # foo[0]
+        return deep_get(dict, path)
 
-        keylist = path.split('.')
-
-        val = dict
-
-        for key in keylist:
-            try:
-                if ends_with_index.search(key):
-                    for prop in _split_indexes(key):
-                        if prop.isdigit():
-                            val = val[int(prop)]
-                        else:
-                            val = val[prop]
-                else:
-                    val = val[key]
-            except (KeyError, IndexError, TypeError):
-                return None
+    def load_cookies(self):
+        if not self.cookiejar or not os.path.exists(self.cookiejar):
+            return
+        try:
+            with open(self.cookiejar, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            self.logger.warning('Failed to load cookies from {0}: {1}'.format(self.cookiejar, e))
+            return
 
-        return val
+        # Older cookiejars contain the bare cookie jar
+        if isinstance(state, dict):
+            self.session.cookies.update(state['cookies'])
+            if state.get('csrftoken'):
+                self.session.headers.update({'X-CSRFToken': state['csrftoken']})
+        else:
+            self.session.cookies.update(state)
 
     def save_cookies(self):
+        """Atomically stores the session cookies and the CSRF token in the cookiejar."""
         if self.cookiejar:
-            with open(self.cookiejar, 'wb') as f:
-                pickle.dump(self.session.cookies, f)
+            state = {'cookies': self.session.cookies,
+                     'csrftoken': self.session.headers.get('X-CSRFToken')}
+            tmp_path = self.cookiejar + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(state, f)
+                os.replace(tmp_path, self.cookiejar)
+            except OSError as e:
+                self.logger.warning('Failed to save cookies to {0}: {1}'.format(self.cookiejar, e))
 
 
 
@@ -1551,13 +2260,31 @@ def main():
     parser.add_argument('--location', action='store_true', default=False, help='Scrape media using a location-id')
     parser.add_argument('--search-location', action='store_true', default=False, help='Search for locations by name')
     parser.add_argument('--comments', action='store_true', default=False, help='Save post comments to json file')
+    parser.add_argument('--max-comment-pages', '--max_comment_pages', type=int, default=MAX_COMMENT_PAGES,
+                        help='Maximum number of comment pages fetched per post, 0 for unlimited')
     parser.add_argument('--no-check-certificate', action='store_true', default=False, help='Do not use ssl on transaction')
     parser.add_argument('--interactive', '-i', action='store_true', default=False,
                         help='Enable interactive login challenge solving')
     parser.add_argument('--retry-forever', action='store_true', default=False,
                         help='Retry download attempts endlessly when errors are received')
+    parser.add_argument('--retry-policy', '--retry_policy', choices=['prompt', 'ignore', 'abort'], default='prompt',
+                        help='What to do when retries are exhausted: ask the user, skip the media or abort')
+    parser.add_argument('--max-retries', '--max_retries', type=int, default=MAX_RETRIES,
+                        help='Maximum number of retries for a single request')
+    parser.add_argument('--account-budget', '--account_budget', type=int, default=0,
+                        help='Time budget in seconds for scraping a single account, 0 for unlimited')
+    parser.add_argument('--cycle-deadline', '--cycle_deadline', type=int, default=0,
+                        help='Deadline in seconds for the whole scrape, 0 for unlimited')
+    parser.add_argument('--max-long-edge', '--max_long_edge', type=int, default=0,
+                        help='Download the smallest rendition whose long edge is at least this many pixels, 0 for the largest')
+    parser.add_argument('--max-bitrate', '--max_bitrate', type=int, default=0,
+                        help='Skip video renditions above this bitrate in bits per second when possible, 0 for unlimited')
+    parser.add_argument('--prefetch-pages', '--prefetch_pages', type=int, default=1,
+                        help='Number of result pages requested ahead while the current one is processed, 0 to disable')
     parser.add_argument('--verbose', '-v', type=int, default=0, help='Logging verbosity level')
     parser.add_argument('--template', '-T', type=str, default='{urlname}', help='Customize filename template')
+    parser.add_argument('--pretty-json', '--pretty_json', action='store_true', default=False,
+                        help='Indent and sort keys in saved json files')
     parser.add_argument('--log_destination', '-l', type=str, default='', help='destination folder for the instagram-scraper.log file')
 
     args = parser.parse_args()
@@ -1602,15 +2329,15 @@ def main():
         args.media_types = InstagramScraper.parse_delimited_str(args.media_types[0])
 
     if args.retry_forever:
-        global MAX_RETRIES
-        MAX_RETRIES = sys.maxsize
+        args.max_retries = sys.maxsize
+
+    # A session stored in a cookiejar is reused by the next run, so it must not be logged out
+    if args.cookiejar:
+        args.keep_session = True
 
     scraper = InstagramScraper(**vars(args))
 
-    if args.login_user and args.login_pass:
-        scraper.authenticate_with_login()
-    else:
-        scraper.authenticate_as_guest()
+    scraper.authenticate()
 
     if args.followings_input:
         scraper.usernames = list(scraper.query_followings_gen(scraper.login_user))
@@ -1634,11 +2361,127 @@ def main():
 
     scraper.save_cookies()
 
-def execute(maximum=MEDIA_LIMIT, latest=True):
+active_scrapers = set()
+
+def cancel():
+    """Cancels all running scrapes."""
+    for scraper in list(active_scrapers):
+        scraper.cancel()
+
+class LoginIdentity(object):
+    """One Instagram login with its own cookiejar, session and rate limits."""
+
+    def __init__(self, login, password, cookiejar):
+        self.login = login
+        self.password = password
+        self.cookiejar = cookiejar
+        self.scraper = None
+        self.blocked_until = 0
+
+    def __repr__(self):
+        return self.login or 'guest'
+
+
+class LoginPool(object):
+    """Shards the monitored accounts across several Instagram logins.
+
+    Every login scrapes its own shard in a separate thread. When Instagram challenges or
+    rate limits a login, the accounts it has not finished are handed over to the other logins
+    and the blocked login rests until its rate limits lift, or for LOGIN_COOLDOWN seconds if the
+    login itself was rejected.
+    """
+
+    def __init__(self, credentials):
+        self.identities = [LoginIdentity(**c) for c in credentials]
+        # CDN limits and breakers apply to all logins together
+        self.shared_limiters = RateController.shared_limiters(RATE_LIMITS)
+
+    def available(self):
+        now = time.monotonic()
+        return [identity for identity in self.identities if identity.blocked_until <= now]
+
+    @staticmethod
+    def shard(usernames, identities):
+        return {identity: usernames[i::len(identities)] for i, identity in enumerate(identities)
+                if usernames[i::len(identities)]}
+
+    def scrape_shard(self, identity, usernames, args, persistent, cycle_deadline_at=None):
+        """Scrapes the usernames with the login and returns the usernames it has finished."""
+        if persistent and identity.scraper is not None:
+            scraper = identity.scraper
+            scraper.configure(usernames=usernames, maximum=args['maximum'], latest=args['latest'])
+        else:
+            scraper = InstagramScraper(**dict(args, usernames=usernames, login_user=identity.login,
+                                              login_pass=identity.password, cookiejar=identity.cookiejar,
+                                              yield_when_blocked=len(self.identities) > 1,
+                                              shared_limiters=self.shared_limiters))
+
+        active_scrapers.add(scraper)
+        try:
+            if not scraper.authenticated:
+                scraper.authenticate()
+
+            if identity.login and not scraper.logged_in:
+                scraper.login_blocked = True
+                return []
+
+            scraper.scrape(cycle_deadline_at=cycle_deadline_at)
+
+            scraper.save_cookies()
+        finally:
+            active_scrapers.discard(scraper)
+            identity.scraper = scraper if persistent else None
+            if scraper.identity_blocked():
+                identity.blocked_until = scraper.identity_blocked_until()
+
+        return scraper.finished_usernames
+
+    def scrape(self, usernames, args, persistent):
+        # Shards handed over to other logins share the deadline of the cycle
+        cycle_deadline_at = time.monotonic() + args['cycle_deadline'] if args.get('cycle_deadline') else None
+        pending = list(usernames)
+        while pending:
+            if cycle_deadline_at is not None and time.monotonic() >= cycle_deadline_at:
+                logging.warning('Время цикла истекло. '
+                                + f'Аккаунты {", ".join(pending)} будут обработаны в следующем цикле.')
+                return
+
+            identities = self.available()
+            if not identities:
+                logging.warning('Все учётные записи Instagram временно заблокированы. '
+                                + f'Аккаунты {", ".join(pending)} будут обработаны в следующем цикле.')
+                return
+
+            shards = self.shard(pending, identities)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                futures = {executor.submit(self.scrape_shard, identity, shard, args, persistent,
+                                           cycle_deadline_at): identity
+                           for identity, shard in shards.items()}
+
+            pending = []
+            for future, identity in futures.items():
+                finished = future.result()
+                left = [username for username in shards[identity] if username not in finished]
+                # Accounts not finished for other reasons (deadline, cancellation) wait for the next cycle
+                if left and identity.blocked_until > time.monotonic():
+                    logging.warning(f'Учётная запись {identity} заблокирована Instagram. '
+                                    + f'Аккаунты {", ".join(left)} передаются другим учётным записям.')
+                    pending.extend(left)
+
+
+# Login pool kept alive between cycles in the persistent session mode
+login_pool = None
+
+def execute(maximum=MEDIA_LIMIT, latest=True, persistent=False):
+    """Scrapes all configured Instagram accounts.
+
+    The accounts are sharded across all configured Instagram logins. With persistent=True the
+    authenticated scrapers are kept between calls: their sessions and connections are reused
+    and they log in again only when Instagram rejects the session.
+    """
+    global login_pool
+
     args = {
-        'usernames': INSTAGRAM_USER_NAMES,
-        'login_user': LOGIN,
-        'login_pass': PASSWORD,
         'destination': TEMP_FOLDER,
         'logger': logging.getLogger(),
         'retain_username': True,
@@ -1646,31 +2489,39 @@ def execute(maximum=MEDIA_LIMIT, latest=True):
         'maximum': maximum,
         'media_metadata': True,
         'latest': latest,
-        'cookiejar': COOKIEJAR,
         'media_types': ['image', 'video', 'broadcast'],
         'template': '{shortcode}.{urlname}',
+        'retry_policy': RETRY_POLICY,
+        'max_retries': MAX_REQUEST_RETRIES,
+        'account_budget': ACCOUNT_BUDGET,
+        'cycle_deadline': CYCLE_DEADLINE,
+        # Сессия, сохранённая в файле cookie, используется при следующем
+        # запуске, поэтому выход из аккаунта не выполняется
+        'keep_session': persistent or bool(COOKIEJAR),
+        # Размер видео проверяется до скачивания
+        'max_video_size': MAX_VIDEO_DOWNLOAD_SIZE,
+        'max_long_edge': MAX_LONG_EDGE,
+        'max_bitrate': MAX_BITRATE,
+        'prefetch_pages': PAGINATION_PREFETCH,
 
         # Пример подключения прокси:
         # 'proxies': '{"https": "https://162.144.34.109:3838"}',
     }
 
     if USE_PROXY:
-        proxy = proxy_finder.get_random_proxy()
-        if proxy:
-            args['proxies'] = f'{{"https": "{proxy}"}}'
-        else:
+        # Прокси выбирается из пула для каждого запроса
+        args['proxy_pool'] = proxy_finder.pool
+        args['proxy_pinning'] = PROXY_PINNING
+        # Выбор прокси не ждёт обновления пула; ожидание возможно только при
+        # первом заполнении пула без фонового потока
+        proxy_finder.pool.prepare()
+        if not proxy_finder.pool.proxies():
             logging.warning('Не удалось получить доступ к прокси-серверу.')
 
-    scraper = InstagramScraper(**args)
+    pool = login_pool if persistent and login_pool is not None else LoginPool(INSTAGRAM_LOGINS)
+    pool.scrape(INSTAGRAM_USER_NAMES, args, persistent)
 
-    if args['login_user'] and args['login_pass']:
-        scraper.authenticate_with_login()
-    else:
-        scraper.authenticate_as_guest()
-
-    scraper.scrape()
-
-    scraper.save_cookies()
+    login_pool = pool if persistent else None
 
 if __name__ == '__main__':
     main()
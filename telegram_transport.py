@@ -0,0 +1,185 @@
+"""В данном модуле настраивается HTTP-транспорт библиотеки pyTelegramBotAPI:
+
+- общая для всех ботов и потоков сессия requests с пулом постоянных
+  (keep-alive) соединений к api.telegram.org;
+- потоковая отправка файлов: тело multipart-запроса формируется по мере
+  передачи, файлы читаются с диска блоками и не загружаются в память целиком;
+- сбор статистики по каждому вызову Bot API: время выполнения, объём
+  отправленных данных и класс ошибки.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import guess_filename
+from telebot import apihelper
+
+# Количество постоянных соединений в пуле
+POOL_SIZE = 10
+
+# Размер блока чтения файла при отправке (байты)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class MultipartStream:
+    """Тело запроса multipart/form-data, формируемое при чтении. Размер тела
+    известен заранее, поэтому запрос отправляется с заголовком
+    Content-Length, а не блоками (chunked).
+    """
+    def __init__(self, files: dict):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        self.length = 0
+
+        for name, value in files.items():
+            if isinstance(value, (tuple, list)):
+                filename, file = value[0], value[1]
+                content_type = value[2] if len(value) > 2 else None
+            else:
+                filename, file, content_type = None, value, None
+            filename = os.path.basename(filename or guess_filename(file)
+                                        or name)
+
+            header = (f'--{self.boundary}\r\n'
+                      + 'Content-Disposition: form-data; '
+                      + f'name="{self._quote(name)}"; '
+                      + f'filename="{self._quote(filename)}"\r\n'
+                      + 'Content-Type: '
+                      + f'{content_type or "application/octet-stream"}'
+                      + '\r\n\r\n').encode('utf-8')
+            self._add(header)
+            if isinstance(file, str):
+                file = file.encode('utf-8')
+            self._add(file)
+            self._add(b'\r\n')
+
+        self._add(f'--{self.boundary}--\r\n'.encode('utf-8'))
+        self.current = 0
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '%22')
+
+    def _add(self, part):
+        if isinstance(part, (bytes, bytearray)):
+            size = len(part)
+        else:
+            position = part.tell()
+            part.seek(0, os.SEEK_END)
+            size = part.tell() - position
+            part.seek(position)
+        self.parts.append(part)
+        self.length += size
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and self.current < len(self.parts):
+            part = self.parts[self.current]
+            if isinstance(part, (bytes, bytearray)):
+                chunk = bytes(part[:size])
+                self.parts[self.current] = part[size:]
+            else:
+                chunk = part.read(min(size, UPLOAD_CHUNK_SIZE))
+            if chunk:
+                chunks.append(chunk)
+                size -= len(chunk)
+            else:
+                self.current += 1
+        return b''.join(chunks)
+
+class TransportStats:
+    """Статистика вызовов Bot API по методам."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(int)
+            self.seconds = defaultdict(float)
+            self.sent = defaultdict(int)
+            self.errors = defaultdict(int)
+
+    def record(self, method: str, seconds: float, sent: int, error: str):
+        with self.lock:
+            self.calls[method] += 1
+            self.seconds[method] += seconds
+            self.sent[method] += sent
+            if error:
+                self.errors[(method, error)] += 1
+
+    def log_summary(self):
+        """Выводит в журнал сводку по вызовам Bot API и сбрасывает её."""
+        with self.lock:
+            for method, calls in sorted(self.calls.items()):
+                seconds = self.seconds[method]
+                speed = self.sent[method] / seconds / 1024 if seconds else 0
+                errors = ', '.join(f'{error}: {count}' for (name, error), count
+                                   in sorted(self.errors.items())
+                                   if name == method)
+                logging.info(f'Telegram {method}: вызовов {calls}, '
+                             + f'среднее время {seconds / calls:.2f} с, '
+                             + f'отправлено {self.sent[method] / 1024:.0f} '
+                             + f'КБ ({speed:.0f} КБ/с)'
+                             + (f', ошибки: {errors}' if errors else ''))
+        self.reset()
+
+stats = TransportStats()
+
+class TelemetryAdapter(HTTPAdapter):
+    """Адаптер, измеряющий время выполнения и объём каждого запроса."""
+    def send(self, request, **kwargs):
+        method = request.path_url.split('?')[0].rsplit('/', 1)[-1]
+        sent = int(request.headers.get('Content-Length') or 0)
+        started = time.monotonic()
+        error = None
+        try:
+            response = super().send(request, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        else:
+            if response.status_code >= 400:
+                error = f'HTTP {response.status_code}'
+            return response
+        finally:
+            stats.record(method, time.monotonic() - started, sent, error)
+
+class TelegramSession(requests.Session):
+    """Сессия, отправляющая файлы потоком без буферизации в памяти."""
+    def request(self, method, url, files=None, headers=None, **kwargs):
+        if files:
+            body = MultipartStream(files)
+            kwargs['data'] = body
+            headers = dict(headers or {}, **{'Content-Type':
+                                             body.content_type})
+        return super().request(method, url, headers=headers, **kwargs)
+
+def install(pool_size: int = POOL_SIZE, api_url: str = None):
+    """Подключает общую сессию с пулом соединений и сбором статистики ко
+    всем ботам pyTelegramBotAPI. Если указан api_url, запросы направляются
+    на локальный сервер Bot API вместо api.telegram.org.
+    """
+    if api_url:
+        apihelper.API_URL = api_url + '/bot{0}/{1}'
+        apihelper.FILE_URL = api_url + '/file/bot{0}/{1}'
+
+    session = TelegramSession()
+    adapter = TelemetryAdapter(pool_connections=pool_size,
+                               pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    apihelper.session = session
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Модули проекта лежат в корне репозитория; config.ini читается из текущей
+# папки, поэтому тесты запускаются из корня: python -m pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,129 @@
+"""Отправка файлов через локальный сервер Bot API: вместо сервера
+используется HTTP-сервер на localhost, записывающий полученные запросы.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+from telebot import apihelper
+
+import bot
+import telegram_transport
+from bot_pool import BotPool
+from media_tools import MAX_PHOTO_SIZE
+
+class BotApiStub(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.path, self.headers.get('Content-Type'),
+                                     body))
+        payload = json.dumps({'ok': True, 'result': {
+            'message_id': 1, 'date': 0,
+            'chat': {'id': 1, 'type': 'private'}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_file(path: str, size: int):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+class LocalBotApiTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BotApiStub)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        api_url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+        self.temp_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_folder, 'user'))
+
+        api_urls = (apihelper.API_URL, apihelper.FILE_URL, apihelper.session)
+        telegram_transport.install(api_url=api_url)
+        self.addCleanup(self._restore_apihelper, api_urls)
+
+        for name, value in (('BOT_API_URL', api_url),
+                            ('TEMP_FOLDER', self.temp_folder),
+                            ('BOT_API_TEMP_FOLDER', '/srv/bot-api/temp'),
+                            ('TELEGRAM_CHAT_IDS', {'user': [1]}),
+                            ('bots', BotPool(['1:token'], 0))):
+            patcher = mock.patch.object(bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_folder)
+
+    @staticmethod
+    def _restore_apihelper(api_urls):
+        apihelper.API_URL, apihelper.FILE_URL, apihelper.session = api_urls
+
+    def test_photo_sent_as_file_url(self):
+        path = os.path.join(self.temp_folder, 'user', 'a.1.jpg')
+        make_file(path, 1024)
+
+        self.assertTrue(bot.send_photo(path, 'caption', 'user'))
+
+        [(url, content_type, body)] = self.server.requests
+        url = urlsplit(url)
+        self.assertTrue(url.path.endswith('/sendPhoto'))
+        # Файл не загружается: серверу передаётся только ссылка на него
+        self.assertNotIn('multipart', content_type or '')
+        self.assertEqual(body, b'')
+        self.assertEqual(parse_qs(url.query)['photo'],
+                         ['file:///srv/bot-api/temp/user/a.1.jpg'])
+
+    def test_video_above_bot_api_limit_sent(self):
+        path = os.path.join(self.temp_folder, 'user', 'a.1.mp4')
+        make_file(path, bot.MAX_UPLOAD_SIZE + 1)
+
+        self.assertFalse(bot.exceeds_upload_limit(path))
+        self.assertTrue(bot.send_video(path, 'caption', 'user'))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_photo_above_photo_limit_not_sent(self):
+        path = os.path.join(self.temp_folder, 'user', 'a.1.jpg')
+        make_file(path, MAX_PHOTO_SIZE + 1)
+
+        self.assertTrue(bot.exceeds_upload_limit(path))
+        self.assertFalse(bot.send_photo(path, 'caption', 'user'))
+        self.assertEqual(self.server.requests, [])
+
+class UploadLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_folder)
+        patcher = mock.patch.object(bot, 'BOT_API_URL', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_limits_without_local_server(self):
+        video = os.path.join(self.temp_folder, 'a.1.mp4')
+        make_file(video, bot.MAX_UPLOAD_SIZE + 1)
+        photo = os.path.join(self.temp_folder, 'a.1.jpg')
+        make_file(photo, MAX_PHOTO_SIZE)
+
+        self.assertTrue(bot.exceeds_upload_limit(video))
+        self.assertFalse(bot.exceeds_upload_limit(photo))
+
+    def test_upload_source_is_file(self):
+        path = os.path.join(self.temp_folder, 'a.1.jpg')
+        make_file(path, 1)
+        with open(path, 'rb') as f:
+            self.assertIs(bot.get_upload_source(f), f)
+
+if __name__ == '__main__':
+    unittest.main()
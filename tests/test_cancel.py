@@ -0,0 +1,36 @@
+import gc
+import threading
+import unittest
+import weakref
+
+from test_paginate import make_scraper
+
+class CancelTest(unittest.TestCase):
+    def test_cancel_while_lock_held(self):
+        # Обработчик сигнала может прервать основной поток внутри _tracked
+        scraper = make_scraper(0)
+        aborted = []
+        scraper._abort_response = aborted.append
+        scraper._active_responses.add('response')
+
+        with scraper._responses_lock:
+            scraper.cancel()
+
+        self.assertTrue(scraper.quit)
+        self.assertEqual(aborted, ['response'])
+
+    def test_scrapers_do_not_leak_threads(self):
+        threads = threading.active_count()
+        refs = []
+        for _ in range(5):
+            scraper = make_scraper(0)
+            scraper.cancel()
+            refs.append(weakref.ref(scraper))
+        del scraper
+        gc.collect()
+
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual([ref() for ref in refs], [None] * 5)
+
+if __name__ == '__main__':
+    unittest.main()
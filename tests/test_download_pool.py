@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+from concurrent.futures import as_completed
+
+from download_pool import PriorityThreadPool, Stage
+
+class PriorityThreadPoolTest(unittest.TestCase):
+    def test_longest_job_first(self):
+        pool = PriorityThreadPool(max_workers=1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        pool.submit(blocker)
+        started.wait(5)
+        # Пока поток занят, задачи копятся в очереди
+        for priority, name in ((1, 'small'), (3, 'large'), (2, 'medium'),
+                               (3, 'large2')):
+            pool.submit_priority(priority, order.append, name)
+        release.set()
+        pool.shutdown(wait=True)
+
+        self.assertEqual(order, ['large', 'large2', 'medium', 'small'])
+
+    def test_results_and_exceptions(self):
+        pool = PriorityThreadPool(max_workers=2)
+        ok = pool.submit(lambda x: x * 2, 21)
+        failed = pool.submit(lambda: 1 / 0)
+
+        self.assertEqual(len(list(as_completed([ok, failed], timeout=5))), 2)
+        self.assertEqual(ok.result(), 42)
+        self.assertIsInstance(failed.exception(), ZeroDivisionError)
+        pool.shutdown()
+
+    def test_bounded_queue_blocks_submit(self):
+        pool = PriorityThreadPool(max_workers=1, max_pending=1)
+        release = threading.Event()
+        pool.submit(release.wait, 5)
+        time.sleep(0.1)
+        pool.submit(lambda: None)
+
+        submitted = threading.Event()
+        def submit():
+            pool.submit(lambda: None)
+            submitted.set()
+        threading.Thread(target=submit, daemon=True).start()
+
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        pool.shutdown()
+
+    def test_shutdown_cancels_pending(self):
+        pool = PriorityThreadPool(max_workers=1)
+        release = threading.Event()
+        running = pool.submit(release.wait, 5)
+        time.sleep(0.1)
+        pending = pool.submit(lambda: None)
+
+        pool.shutdown(wait=False, cancel_futures=True)
+        release.set()
+
+        self.assertTrue(pending.cancelled())
+        self.assertTrue(running.result(5))
+        with self.assertRaises(RuntimeError):
+            pool.submit(lambda: None)
+
+class StageTest(unittest.TestCase):
+    def test_wait_returns_errors_once(self):
+        stage = Stage(max_workers=2)
+        done = []
+        for i in range(5):
+            stage.submit(lambda i=i: (time.sleep(0.01), done.append(i)))
+        stage.submit(lambda: 1 / 0)
+
+        errors = stage.wait()
+        self.assertEqual(sorted(done), list(range(5)))
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+        self.assertEqual(stage.wait(), [])
+        stage.shutdown()
+
+    def test_shutdown_without_wait_cancels_queued(self):
+        stage = Stage(max_workers=1)
+        release = threading.Event()
+        stage.submit(release.wait, 5)
+        time.sleep(0.1)
+        queued = stage.submit(lambda: None)
+
+        stage.shutdown(wait=False)
+        release.set()
+
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(stage.wait(), [])
+
+if __name__ == '__main__':
+    unittest.main()
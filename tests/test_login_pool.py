@@ -0,0 +1,51 @@
+import time
+import unittest
+
+from scraper import LoginPool
+from test_paginate import make_scraper
+
+class LoginPoolDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = LoginPool([{'login': 'a', 'password': 'p', 'cookiejar': None},
+                               {'login': 'b', 'password': 'p', 'cookiejar': None}])
+        self.calls = []
+
+    def test_handed_over_shards_share_cycle_deadline(self):
+        def scrape_shard(identity, usernames, args, persistent, cycle_deadline_at=None):
+            self.calls.append((identity.login, list(usernames), cycle_deadline_at))
+            if identity.login == 'a':
+                identity.blocked_until = time.monotonic() + 60
+                return []
+            return usernames
+
+        self.pool.scrape_shard = scrape_shard
+        self.pool.scrape(['u1', 'u2'], {'cycle_deadline': 600}, False)
+
+        self.assertEqual([(login, usernames) for login, usernames, _ in self.calls],
+                         [('a', ['u1']), ('b', ['u2']), ('b', ['u1'])])
+        deadlines = {deadline for _, _, deadline in self.calls}
+        self.assertEqual(len(deadlines), 1)
+        self.assertIsNotNone(deadlines.pop())
+
+    def test_no_handover_after_deadline(self):
+        def scrape_shard(identity, usernames, args, persistent, cycle_deadline_at=None):
+            self.calls.append(identity.login)
+            identity.blocked_until = time.monotonic() + 60 if identity.login == 'a' else 0
+            time.sleep(0.05)
+            return [] if identity.login == 'a' else usernames
+
+        self.pool.scrape_shard = scrape_shard
+        self.pool.scrape(['u1', 'u2'], {'cycle_deadline': 0.01}, False)
+
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+
+    def test_start_cycle_joins_running_cycle(self):
+        scraper = make_scraper(0)
+        scraper.cycle_deadline = 600
+        deadline_at = time.monotonic() + 5
+        scraper.start_cycle(deadline_at)
+        self.assertEqual(scraper.cycle_deadline_at, deadline_at)
+        scraper._disarm_deadline_timer()
+
+if __name__ == '__main__':
+    unittest.main()
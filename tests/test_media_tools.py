@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import media_tools
+from media_tools import MAX_PHOTO_SIDE, fit_photo
+
+class FitPhotoTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache_dir = os.path.join(self.folder, 'cache')
+
+    def make_photo(self, size: tuple) -> str:
+        path = os.path.join(self.folder, '{0}x{1}.jpg'.format(*size))
+        Image.new('RGB', size, (200, 100, 50)).save(path, 'JPEG')
+        return path
+
+    def test_fitting_photo_not_hashed(self):
+        path = self.make_photo((100, 80))
+        with mock.patch.object(media_tools, 'file_digest') as file_digest:
+            self.assertEqual(fit_photo(path, self.cache_dir), path)
+        file_digest.assert_not_called()
+
+    def test_large_photo_resized_and_cached(self):
+        path = self.make_photo((MAX_PHOTO_SIDE + 100, 100))
+
+        cached_path = fit_photo(path, self.cache_dir)
+        self.assertEqual(os.path.dirname(cached_path), self.cache_dir)
+        with Image.open(cached_path) as image:
+            self.assertEqual(max(image.size), MAX_PHOTO_SIDE)
+
+        with mock.patch.object(Image.Image, 'save') as save:
+            self.assertEqual(fit_photo(path, self.cache_dir), cached_path)
+        save.assert_not_called()
+
+    def test_decompression_bomb_skipped(self):
+        path = self.make_photo((100, 100))
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            self.assertEqual(fit_photo(path, self.cache_dir), path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from scraper import InstagramScraper, DeadlineExceeded
+
+def make_scraper(prefetch_pages: int) -> InstagramScraper:
+    log_destination = tempfile.mkdtemp()
+    scraper = InstagramScraper(usernames=['user'], prefetch_pages=prefetch_pages,
+                               log_destination=log_destination)
+    for handler in scraper.logger.handlers[:]:
+        handler.close()
+        scraper.logger.removeHandler(handler)
+    shutil.rmtree(log_destination)
+    return scraper
+
+class Feed:
+    """Лента из pages страниц по page_size элементов; запоминает запросы."""
+    def __init__(self, pages: int, page_size: int = 3):
+        self.pages = pages
+        self.page_size = page_size
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def __call__(self, end_cursor):
+        page = int(end_cursor or 0)
+        with self.lock:
+            self.requested.append(page)
+        if page >= self.pages:
+            return None, None
+        items = list(range(page * self.page_size, (page + 1) * self.page_size))
+        return items, str(page + 1) if page + 1 < self.pages else None
+
+class PaginateTest(unittest.TestCase):
+    def test_same_items_with_and_without_prefetch(self):
+        for prefetch_pages in (0, 1, 3):
+            feed = Feed(5)
+            items = list(make_scraper(prefetch_pages).paginate(feed))
+            self.assertEqual(items, list(range(15)), prefetch_pages)
+            self.assertEqual(feed.requested, [0, 1, 2, 3, 4], prefetch_pages)
+
+    def test_early_stops_do_not_fetch_more(self):
+        for prefetch_pages in (0, 2):
+            scraper = make_scraper(prefetch_pages)
+
+            feed = Feed(10)
+            self.assertEqual(list(scraper.paginate(feed, limit=4)), list(range(6)))
+            self.assertEqual(feed.requested, [0, 1])
+
+            feed = Feed(10)
+            self.assertEqual(len(list(scraper.paginate(feed, max_pages=3))), 9)
+            self.assertEqual(feed.requested, [0, 1, 2])
+
+            feed = Feed(10)
+            items = list(scraper.paginate(feed, is_last_page=lambda items: 4 in items))
+            self.assertEqual(items, list(range(6)))
+            self.assertEqual(feed.requested, [0, 1])
+
+    def test_prefetch_is_bounded(self):
+        feed = Feed(100)
+        pages = make_scraper(2).paginate(feed)
+        next(pages)
+        # Потребитель занят первой страницей: запрошено не более
+        # prefetch_pages следующих страниц
+        with feed.lock:
+            requested = len(feed.requested)
+        self.assertLessEqual(requested, 3)
+        pages.close()
+
+    def test_fetch_error_is_raised(self):
+        def fetch(end_cursor):
+            if end_cursor:
+                raise ValueError('bad page')
+            return [1, 2], '1'
+
+        pages = make_scraper(1).paginate(fetch)
+        self.assertEqual(next(pages), 1)
+        self.assertEqual(next(pages), 2)
+        with self.assertRaises(ValueError):
+            next(pages)
+
+    def test_deadline_is_not_end_of_feed(self):
+        # По истечении срока safe_get возвращает None - это не конец ленты
+        for prefetch_pages in (0, 1):
+            scraper = make_scraper(prefetch_pages)
+            expired = threading.Event()
+            scraper.deadline_exceeded = expired.is_set
+
+            def fetch(end_cursor):
+                if end_cursor:
+                    expired.set()
+                    return None, None
+                return [1], '1'
+
+            with self.assertRaises(DeadlineExceeded):
+                list(scraper.paginate(fetch))
+
+class SettleDownloadsTest(unittest.TestCase):
+    def setUp(self):
+        self.scraper = make_scraper(0)
+        self.scraper.latest = True
+        self.scraper.latest_stamps_parser = object()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def make_file(self, name: str) -> str:
+        path = os.path.join(self.folder, name)
+        open(path, 'wb').close()
+        return path
+
+    def test_stamp_clamped_below_deferred(self):
+        newer = self.make_file('newer.jpg')
+        completed = [(100, False, [newer]), (50, False, [])]
+
+        self.assertEqual(self.scraper._settle_downloads(completed, [(80, False)]), 79)
+        self.assertTrue(os.path.exists(newer))
+
+    def test_incomplete_listing_keeps_stamp(self):
+        path = self.make_file('a.jpg')
+        stamp = self.scraper._settle_downloads([(100, False, [path])], [],
+                                               listing_complete=False)
+        self.assertLessEqual(stamp, 0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_file_watermark_drops_newer_files(self):
+        # Без файла меток водяным знаком служит самый новый файл папки
+        self.scraper.latest_stamps_parser = None
+        newer = self.make_file('newer.jpg')
+        older = self.make_file('older.jpg')
+        completed = [(100, False, [newer]), (50, False, [older])]
+
+        self.assertEqual(self.scraper._settle_downloads(completed, [(80, False)]), 50)
+        self.assertFalse(os.path.exists(newer))
+        self.assertTrue(os.path.exists(older))
+
+if __name__ == '__main__':
+    unittest.main()
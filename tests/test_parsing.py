@@ -0,0 +1,60 @@
+import json
+import unittest
+
+from parsing import JsonBlobScanner, iter_json_blobs
+
+MARKER = b'window._sharedData = '
+
+PAGE = (b'<html><script>var a = {"x": 1};</script><script>' + MARKER
+        + json.dumps({'user': {'bio': 'a "quoted" {brace} \\ slash',
+                               'edges': [{'id': 1}, {'id': 2}]}}).encode()
+        + b';</script></html>')
+
+def split(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+class JsonBlobScannerTest(unittest.TestCase):
+    def test_whole_page(self):
+        [(marker, blob)] = JsonBlobScanner([MARKER]).feed(PAGE)
+        self.assertEqual(marker, MARKER)
+        self.assertEqual(json.loads(blob)['user']['edges'], [{'id': 1}, {'id': 2}])
+
+    def test_any_chunking(self):
+        # Маркер, экранирование и строки со скобками разрезаются между фрагментами
+        expected = JsonBlobScanner([MARKER]).feed(PAGE)
+        for size in range(1, 40):
+            scanner = JsonBlobScanner([MARKER])
+            found = []
+            for chunk in split(PAGE, size):
+                found.extend(scanner.feed(chunk))
+            self.assertEqual(found, expected, size)
+
+    def test_several_markers(self):
+        page = b'A = {"a": {}} B = {"b": "}"} A = {"c": 3}'
+        found = JsonBlobScanner([b'A = ', b'B = ']).feed(page)
+        self.assertEqual(found, [(b'A = ', b'{"a": {}}'), (b'B = ', b'{"b": "}"}'),
+                                 (b'A = ', b'{"c": 3}')])
+
+    def test_no_marker(self):
+        self.assertEqual(JsonBlobScanner([MARKER]).feed(b'<html>{"x": 1}</html>'), [])
+
+class IterJsonBlobsTest(unittest.TestCase):
+    def test_stops_at_limit(self):
+        chunks = split(PAGE, 16)
+        self.assertEqual(list(iter_json_blobs(iter(chunks), [MARKER], 32)), [])
+
+    def test_stops_reading_when_closed(self):
+        # Потребитель получил объект - оставшиеся фрагменты не читаются
+        read = []
+        def chunks():
+            for chunk in split(PAGE, 16) + [b'x'] * 100:
+                read.append(chunk)
+                yield chunk
+
+        blobs = iter_json_blobs(chunks(), [MARKER], 1 << 20)
+        next(blobs)
+        blobs.close()
+        self.assertNotIn(b'x', read)
+
+if __name__ == '__main__':
+    unittest.main()
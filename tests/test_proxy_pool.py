@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import proxy_finder
+
+class ProxyPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.parsed = []
+
+        def parse_proxies():
+            self.parsed.append(1)
+            self.release.wait(5)
+            return ['a:1', 'b:2']
+
+        for name, value in (('parse_proxies', parse_proxies),
+                            ('check_proxy', lambda proxy: 0.1)):
+            patcher = mock.patch.object(proxy_finder, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+        self.pool = proxy_finder.ProxyPool()
+
+    def test_random_does_not_wait_for_refresh(self):
+        start = time.monotonic()
+        self.assertIsNone(self.pool.random())
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.release.set()
+        for _ in range(50):
+            if self.pool.proxies():
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(self.pool.proxies()), ['a:1', 'b:2'])
+
+    def test_early_refresh_rate_limited(self):
+        # В пуле меньше MIN_POOL_SIZE прокси, но обновление уже выполнялось
+        self.release.set()
+        self.pool.ensure()
+        for _ in range(5):
+            self.pool.random()
+        time.sleep(0.1)
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_prepare_waits_only_for_empty_pool(self):
+        self.release.set()
+        self.pool.prepare()
+        self.assertEqual(len(self.pool.proxies()), 2)
+
+        # Устаревший непустой пул обновляется в фоне
+        self.release.clear()
+        self.pool.refreshed = self.pool.attempted = time.monotonic() - 2 * self.pool.ttl
+        start = time.monotonic()
+        self.pool.prepare()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(self.pool.proxies()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from constants import RATE_LIMITS
+from rate_control import RateController
+from scraper import InstagramScraper, LoginPool
+
+class SharedLimitersTest(unittest.TestCase):
+    def test_cdn_limiter_shared_between_controllers(self):
+        shared = RateController.shared_limiters(RATE_LIMITS)
+        first = RateController(RATE_LIMITS, shared=shared)
+        second = RateController(RATE_LIMITS, shared=shared)
+
+        self.assertIs(first.limiters['cdn'], second.limiters['cdn'])
+        self.assertIsNot(first.limiters['graphql'], second.limiters['graphql'])
+        self.assertIsNot(first.limiters['profile'], second.limiters['profile'])
+
+    def test_login_pool_scrapers_share_cdn_limiter(self):
+        pool = LoginPool([{'login': 'a', 'password': 'p', 'cookiejar': None},
+                          {'login': 'b', 'password': 'p', 'cookiejar': None}])
+        scrapers = []
+        original_init = InstagramScraper.__init__
+
+        def init(scraper, **kwargs):
+            original_init(scraper, **kwargs)
+            scrapers.append(scraper)
+            # Дальше вход в Instagram, не нужный для проверки
+            raise RuntimeError('stop before authentication')
+
+        log_destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_destination)
+        with mock.patch.object(InstagramScraper, '__init__', init):
+            for identity in pool.identities:
+                with self.assertRaises(RuntimeError):
+                    pool.scrape_shard(identity, ['user'], {'log_destination': log_destination},
+                                      False)
+
+        first, second = (scraper.rate_control.limiters for scraper in scrapers)
+        self.assertIs(first['cdn'], second['cdn'])
+        self.assertIsNot(first['graphql'], second['graphql'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from constants import LINK_SUFFIX
+from test_paginate import make_scraper
+
+class LastScrapedFilemtimeTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.scraper = make_scraper(0)
+
+    def make_file(self, name: str, mtime: int):
+        path = os.path.join(self.folder, name)
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+
+    def test_empty_folder(self):
+        self.assertEqual(self.scraper.get_last_scraped_filemtime(self.folder), 0)
+
+    def test_lone_link_marker(self):
+        # После очистки от слишком большого видео остаётся только метка ссылки
+        self.make_file('a.1.mp4' + LINK_SUFFIX, 1000)
+        self.assertEqual(self.scraper.get_last_scraped_filemtime(self.folder), 1000)
+
+    def test_newest_of_media_and_links(self):
+        self.make_file('a.1.jpg', 500)
+        self.make_file('a.2.mp4' + LINK_SUFFIX, 1000)
+        self.make_file('a.3.mp4', 700)
+        self.assertEqual(self.scraper.get_last_scraped_filemtime(self.folder), 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import workers
+
+def square(x):
+    return x * x
+
+def crash_in_pool(x):
+    # Имитация процесса, завершённого OOM killer
+    if x == 3 and multiprocessing.current_process().name != 'MainProcess':
+        os._exit(1)
+    return x * x
+
+def crash_once(marker, x):
+    if x == 3 and os.path.exists(marker):
+        os.remove(marker)
+        os._exit(1)
+    return x * x
+
+class WorkersMapTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(workers, 'CPU_WORKERS', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(workers.shutdown)
+        workers.shutdown()
+
+    def test_map(self):
+        self.assertEqual(workers.map(square, range(6)), [0, 1, 4, 9, 16, 25])
+
+    def test_broken_pool_retried_in_new_pool(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        marker = os.path.join(folder, 'crash')
+        open(marker, 'w').close()
+
+        results = workers.map(crash_once, [marker] * 6, range(6))
+
+        self.assertEqual(results, [0, 1, 4, 9, 16, 25])
+        self.assertFalse(os.path.exists(marker))
+
+    def test_repeatedly_broken_pool_falls_back_inline(self):
+        self.assertEqual(workers.map(crash_in_pool, range(6)), [0, 1, 4, 9, 16, 25])
+        # Следующие задачи получают новый пул
+        self.assertEqual(workers.map(square, range(3)), [0, 1, 4])
+
+if __name__ == '__main__':
+    unittest.main()
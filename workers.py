@@ -0,0 +1,124 @@
+"""В данном модуле реализован пул процессов для выполнения задач, требовательных
+к ресурсам процессора (обработка изображений, сведение и сжатие видео).
+Задачи выполняются в отдельных процессах и не конкурируют за GIL с потоками
+загрузки. Разбор JSON в пул не передаётся: пересылка результата между
+процессами обходится дороже самого разбора.
+
+Дочерние процессы запускаются методом spawn и повторно импортируют основной
+модуль программы; настройка журнала (модуль config_loader) в них не
+выполняется, сообщения об ошибках выводятся в stderr.
+
+Функции задач должны быть объявлены на уровне модуля (требование сериализации
+pickle). Если пул отключён (cpu_workers = 0) или недоступен, задачи
+выполняются в вызывающем потоке.
+"""
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config_loader import CPU_WORKERS
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ProcessPoolExecutor:
+    """Возвращает пул процессов, создавая его при первом обращении.
+    Возвращает None, если пул отключён в настройках.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None and CPU_WORKERS > 0:
+            # Метод spawn безопасен при запуске из многопоточного процесса
+            _executor = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        return _executor
+
+def _run_inline(fn, *args, **kwargs) -> Future:
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def submit(fn, *args, **kwargs) -> Future:
+    """Ставит задачу fn(*args, **kwargs) в очередь пула процессов."""
+    global _executor
+
+    executor = get_executor()
+    if executor is None:
+        return _run_inline(fn, *args, **kwargs)
+
+    try:
+        return executor.submit(fn, *args, **kwargs)
+    except (BrokenProcessPool, RuntimeError) as e:
+        logging.warning('Пул процессов недоступен, задача будет выполнена '
+                        + 'в текущем потоке. ' + str(e))
+        _discard(executor)
+        return _run_inline(fn, *args, **kwargs)
+
+def _discard(executor: ProcessPoolExecutor):
+    """Забывает неработающий пул; следующая задача создаст новый."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+def run(fn, *args, **kwargs):
+    """Выполняет задачу в пуле процессов и возвращает её результат."""
+    return submit(fn, *args, **kwargs).result()
+
+def map(fn, *iterables) -> list:
+    """Параллельно выполняет fn для каждого набора аргументов и возвращает
+    список результатов в исходном порядке.
+
+    Если процесс пула аварийно завершился (например, из-за нехватки памяти),
+    незавершённые задачи повторяются в новом пуле, а при повторном сбое
+    выполняются в вызывающем потоке.
+    """
+    arguments = list(zip(*iterables))
+    executor = get_executor()
+    futures = [submit(fn, *args) for args in arguments]
+    results = []
+    failures = 0
+
+    for i in range(len(arguments)):
+        while True:
+            try:
+                results.append(futures[i].result())
+                break
+            except BrokenProcessPool as e:
+                failures += 1
+                if executor is not None:
+                    _discard(executor)
+                if failures == 1:
+                    logging.error('Процесс пула аварийно завершился, задачи '
+                                  + 'будут повторены в новом пуле. ' + str(e))
+                    executor = get_executor()
+                    futures[i:] = [submit(fn, *args)
+                                   for args in arguments[i:]]
+                else:
+                    logging.error('Процесс пула аварийно завершился повторно, '
+                                  + 'задачи будут выполнены в текущем '
+                                  + 'потоке. ' + str(e))
+                    executor = None
+                    futures[i:] = [_run_inline(fn, *args)
+                                   for args in arguments[i:]]
+
+    return results
+
+def shutdown():
+    """Останавливает пул процессов."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None